@@ -0,0 +1,739 @@
+# This file contains simple throughput benchmarks for the performance-sensitive parts of the project.
+# Run it from the top directory, optionally naming the benchmarks to run:
+#   python benchmarks.py
+#   python benchmarks.py cipher_engine
+#   python benchmarks.py --self-test
+
+import os
+import re
+import sys
+import time
+import random
+import tempfile
+import tracemalloc
+import shutil
+import subprocess
+
+import numpy as np
+import sqlalchemy
+import sqlalchemy.orm
+
+import encoders
+import helpers
+import db_connect
+import feature_store
+
+from constants import *
+
+# Text used for benchmarking when a specific file isn't needed: random characters from the set,
+# weighted slightly toward spaces and newlines so it looks a bit like prose.
+def make_sample_text(length: int) -> str:
+    population = encoders.CHARSET + " " * 10 + "\n"
+    return "".join(random.choices(population, k=length))
+
+# Run a function several times and return the best elapsed time in seconds
+def best_time(func, repeats: int = 3) -> float:
+    best = None
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+# Report throughput of a before/after pair
+def report_throughput(label: str, byte_count: int, before_seconds: float, after_seconds: float):
+    mb = byte_count / 1e6
+    print(f"{label:<28} before {mb / before_seconds:9.2f} MB/s   after {mb / after_seconds:9.2f} MB/s   "
+          f"speedup {before_seconds / after_seconds:7.1f}x")
+
+
+# The original, character-at-a-time implementations. They are kept here only as the baseline
+# for the benchmarks below.
+def _legacy_string_to_offsets(in_str: str) -> list[int]:
+    return [encoders.CHARSET.find(c) for c in in_str]
+
+def _legacy_offsets_to_string(offsets: list[int]) -> str:
+    return "".join(encoders.CHARSET[i] for i in offsets)
+
+def _legacy_do_caesar(plaintext: str, key: int) -> str:
+    charset = encoders.CHARSET
+    return "".join([charset[(charset.find(c) + key) % len(charset)] for c in plaintext])
+
+def _legacy_do_substitution(plaintext: str, key_from: str, key_to: str) -> str:
+    return "".join([key_to[key_from.find(c)] for c in plaintext])
+
+def _legacy_chunkify(inputs: list, chunk_size: int) -> list[list]:
+    chunks = []
+    offset = 0
+    while offset < len(inputs):
+        if (offset + chunk_size >= len(inputs)):
+            offset = len(inputs) - chunk_size
+        chunks.append(inputs[offset : offset + chunk_size])
+        offset += chunk_size
+    return chunks
+
+def _legacy_encode_simple(raw_text: str) -> str:
+    good_part_start = raw_text.find(encoders.PG_START_CONTENT)
+    good_part_end = raw_text.find(encoders.PG_END_CONTENT)
+    if good_part_start == -1:
+        good_part_start = 0
+    else:
+        good_part_start = raw_text.find("\n", good_part_start)+1
+    if good_part_end == -1:
+        good_part_end = len(raw_text)
+
+    result = raw_text[good_part_start:good_part_end]
+    result = result.translate(encoders.SIMPLIFICATION_MAP)
+    result = result.replace('\r\n', '\n')
+    result = result.replace('\r', '\n')
+    result = result.upper()
+    result = "".join([c for c in result if c in encoders.CHARSET])
+    result = re.sub(r'\n\n+', '\n\n', result)
+    result = re.sub(r'  +', ' ', result)
+    return result.strip()
+
+
+# Compare the lookup-table cipher engine with the original implementations
+def bench_cipher_engine(length: int = 1_000_000):
+    text = make_sample_text(length)
+    caesar_key = encoders.get_key_caesar()
+    subst_key = encoders.get_key_substitution()
+    offsets = encoders.string_to_offsets(text)
+
+    print(f"Cipher engine, {length} characters:")
+
+    before = best_time(lambda: _legacy_string_to_offsets(text))
+    after = best_time(lambda: encoders.string_to_offsets(text))
+    report_throughput("string_to_offsets", length, before, after)
+
+    before = best_time(lambda: _legacy_offsets_to_string(offsets))
+    after = best_time(lambda: encoders.offsets_to_string(offsets))
+    report_throughput("offsets_to_string", length, before, after)
+
+    before = best_time(lambda: _legacy_do_caesar(text, caesar_key))
+    after = best_time(lambda: encoders.encode_caesar(text, caesar_key))
+    report_throughput("encode_caesar", length, before, after)
+
+    before = best_time(lambda: _legacy_do_substitution(text, encoders.CHARSET, subst_key))
+    after = best_time(lambda: encoders.encode_substitution(text, subst_key))
+    report_throughput("encode_substitution", length, before, after)
+
+    # Sanity check, since a fast wrong answer is no good
+    if encoders.encode_caesar(text, caesar_key) != _legacy_do_caesar(text, caesar_key):
+        raise Exception("Caesar engine output does not match the original implementation")
+    if encoders.encode_substitution(text, subst_key) != _legacy_do_substitution(text, encoders.CHARSET, subst_key):
+        raise Exception("Substitution engine output does not match the original implementation")
+
+
+# Compare encrypting (and verifying) one plaintext under several keys the way the librarian used to,
+# one key at a time, against doing all the keys at once
+def bench_multi_key(length: int = 1_000_000, key_count: int = 5):
+    text = make_sample_text(length)
+    keys = random.sample(range(1, len(encoders.CHARSET)), key_count)
+
+    def one_at_a_time(func_do_caesar):
+        for key in keys:
+            cipher_text = func_do_caesar(text, key)
+            if func_do_caesar(cipher_text, -key) != text:
+                raise Exception("Round trip failed")
+
+    def all_at_once():
+        cipher_texts = encoders.encode_caesar_many(text, keys)
+        if len(encoders.mismatched_rows(text, encoders.decode_caesar_many(cipher_texts, keys))) > 0:
+            raise Exception("Round trip failed")
+        return [encoders.codes_to_string(row) for row in cipher_texts]
+
+    print(f"Multi-key Caesar encryption with verification, {length} characters, {key_count} keys:")
+    before = best_time(lambda: one_at_a_time(_legacy_do_caesar), repeats=1)
+    after_single = best_time(lambda: one_at_a_time(encoders._do_caesar))
+    after = best_time(all_at_once)
+    report_throughput("one key at a time", length * key_count, before, after_single)
+    report_throughput("encode_caesar_many", length * key_count, before, after)
+
+
+# Compare the single-pass simplifier with the original, over the whole intake directory
+def bench_simplifier(intake_dir: str = DATA_INTAKE_DIR):
+    paths = [os.path.join(intake_dir, f) for f in sorted(os.listdir(intake_dir)) if f.endswith(".txt")]
+    raw_texts = [helpers.read_text_file(p) for p in paths]
+    byte_count = sum(len(t.encode('utf-8')) for t in raw_texts)
+
+    print(f"Simplifier, {len(raw_texts)} files from {intake_dir}:")
+    before = best_time(lambda: [_legacy_encode_simple(t) for t in raw_texts], repeats=1)
+    after = best_time(lambda: [encoders.encode_simple(t) for t in raw_texts])
+    report_throughput("encode_simple", byte_count, before, after)
+
+# Run a function and return the peak memory allocated while it ran, in bytes
+def peak_memory(func) -> int:
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# Compare chunking a book's offsets into lists (then float arrays, as the training code used to)
+# against chunking into a uint8 view
+def bench_chunkify(length: int = 10_000_000, chunk_size: int = 256):
+    offsets = encoders.string_to_offset_array(make_sample_text(length))
+    offsets_list = offsets.tolist()
+
+    def as_lists():
+        return [np.array(chunk).astype(float) for chunk in _legacy_chunkify(offsets_list, chunk_size)]
+
+    # The length isn't a multiple of chunk_size, so the last chunk is moved back to cover the end, as a separate view
+    def as_view():
+        return helpers.chunkify_view(offsets, chunk_size, dtype=np.uint8)
+
+    print(f"Chunkify, {length} offsets, chunk size {chunk_size}:")
+    before = best_time(as_lists, repeats=1)
+    after = best_time(as_view)
+    report_throughput("chunkify", length, before, after)
+    print(f"Peak memory: before {peak_memory(as_lists) / 1e6:.1f} MB, after {peak_memory(as_view) / 1e6:.3f} MB")
+    (chunks, tail) = as_view()
+    print(f"Covering the end: {len(chunks)} chunks plus {len(tail)}, share memory with input: {np.shares_memory(chunks, offsets) and np.shares_memory(tail, offsets)}")
+    overlapping = helpers.chunkify(offsets, chunk_size, dtype=np.uint8, stride=chunk_size // 4)
+    print(f"Overlapping windows (stride {chunk_size // 4}): {overlapping.shape[0]} chunks, shares memory with input: {np.shares_memory(overlapping, offsets)}")
+
+
+# Create the project's tables in a SQLite database, as a local stand-in for PostgreSQL.
+# The tables come from the ORM models in db_connect, which mirror sql/schema.sql.
+def create_sqlite_standin(path: str) -> str:
+    url = f"sqlite:///{path}"
+    engine = sqlalchemy.create_engine(url)
+    db_connect.Base.metadata.create_all(engine)
+    engine.dispose()
+    return url
+
+# Report rows per second for a before/after pair
+def report_row_rate(label: str, row_count: int, before_seconds: float, after_seconds: float):
+    print(f"{label:<28} before {row_count / before_seconds:9.0f} rows/s   after {row_count / after_seconds:9.0f} rows/s   "
+          f"speedup {before_seconds / after_seconds:7.1f}x")
+
+# Compare adding keys and files one row (and one commit) at a time, then looking up the new ID,
+# against the bulk ID-returning methods. Uses a SQLite file as a stand-in for the real database.
+def bench_db_writes(row_count: int = 2000, batch_size: int = 100):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        db = db_connect.DB(None, url=create_sqlite_standin(os.path.join(temp_dir, "bench.sqlite")))
+
+        with db.get_session() as session:
+            encoder_id = db.add_encoder(session, encoders.ENCODER_SUBST)
+            key_type_id = db.add_key_type(session, encoders.KEY_NAME_SUBST)
+            source_id = db.add_source(session, "Benchmark", "https://example.com", False)
+
+            key_values = [encoders.get_key_substitution() for _ in range(row_count * 2)]
+            old_values = key_values[:row_count]
+            new_values = key_values[row_count:]
+
+            def one_at_a_time():
+                for value in old_values:
+                    session.add(db.db_keys_tbl(key_type_id=key_type_id, value=value))
+                    session.commit()
+                    key_id = db.get_key_id_by_type_and_value(session, key_type_id, value)
+
+                    session.add(db.db_files_tbl(source_id=source_id, encoder_id=encoder_id, key_id=key_id,
+                                                path=f"{value}.txt", test_only=False))
+                    session.commit()
+
+            def in_batches():
+                for i in range(0, row_count, batch_size):
+                    batch = new_values[i : i + batch_size]
+                    key_ids = db.add_keys(session, key_type_id, batch)
+                    db.add_files(session, [(source_id, encoder_id, key_id, f"{value}.txt", False)
+                                           for key_id, value in zip(key_ids, batch)])
+
+            print(f"Database writes, {row_count} keys + {row_count} files, SQLite stand-in, batches of {batch_size}:")
+            before = best_time(one_at_a_time, repeats=1)
+            after = best_time(in_batches, repeats=1)
+            report_row_rate("add_keys + add_files", row_count * 2, before, after)
+        db.engine.dispose()
+    finally:
+        shutil.rmtree(temp_dir)
+
+# Compare the ID and key lookups the notebooks make with a cold cache (as every lookup used to be)
+# against a warm one. Uses a SQLite file as a stand-in for the real database.
+def bench_db_lookups(repeats: int = 200):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        db = db_connect.DB(None, url=create_sqlite_standin(os.path.join(temp_dir, "bench.sqlite")))
+
+        with db.get_session() as session:
+            for encoder in encoders.ALL_ENCODER_NAMES:
+                db.add_encoder(session, encoder)
+            for key_type in encoders.KEY_NAMES:
+                db.add_key_type(session, key_type)
+            key_type_id = db.get_key_type_id(session, encoders.KEY_NAME_CAESAR)
+            key_ids = db.add_keys(session, key_type_id, [str(k) for k in range(1, len(encoders.CHARSET))])
+
+            def lookups(cold: bool):
+                for _ in range(repeats):
+                    if cold:
+                        db.clear_caches()
+                    db.get_id_maps(session)
+                    for key_id in key_ids:
+                        if cold:
+                            db.clear_caches()
+                        db.get_key_by_id(session, key_id)
+
+            print(f"Database lookups, get_id_maps + {len(key_ids)} x get_key_by_id, {repeats} times, SQLite stand-in:")
+            before = best_time(lambda: lookups(cold=True), repeats=1)
+            after = best_time(lambda: lookups(cold=False), repeats=1)
+            report_row_rate("cold vs warm cache", repeats * (len(key_ids) + 1), before, after)
+            print(f"Cache stats: {db.get_cache_stats()}")
+        db.engine.dispose()
+    finally:
+        shutil.rmtree(temp_dir)
+
+# Compare constructing a DB and running a first query, reflecting the schema with automap (as DB used to)
+# against the declared ORM models, then compare opening a new connection for every session against
+# reusing pooled connections. Uses a SQLite file as a stand-in for the real database, so reflection and
+# connecting are both far cheaper here than over the network to PostgreSQL.
+def bench_db_connect(repeats: int = 20, session_count: int = 500):
+    import sqlalchemy.ext.automap
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        url = create_sqlite_standin(os.path.join(temp_dir, "bench.sqlite"))
+
+        def first_query(engine, encoder_tbl):
+            with sqlalchemy.orm.Session(engine) as session:
+                session.query(encoder_tbl.id).all()
+
+        def reflected():
+            engine = sqlalchemy.create_engine(url)
+            base = sqlalchemy.ext.automap.automap_base()
+            base.prepare(autoload_with=engine)
+            first_query(engine, base.classes.encoder_names)
+            engine.dispose()
+
+        def declared():
+            db = db_connect.DB(None, url=url)
+            first_query(db.engine, db.db_encoder_tbl)
+            db.engine.dispose()
+
+        print(f"Database connection, SQLite stand-in:")
+        before = best_time(reflected, repeats) * 1000
+        after = best_time(declared, repeats) * 1000
+        print(f"{'DB() + first query':<28} before {before:8.2f} ms   after {after:8.2f} ms   speedup {before / after:7.1f}x")
+
+        unpooled = sqlalchemy.create_engine(url, poolclass=sqlalchemy.pool.NullPool)
+        db = db_connect.DB(None, url=url)
+        before = best_time(lambda: [first_query(unpooled, db.db_encoder_tbl) for _ in range(session_count)], repeats=1)
+        after = best_time(lambda: [first_query(db.engine, db.db_encoder_tbl) for _ in range(session_count)], repeats=1)
+        print(f"{f'{session_count} sessions':<28} before {session_count / before:9.0f} /s      after {session_count / after:9.0f} /s      "
+              f"speedup {before / after:7.1f}x")
+        unpooled.dispose()
+        db.engine.dispose()
+    finally:
+        shutil.rmtree(temp_dir)
+
+# Compare building training arrays from text files, the way DB.get_features_and_targets() does,
+# against loading them from a feature store. Uses the intake files, simplified and encrypted into a temp directory.
+def bench_feature_store(intake_dir: str = DATA_INTAKE_DIR, chunk_size: int = 256, keys_per_file: int = 2):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        file_sets = []
+        file_id = 0
+        for source_id, filename in enumerate(sorted(f for f in os.listdir(intake_dir) if f.endswith(".txt"))):
+            plaintext = encoders.encode_simple(helpers.read_text_file(os.path.join(intake_dir, filename)))
+            plaintext_path = os.path.join(temp_dir, f"plain_{source_id}.txt")
+            helpers.write_text_file(plaintext, plaintext_path)
+            ciphertexts = []
+            for key in random.sample(range(1, len(encoders.CHARSET)), keys_per_file):
+                ciphertext_path = os.path.join(temp_dir, f"cipher_{file_id}.txt")
+                helpers.write_text_file(encoders.encode_caesar(plaintext, key), ciphertext_path)
+                ciphertexts.append((source_id, file_id, key, str(key), ciphertext_path))
+                file_id += 1
+            file_sets.append((plaintext_path, ciphertexts))
+
+        def from_text_files():
+            X, y_keys, y_texts = [], [], []
+            for plaintext_path, ciphertexts in file_sets:
+                plaintext_chunks = helpers.chunkify(encoders.string_to_offsets(helpers.read_text_file(plaintext_path)), chunk_size)
+                for _, _, _, key_value, ciphertext_path in ciphertexts:
+                    ciphertext_chunks = helpers.chunkify(encoders.string_to_offsets(helpers.read_text_file(ciphertext_path)), chunk_size)
+                    for i in range(len(ciphertext_chunks)):
+                        X.append(np.array(ciphertext_chunks[i]).astype(float))
+                        y_texts.append(np.array(plaintext_chunks[i]).astype(float))
+                        y_keys.append(float(key_value))
+            return np.array(X), np.array(y_keys), np.array(y_texts)
+
+        root = os.path.join(temp_dir, "features")
+        store_dir = feature_store.get_store_dir(encoders.ENCODER_CAESAR, chunk_size, False, root)
+        start_time = time.perf_counter()
+        feature_store.add_files_to_store(store_dir, encoders.ENCODER_CAESAR, chunk_size, False, file_sets)
+        build_seconds = time.perf_counter() - start_time
+
+        def from_store():
+            (X, y_keys, y_texts, _) = feature_store.load_features_and_targets(encoders.ENCODER_CAESAR, chunk_size, False, root=root)
+            # Touch every value, so the comparison includes actually reading the data
+            return int(X.sum()) + int(y_keys.sum()) + int(y_texts.sum())
+
+        (X, _, _) = from_text_files()
+        print(f"Feature store, {len(X)} chunks of {chunk_size} from {file_id} encrypted files (store built in {build_seconds:.2f} seconds):")
+        before = best_time(from_text_files, repeats=1)
+        after = best_time(from_store)
+        report_row_rate("load features and targets", len(X), before, after)
+        print(f"Memory for X: {X.nbytes / 1e6:.1f} MB as float64 arrays, {X.nbytes / 8e6:.1f} MB in the store")
+    finally:
+        shutil.rmtree(temp_dir)
+
+# Build Caesar crackers from the bundled models: one using model.predict(), plus one for each
+# of the given lists of extra arguments (e.g. serving=True)
+def load_caesar_crackers(*extra_kwargs: dict) -> list:
+    # Importing these pulls in TensorFlow, so only do it when a benchmark needs them
+    import models
+    import crackers
+
+    scaler = helpers.load_scaler_from_file(helpers.get_recommended_scaler_path(encoders.ENCODER_CAESAR, 256, temp=False))
+    key_model = models.load_model(models.CAESAR_KEY_MODEL_PATH)
+    text_model = models.load_model(models.CAESAR_TEXT_MODEL_PATH)
+    return [crackers.Caesar_Cracker(scaler, key_model, text_model, **kwargs) for kwargs in [{}] + list(extra_kwargs)]
+
+def bench_crackers(doc_count: int = 200, min_length: int = 256, max_length: int = 2000):
+    (cracker,) = load_caesar_crackers()
+
+    docs = [make_sample_text(random.randint(min_length, max_length)) for _ in range(doc_count)]
+    # Warm up, so neither side pays for building the predict functions
+    cracker.infer_keys_batch(docs[:2])
+    cracker.infer_texts_batch(docs[:2])
+
+    print(f"Crackers, {doc_count} documents of {min_length} to {max_length} characters:")
+    for (label, loop_func, batch_func) in [
+            ("infer keys", cracker.infer_key_with_model, cracker.infer_keys_batch),
+            ("infer texts", cracker.infer_text_with_model, cracker.infer_texts_batch)]:
+        before = best_time(lambda: [loop_func(d) for d in docs], repeats=1)
+        after = best_time(lambda: batch_func(docs), repeats=1)
+        print(f"{label:<28} before {doc_count / before:9.1f} docs/s   after {doc_count / after:9.1f} docs/s   "
+              f"speedup {before / after:7.1f}x")
+
+
+# Compare key recovery by frequency analysis against the key model, on chunk-sized pieces of
+# simplified intake files. The frequencies come from the first three quarters of the files,
+# and the test pieces from the rest.
+# Simplify the intake files, take the character frequencies from three quarters of them, and encrypt pieces
+# of the rest with random Caesar keys. Returns a tuple: (frequencies, docs, keys, plaintexts, held-out file count)
+def make_held_out_caesar_docs(intake_dir: str, doc_count: int, length: int) -> tuple:
+    import crackers
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        paths = []
+        for filename in sorted(f for f in os.listdir(intake_dir) if f.endswith(".txt")):
+            paths.append(os.path.join(temp_dir, filename))
+            helpers.simplify_text_file(os.path.join(intake_dir, filename), paths[-1])
+        split = len(paths) * 3 // 4
+        frequencies = crackers.get_character_frequencies(paths[:split])
+        texts = [helpers.read_text_file(p) for p in paths[split:]]
+    finally:
+        shutil.rmtree(temp_dir)
+
+    docs, keys, plaintexts = [], [], []
+    for _ in range(doc_count):
+        text = random.choice(texts)
+        start = random.randint(0, len(text) - length)
+        plaintexts.append(text[start : start + length])
+        keys.append(encoders.get_key_caesar())
+        docs.append(encoders.encode_caesar(plaintexts[-1], keys[-1]))
+    return (frequencies, docs, keys, plaintexts, len(texts))
+
+def bench_frequency_cracker(intake_dir: str = DATA_INTAKE_DIR, doc_count: int = 1000, length: int = 256):
+    import crackers
+
+    (frequencies, docs, keys, _, file_count) = make_held_out_caesar_docs(intake_dir, doc_count, length)
+    (model_cracker,) = load_caesar_crackers()
+    model_cracker.infer_keys_batch(docs[:2])
+    frequency_cracker = crackers.Frequency_Caesar_Cracker(frequencies)
+
+    print(f"Caesar key recovery, {doc_count} pieces of {length} characters from {file_count} held-out files:")
+    for (label, cracker) in [("key model", model_cracker), ("frequency analysis", frequency_cracker)]:
+        guesses = []
+        seconds = best_time(lambda: guesses.append(cracker.infer_keys_batch(docs)), repeats=1)
+        accuracy = np.mean(np.array(guesses[-1]) == keys)
+        print(f"{label:<28} {doc_count / seconds:11.1f} docs/s   accuracy {accuracy:7.2%}")
+
+# Compare recovering Caesar plaintexts with the text model against inferring the key, decrypting, and only
+# asking the text model about decryptions that don't fit the corpus character frequencies
+def bench_decrypting_cracker(intake_dir: str = DATA_INTAKE_DIR, doc_count: int = 1000, length: int = 256):
+    import crackers
+
+    (frequencies, docs, _, plaintexts, file_count) = make_held_out_caesar_docs(intake_dir, doc_count, length)
+    (model_cracker,) = load_caesar_crackers()
+    model_cracker.infer_texts_batch(docs[:2])
+    frequency_cracker = crackers.Frequency_Caesar_Cracker(frequencies)
+    decrypting_crackers = [
+        ("key model + decrypt", crackers.Decrypting_Caesar_Cracker(model_cracker, frequencies, text_cracker=model_cracker)),
+        ("frequency + decrypt", crackers.Decrypting_Caesar_Cracker(frequency_cracker, frequencies, text_cracker=model_cracker)),
+    ]
+
+    expected = np.array([encoders.string_to_offset_array(p) for p in plaintexts])
+    print(f"Caesar text recovery, {doc_count} pieces of {length} characters from {file_count} held-out files:")
+    for (label, cracker) in [("text model", model_cracker)] + decrypting_crackers:
+        texts = []
+        seconds = best_time(lambda: texts.append(cracker.infer_texts_batch(docs)), repeats=1)
+        accuracy = np.mean(np.array([encoders.string_to_offset_array(t) for t in texts[-1]]) == expected)
+        fallbacks = getattr(cracker, "fallback_count", doc_count)
+        print(f"{label:<28} {doc_count / seconds:11.1f} docs/s   character accuracy {accuracy:7.2%}   text model used for {fallbacks} docs")
+
+
+# Keys evaluated per second by the substitution key search: rescoring the whole text for every
+# swap, against rescoring only the quadgrams a swap affects, then the full search with and without
+# a process pool
+def bench_substitution_cracker(intake_dir: str = DATA_INTAKE_DIR, length: int = 1000, swap_count: int = 20000):
+    import crackers
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        paths = []
+        for filename in sorted(f for f in os.listdir(intake_dir) if f.endswith(".txt")):
+            paths.append(os.path.join(temp_dir, filename))
+            helpers.simplify_text_file(os.path.join(intake_dir, filename), paths[-1])
+        table_path = os.path.join(temp_dir, "quadgrams.npy")
+        table = crackers.get_quadgram_table(table_path, paths[:-1])
+        flat_table = table.reshape(-1)
+
+        plaintext = helpers.read_text_file(paths[-1])
+        start = random.randint(0, len(plaintext) - length)
+        ciphertext = encoders.encode_substitution(plaintext[start : start + length], encoders.get_key_substitution())
+        text = crackers._Quadgram_Text(ciphertext)
+        mapping = np.random.permutation(len(encoders.CHARSET))
+        indexes = text.table_indexes(mapping)
+        values = flat_table[indexes]
+        letters = [random.choice(text.letters) for _ in range(swap_count // (len(encoders.CHARSET) - 1))]
+        key_count = len(letters) * (len(encoders.CHARSET) - 1)
+
+        def full_rescoring():
+            for a in letters:
+                for b in range(len(encoders.CHARSET)):
+                    if b != a:
+                        swapped = mapping.copy()
+                        swapped[a], swapped[b] = swapped[b], swapped[a]
+                        text.score(flat_table, swapped)
+
+        def incremental():
+            for a in letters:
+                text.swap_deltas(flat_table, mapping, indexes, values, a)
+
+        print(f"Substitution cracker, {length} characters of ciphertext:")
+        print(f"{'full rescoring':<28} {key_count / best_time(full_rescoring, repeats=1):11.0f} keys/s")
+        print(f"{'incremental rescoring':<28} {key_count / best_time(incremental, repeats=1):11.0f} keys/s")
+
+        for workers in sorted({1, os.cpu_count()}):
+            cracker = crackers.Substitution_Cracker(table_path=table_path, workers=workers)
+            decrypted = encoders.decode_substitution(ciphertext, cracker.infer_key(ciphertext))
+            accuracy = np.mean([a == b for (a, b) in zip(decrypted, plaintext[start : start + length])])
+            print(f"{f'search, {workers} worker(s)':<28} {cracker.keys_per_second():11.0f} keys/s   "
+                  f"{cracker.search_seconds:6.2f} seconds   characters right {accuracy:7.2%}")
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+# Compare getting character counts the way statcheck.ipynb used to, with a pandas DataFrame built from
+# every file's characters, against building the n-gram index once and then loading counts from it
+def bench_ngram_index(intake_dir: str = DATA_INTAKE_DIR):
+    import pandas as pd
+    import ngram_index
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        paths = []
+        for filename in sorted(f for f in os.listdir(intake_dir) if f.endswith(".txt")):
+            paths.append(os.path.join(temp_dir, filename))
+            helpers.simplify_text_file(os.path.join(intake_dir, filename), paths[-1])
+        char_count = sum(os.path.getsize(p) for p in paths)
+
+        def dataframe_counts():
+            return [pd.DataFrame(list(helpers.read_text_file(p)))[0].value_counts() for p in paths]
+
+        index_dir = os.path.join(temp_dir, "ngrams")
+        start_time = time.perf_counter()
+        ngram_index.update_index(paths, index_dir)
+        build_seconds = time.perf_counter() - start_time
+
+        print(f"N-gram index, {len(paths)} simplified files, {char_count / 1e6:.1f} MB "
+              f"(index of 1 to 4-grams built in {build_seconds:.2f} seconds):")
+        before = best_time(dataframe_counts, repeats=1)
+        after = best_time(lambda: ngram_index.load_counts(1, index_dir).sum())
+        print(f"{'character counts':<28} before {before * 1000:9.1f} ms   after {after * 1000:9.1f} ms   speedup {before / after:7.1f}x")
+        for n in ngram_index.NGRAM_SIZES[1:]:
+            seconds = best_time(lambda: ngram_index.load_counts(n, index_dir).sum())
+            print(f"{f'{n}-gram counts':<28} loaded in {seconds * 1000:9.1f} ms")
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+# Compare reading scaler values from the JSON format against the binary format, and against the cache
+def bench_scalers(chunk_size: int = 4096, repeats: int = 200):
+    scaler = helpers.fit_scaler(np.random.randint(0, len(encoders.CHARSET), size=(1000, chunk_size), dtype=np.uint8))
+    temp_dir = tempfile.mkdtemp()
+    try:
+        json_path = os.path.join(temp_dir, "scaler.json")
+        npz_path = os.path.join(temp_dir, "scaler.npz")
+        helpers.save_scaler_to_file(scaler, json_path)
+        helpers.save_scaler_to_file(scaler, npz_path)
+
+        print(f"Scalers, chunk size {chunk_size}, {repeats} loads:")
+        before = best_time(lambda: [helpers._read_scaler_file(json_path) for _ in range(repeats)], repeats=1)
+        for (label, func) in [("binary format", lambda: helpers._read_scaler_file(npz_path)),
+                              ("cached", lambda: helpers.load_scaler_from_file(npz_path))]:
+            after = best_time(lambda: [func() for _ in range(repeats)])
+            print(f"{label:<28} before {before * 1000 / repeats:9.3f} ms   after {after * 1000 / repeats:9.3f} ms   speedup {before / after:7.1f}x")
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+# Entry points that shouldn't need TensorFlow (or the database) just to be imported
+LIGHT_MODULES = ["encoders", "helpers", "ngram_index", "feature_store", "crackers", "models", "db_connect", "librarian"]
+
+# Packages that take seconds to import, which the light modules only import inside the functions that use them
+HEAVY_PACKAGES = ["tensorflow", "sklearn"]
+
+# Import a module in a fresh interpreter with python -X importtime.
+# Returns a dictionary of the cumulative import time, in microseconds, of each module imported along the way.
+def get_import_times(module: str) -> dict[str, int]:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, check=True)
+    # Lines look like "import time: self [us] | cumulative | imported package", with nesting shown by indentation
+    times = {}
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if line.startswith("import time:") and len(parts) == 3 and parts[1].strip().isdigit():
+            times[parts[2].strip()] = int(parts[1])
+    return times
+
+# Which of the heavy packages importing a module (in a fresh interpreter) pulls in
+def get_heavy_imports(times: dict[str, int]) -> list[str]:
+    return [package for package in HEAVY_PACKAGES if any(name.split(".")[0] == package for name in times)]
+
+# Import each module in a fresh interpreter, reporting the total import time.
+# Fails if any of them imports TensorFlow or scikit-learn along the way.
+def bench_import_time(modules: list[str] = LIGHT_MODULES):
+    print(f"Import time, each module in a fresh interpreter:")
+    heavy = {}
+    for module in modules:
+        times = get_import_times(module)
+        heavy[module] = get_heavy_imports(times)
+        print(f"{module:<28} {times[module] / 1e6:7.3f} seconds   heavy imports: {', '.join(heavy[module]) or 'none'}")
+
+    heavy = {module: packages for (module, packages) in heavy.items() if len(packages) > 0}
+    if len(heavy) > 0:
+        raise Exception(f"Light modules import heavy packages: {heavy}")
+
+
+# Time each call separately, returning the latencies in milliseconds
+def latencies_ms(func, count: int) -> np.ndarray:
+    times = []
+    for _ in range(count):
+        start_time = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start_time) * 1000)
+    return np.array(times)
+
+def bench_serving(request_count: int = 300, length: int = 300):
+    crackers = load_caesar_crackers({"serving": True}, {"serving": True, "jit_compile": True})
+    ciphertext = make_sample_text(length)
+
+    print(f"Cracker latency, {request_count} single requests of {length} characters:")
+    for (mode, cracker) in zip(["model.predict", "tf.function", "tf.function (XLA)"], crackers):
+        for (label, func) in [("key", cracker.infer_key_with_model), ("text", cracker.infer_text_with_model)]:
+            func(ciphertext)
+            times = latencies_ms(lambda: func(ciphertext), request_count)
+            print(f"{mode + ' ' + label:<28} p50 {np.percentile(times, 50):8.2f} ms   p99 {np.percentile(times, 99):8.2f} ms")
+
+
+
+# Compare inferring keys from every chunk of long ciphertexts against progressive inference, which stops once
+# the keys predicted around the median agree, at a few levels of agreement. How many chunks that takes depends on
+# how much the model's chunk predictions agree, so it varies with the model as well as the agreement asked for.
+def bench_progressive_keys(intake_dir: str = DATA_INTAKE_DIR, length: int = 200_000, agreements: list[float] = [0.5, 0.25, 0.1]):
+    (cracker,) = load_caesar_crackers({"serving": True})[1:]
+
+    filenames = sorted(f for f in os.listdir(intake_dir) if f.endswith(".txt"))
+    texts = [encoders.encode_simple(helpers.read_text_file(os.path.join(intake_dir, f)))[:length] for f in filenames]
+    keys = [encoders.get_key_caesar() for _ in texts]
+    ciphertexts = [encoders.encode_caesar(text, key) for (text, key) in zip(texts, keys)]
+    # The last chunk of each ciphertext overlaps the one before it, to cover the end
+    chunk_size = cracker._get_chunk_size(cracker.key_model)
+    chunk_count = sum(-(-len(c) // chunk_size) for c in ciphertexts)
+
+    print(f"Key inference, {len(ciphertexts)} ciphertexts of up to {length} characters ({chunk_count} chunks), serving mode:")
+    start_time = time.perf_counter()
+    inferred = [cracker.infer_key_with_model(c) for c in ciphertexts]
+    seconds = time.perf_counter() - start_time
+    accuracy = np.mean([a == b for (a, b) in zip(inferred, keys)])
+    print(f"{'every chunk (median)':<28} {seconds:7.2f} s   {chunk_count:8d} chunks   accuracy {accuracy:6.1%}")
+
+    for agreement in agreements:
+        start_time = time.perf_counter()
+        results = [cracker.infer_key_progressive(c, min_agreement=agreement) for c in ciphertexts]
+        seconds = time.perf_counter() - start_time
+        accuracy = np.mean([key == expected for ((key, _), expected) in zip(results, keys)])
+        same = np.mean([key == full_key for ((key, _), full_key) in zip(results, inferred)])
+        print(f"{f'progressive, agreement {agreement}':<28} {seconds:7.2f} s   {sum(used for (_, used) in results):8d} chunks   accuracy {accuracy:6.1%}"
+              f"   same key as every chunk {same:6.1%}")
+
+# Compare predicting with full models against lean ones (see models.make_lean_model()), which only compute the
+# output the crackers use. The bundled models take each chunk as a single step, so there is little to trim from
+# them; this uses untrained models shaped like the ones that take each chunk as a sequence of single values.
+def bench_lean_models(chunk_count: int = 1024, chunk_size: int = 256, units: int = 64, batch_size: int = 32):
+    import tensorflow as tf
+    import models
+    import tf_helpers
+
+    chunks = np.random.default_rng(0).standard_normal((chunk_count, chunk_size, 1)).astype(np.float32)
+
+    print(f"Model predictions, {chunk_count} chunks of {chunk_size} as sequences, LSTM of {units} units, batches of {batch_size}:")
+    for (target, output_size) in [("key", 1), ("text", chunk_size)]:
+        model = tf.keras.models.Sequential([
+            tf.keras.Input(shape=(chunk_size, 1)),
+            tf.keras.layers.LSTM(units, return_sequences=True),
+            tf.keras.layers.Dense(output_size, activation=tf_helpers.modulo_output)])
+        lean = models.make_lean_model(model, target)
+
+        outputs = {}
+        def predict(name, m):
+            outputs[name] = m.predict(chunks, batch_size=batch_size, verbose=0)
+        before = best_time(lambda: predict("full", model), repeats=2)
+        after = best_time(lambda: predict("lean", lean), repeats=2)
+        print(f"{target + ' model':<28} before {before:7.2f} s, {outputs['full'].nbytes / 1e6:8.2f} MB   "
+              f"after {after:7.2f} s, {outputs['lean'].nbytes / 1e6:8.2f} MB   speedup {before / after:5.1f}x")
+
+
+ALL_BENCHMARKS = {
+    "cipher_engine": bench_cipher_engine,
+    "multi_key": bench_multi_key,
+    "simplifier": bench_simplifier,
+    "chunkify": bench_chunkify,
+    "db_writes": bench_db_writes,
+    "db_lookups": bench_db_lookups,
+    "db_connect": bench_db_connect,
+    "feature_store": bench_feature_store,
+    "crackers": bench_crackers,
+    "serving": bench_serving,
+    "lean_models": bench_lean_models,
+    "progressive_keys": bench_progressive_keys,
+    "frequency_cracker": bench_frequency_cracker,
+    "decrypting_cracker": bench_decrypting_cracker,
+    "substitution_cracker": bench_substitution_cracker,
+    "ngram_index": bench_ngram_index,
+    "scalers": bench_scalers,
+    "import_time": bench_import_time,
+}
+
+def main(names: list[str]):
+    for name in names if len(names) > 0 else ALL_BENCHMARKS.keys():
+        if name not in ALL_BENCHMARKS:
+            raise Exception(f"Unknown benchmark {name}; choose from {list(ALL_BENCHMARKS.keys())}")
+        ALL_BENCHMARKS[name]()
+        print()
+
+def self_test():
+    print(f"Light Imports: {all(len(get_heavy_imports(get_import_times(module))) == 0 for module in LIGHT_MODULES)}")
+    print(f"Heavy Imports Found: {get_heavy_imports(get_import_times('sklearn.preprocessing')) == ['sklearn']}")
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ["--self-test"]:
+        self_test()
+    else:
+        main(sys.argv[1:])
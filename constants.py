@@ -11,6 +11,12 @@ DATA_INTAKE_DIR = os.path.join(DATA_DIR, "intake")
 DATA_RAW_DIR = os.path.join(DATA_DIR, "raw")
 DATA_SIMPLIFIED_DIR = os.path.join(DATA_DIR, "simplified")
 DATA_ENCODED_DIR = os.path.join(DATA_DIR, "encoded")
+FEATURE_STORE_DIR = os.path.join(DATA_DIR, "features")
+NGRAM_INDEX_DIR = os.path.join(DATA_DIR, "ngrams")
+QUADGRAM_TABLE_PATH = os.path.join(DATA_DIR, "quadgrams.npy")
+
+# How many characters to handle at a time when streaming text files, rather than reading them whole
+STREAMING_BLOCK_SIZE = 1024 * 1024
 
 # Model (and scaler) directories
 TEMP_MODEL_DIR = "temp_models" # Excluded from source control
@@ -1,8 +1,42 @@
+import os
+import random
+import tempfile
+import time
+import concurrent.futures
+
 import numpy as np
 
 import encoders
 import helpers
-import tf_helpers
+import ngram_index
+
+from constants import *
+
+# How many chunks go through a model at once, by default, when inferring keys or texts
+DEFAULT_BATCH_SIZE = 256
+
+# For progressive key inference (see Caesar_Cracker.infer_key_progressive()): how many chunks are predicted
+# first, and what proportion of the keys predicted so far, around the median, must agree to stop early
+DEFAULT_FIRST_BATCH_CHUNKS = 8
+DEFAULT_MIN_KEY_AGREEMENT = 0.5
+
+# For frequency analysis, how clear a winner the best key must be (see Frequency_Caesar_Cracker)
+# before it is trusted without asking the model
+DEFAULT_MIN_CONFIDENCE = 0.3
+
+# For validating decryptions (see Decrypting_Caesar_Cracker): texts that fit the corpus character frequencies
+# worse than this, in chi-squared per character, are taken to be wrong. On 256 character pieces of held-out
+# texts, about 97% of correct decryptions score under 3, and decryptions with a wrong key score over 3.
+# Raising it lets decryptions with a key one away from the right one through.
+DEFAULT_MAX_TEXT_FIT = 3.0
+
+# Quadgrams never seen in the corpus are scored as if they had been seen this many times
+QUADGRAM_FLOOR_COUNT = 0.01
+
+# Substitution key search settings: how many independent restarts, and how many swaps in a row
+# can fail to improve a key before a restart gives up
+SUBST_RESTARTS = 8
+SUBST_MAX_STALE_SWAPS = 3000
 
 # This class wraps up use of a model to try to predict keys or plaintext.
 # I wrote it with the Caesar Cipher in mind, but I'm not sure the code is really much
@@ -10,52 +44,550 @@ import tf_helpers
 #
 # The dimension for the "best guess" seems to be different between the two,
 # which is strange.
+#
+# With serving=True, each model is wrapped in a compiled tf.function (optionally XLA compiled, with
+# jit_compile=True) that takes the unscaled chunks and does the scaling itself. This skips the
+# per-call overhead of model.predict(), which dominates the time for short ciphertexts.
 class Caesar_Cracker(object):
-    def __init__(self, scaler, key_model, text_model, verbose = 0):
+    def __init__(self, scaler, key_model, text_model, verbose = 0, serving: bool = False, jit_compile: bool = False):
         self.scaler = scaler
         self.key_model = key_model
         self.text_model = text_model
         self.verbose = verbose
 
         if (key_model is not None) and (text_model is not None):
-            if key_model.input_shape[2] != text_model.input_shape[2]:
-                raise Exception("Model inputs (chunk size) do not match: {key_model.input_shape[2]} != {text_model.input_shape[2]}")
+            if self._get_chunk_size(key_model) != self._get_chunk_size(text_model):
+                raise Exception(f"Model inputs (chunk size) do not match: {key_model.input_shape} != {text_model.input_shape}")
+
+        self.key_function = None
+        self.text_function = None
+        if serving:
+            if key_model is not None:
+                self.key_function = self._make_serving_function(key_model, jit_compile)
+            if text_model is not None:
+                self.text_function = self._make_serving_function(text_model, jit_compile)
+
+    # Models take each chunk either as a sequence of single values, shape (chunk size, 1), or as a single
+    # step holding the whole chunk, shape (1, chunk size). Either way, the chunk size is the product.
+    @staticmethod
+    def _get_chunk_size(model) -> int:
+        return int(np.prod(model.input_shape[1:]))
+
+    # Wrap a model in a tf.function taking a batch of unscaled (uint8) chunks, with the scaler folded
+    # into the graph. The input signature is fixed apart from the batch size, so the function is
+    # traced once, by the warm-up call here, rather than on the first real request.
+    def _make_serving_function(self, model, jit_compile: bool):
+        # Only imported here, so crackers that never build a serving function don't wait for TensorFlow to load
+        import tensorflow as tf
+
+        input_shape = tuple(model.input_shape[1:])
+        mean = tf.constant(np.reshape(self.scaler.mean_, input_shape), dtype=tf.float32)
+        scale = tf.constant(np.reshape(self.scaler.scale_, input_shape), dtype=tf.float32)
+
+        @tf.function(input_signature=[tf.TensorSpec((None,) + input_shape, tf.uint8)], jit_compile=jit_compile)
+        def serve(chunks):
+            scaled = (tf.cast(chunks, tf.float32) - mean) / scale
+            return model(scaled, training=False)
+
+        serve(tf.zeros((1,) + input_shape, dtype=tf.uint8))
+        return serve
+
+    # Run a model over the chunks of several ciphertexts in one go.
+    # All the chunks are scaled and predicted together, batch_size at a time, and the predictions
+    # are split back up, returning one array of predictions (one per chunk) for each ciphertext.
+    # If there is a serving function for the model, it is called directly instead of model.predict().
+    def _predict_chunks(self, model, serving_function, ciphertexts: list[str], batch_size: int) -> list[np.ndarray]:
+        if len(ciphertexts) == 0:
+            return []
+
+        chunk_size = self._get_chunk_size(model)
+        chunk_arrays = [helpers.chunkify(encoders.string_to_offset_array(c), chunk_size, dtype=np.uint8) for c in ciphertexts]
+        chunk_counts = [len(chunks) for chunks in chunk_arrays]
+        predictions = self._predict_chunk_array(model, serving_function, np.concatenate(chunk_arrays), batch_size)
+        return np.split(predictions, np.cumsum(chunk_counts)[:-1])
+
+    # Run a model over an array of unscaled (uint8) chunks, one per row, batch_size at a time
+    def _predict_chunk_array(self, model, serving_function, chunks: np.ndarray, batch_size: int) -> np.ndarray:
+        input_shape = (-1,) + tuple(model.input_shape[1:])
+
+        if serving_function is not None:
+            shaped_chunks = chunks.reshape(input_shape)
+            return np.concatenate([serving_function(shaped_chunks[start : start + batch_size]).numpy()
+                                   for start in range(0, len(shaped_chunks), batch_size)])
+
+        scaled_chunks = helpers.scale_features(self.scaler, chunks)
+        return model.predict(scaled_chunks.reshape(input_shape), batch_size=batch_size, verbose=self.verbose)
+
+    def infer_texts_batch(self, ciphertexts: list[str], batch_size: int = DEFAULT_BATCH_SIZE) -> list[str]:
+        chunk_size = self._get_chunk_size(self.text_model)
+        results = []
+        for guesses in self._predict_chunks(self.text_model, self.text_function, ciphertexts, batch_size):
+            # Shape of prediction:
+            # (feature index, chunk size, chunk size)
+            # ... so that's a little confusing. The best text guesses seem to be along
+            # the 3rd dimension, and I don't know why. Models taking the chunk as a single
+            # step put out (feature index, 1, chunk size) instead, with the guesses along the 3rd.
+            # Lean text models (see models.make_lean_model()) put out only the guesses used here,
+            # shaped (feature index, chunk size, 1) or (feature index, 1, chunk size).
+            if guesses.shape[1] == chunk_size:
+                best_guesses = guesses[:, :, -1]
+            else:
+                best_guesses = guesses[:, -1, :]
+
+            # Now we have floating point offsets. We want integer offsets, then strings:
+            flat = best_guesses.flatten()
+            int_offsets = flat.round().astype(int)
+            results.append(encoders.offsets_to_string(int_offsets))
+
+        return results
+
+    # Turn a key predicted by the model into a usable key: rounded, then wrapped around the character set the way
+    # decode_caesar_batch() wraps keys. So 63 becomes 1, and a prediction that rounds to 0 (or len(CHARSET)) becomes
+    # 0, which decode_caesar_batch() leaves undecrypted.
+    @staticmethod
+    def _round_key(value: float) -> int:
+        return int(np.rint(value)) % len(encoders.CHARSET)
+
+    def infer_keys_batch(self, ciphertexts: list[str], batch_size: int = DEFAULT_BATCH_SIZE) -> list[int]:
+        results = []
+        for keys in self._predict_chunks(self.key_model, self.key_function, ciphertexts, batch_size):
+            # Shape of keys:
+            # (feature index, chunk size, 1), or (feature index, 1, 1) for lean models
 
+            # The model puts out a key for every iteration through the data, and (on average)
+            # gets more accurate every time, so the best key is the last one:
+            best_keys = keys[:, -1, :]
+
+            # We have the best key from each chunk, so pick the middle one:
+            key = np.median(best_keys)
+            results.append(self._round_key(key))
+
+        return results
+
+    # Infer a key from as few chunks as it takes, so long ciphertexts with a clear answer don't have every chunk
+    # predicted. Chunks are predicted in batches that grow from first_batch chunks, doubling up to batch_size.
+    # The key is the median of the keys predicted from each chunk, just as infer_keys_batch() picks it. Once the
+    # middle min_agreement of the keys predicted so far (which always includes the median) all round to the same
+    # key, the rest of the ciphertext is skipped. If that never happens, every chunk is predicted, and the result is
+    # the same as infer_keys_batch()'s.
+    # Returns a tuple: (key, chunks_used)
+    def infer_key_progressive(self, ciphertext: str, min_agreement: float = DEFAULT_MIN_KEY_AGREEMENT,
+                              first_batch: int = DEFAULT_FIRST_BATCH_CHUNKS, batch_size: int = DEFAULT_BATCH_SIZE) -> tuple[int, int]:
+        # The chunks stay a view of the offsets; only the batches that get predicted are copied
+        (chunks, tail) = helpers.chunkify_view(encoders.string_to_offset_array(ciphertext), self._get_chunk_size(self.key_model), dtype=np.uint8)
+        predicted = np.empty(0, dtype=np.float32)
+        step = first_batch
+
+        while len(predicted) < len(chunks) + len(tail):
+            (start, stop) = (len(predicted), len(predicted) + step)
+            batch = chunks[start : stop] if stop <= len(chunks) else np.concatenate((chunks[start : stop], tail))
+            keys = self._predict_chunk_array(self.key_model, self.key_function, batch, batch_size)
+            predicted = np.concatenate([predicted, keys[:, -1, :].ravel()])
+
+            ordered = np.sort(predicted)
+            outside = int(len(ordered) * (1 - min_agreement) / 2)
+            if np.rint(ordered[outside]) == np.rint(ordered[-1 - outside]):
+                break
+            step = min(step * 2, batch_size)
+
+        return (self._round_key(np.median(predicted)), len(predicted))
 
     def infer_text_with_model(self, ciphertext: str) -> str:
-        chunk_size = self.text_model.input_shape[2]
-        offsets = encoders.string_to_offsets(ciphertext)
-        chunks = helpers.chunkify(offsets, chunk_size)
-        scaled_chunks = self.scaler.transform(chunks)
-        shaped_chunks = tf_helpers.reshape_input_for_RNN(np.array(scaled_chunks), chunk_size)
-        guesses = self.text_model.predict(shaped_chunks, verbose=self.verbose)
-        # Shape of prediction:
-        # (feature index, chunk size, chunk size)
-        # ... so that's a little confusing. The best text guesses seem to be along
-        # the 3rd dimension, and I don't know why:
-        best_guesses = guesses[:, :, chunk_size-1]
-
-        # Now we have floating point offsets. We want integer offsets, then strings:
-        flat = best_guesses.flatten()        
-        int_offsets = flat.round().astype(int)
-        result = encoders.offsets_to_string(int_offsets)
-
-        return result
+        return self.infer_texts_batch([ciphertext])[0]
 
     def infer_key_with_model(self, ciphertext: str) -> int:
-        chunk_size = self.key_model.input_shape[2]
-        offsets = encoders.string_to_offsets(ciphertext)
-        chunks = helpers.chunkify(offsets, chunk_size)
-        scaled_chunks = self.scaler.transform(chunks)
-        shaped_chunks = tf_helpers.reshape_input_for_RNN(np.array(scaled_chunks), chunk_size)
-        keys = self.key_model.predict(shaped_chunks, verbose=self.verbose)
-        # Shape of keys:
-        # (feature index, chunk size, 1)
-
-        # The model puts out a key for every iteration through the data, and (on average)
-        # gets more accurate every time, so the best key is the last one:
-        best_keys = keys[:, chunk_size-1, :]
-
-        # We have the best key from each chunk, so pick the middle one:
-        key = np.median(best_keys)
-        return int(round(key))
\ No newline at end of file
+        return self.infer_keys_batch([ciphertext])[0]
+
+
+# Character frequencies across the simplified texts, as proportions in CHARSET order.
+# By default they come from the n-gram index; otherwise the given files are read. Each count gets
+# 1 added, so no character is ever completely unexpected.
+def get_character_frequencies(paths: list[str] = None) -> np.ndarray:
+    counts = ngram_index.load_counts(1) if paths is None else ngram_index.count_text_files(paths, 1)
+    counts = counts + 1
+    return counts / counts.sum()
+
+# Count the characters of each text, returning a (text count, len(CHARSET)) array.
+# All the texts are counted with a single bincount.
+def count_characters_batch(texts: list[str]) -> np.ndarray:
+    offsets = encoders.string_to_offset_array("".join(texts)).astype(np.int64)
+    text_indexes = np.repeat(np.arange(len(texts)), [len(t) for t in texts])
+    counts = np.bincount(text_indexes * 256 + offsets, minlength=len(texts) * 256)
+    return counts.reshape((len(texts), 256))[:, :len(encoders.CHARSET)]
+
+# Decrypt each ciphertext with its key. Models can guess keys outside the valid range, so they are
+# wrapped around; a key of 0 changes nothing.
+def decode_caesar_batch(ciphertexts: list[str], keys: list[int]) -> list[str]:
+    keys = [key % len(encoders.CHARSET) for key in keys]
+    return [encoders.decode_caesar(c, key) if key != 0 else c for (c, key) in zip(ciphertexts, keys)]
+
+# How well each text's character counts fit the given frequencies: chi-squared divided by the text's length,
+# so texts of different lengths can be compared. Lower is better. Texts with no characters from the set score 0.
+def get_text_fit_batch(texts: list[str], frequencies: np.ndarray) -> np.ndarray:
+    counts = count_characters_batch(texts).astype(float)
+    lengths = np.maximum(counts.sum(axis=1), 1)
+    return ((counts ** 2) @ (1.0 / np.asarray(frequencies, dtype=float)) / lengths - lengths) / lengths
+
+# Cracks the Caesar Cipher by classical frequency analysis: every possible key is tried, and the
+# one whose decrypted character counts best fit the corpus frequencies (lowest chi-squared) wins.
+#
+# The confidence of a guess is how much better the best key scored than the runner-up, from 0 (a tie)
+# to 1. If a model-based Caesar_Cracker is given as the fallback, this works as a hybrid, asking the
+# model about any ciphertext where confidence is below min_confidence. The model needs at least one
+# chunk of text, so shorter ciphertexts always keep the frequency analysis guess.
+class Frequency_Caesar_Cracker(object):
+    def __init__(self, frequencies: np.ndarray, fallback: Caesar_Cracker = None, min_confidence: float = DEFAULT_MIN_CONFIDENCE):
+        self.frequencies = np.asarray(frequencies, dtype=float)
+        self.fallback = fallback
+        self.min_confidence = min_confidence
+
+        if len(self.frequencies) != len(encoders.CHARSET):
+            raise Exception(f"Expected {len(encoders.CHARSET)} character frequencies, not {len(self.frequencies)}")
+
+        # Chi-squared for key k is the sum over plaintext offsets p of (observed - expected)^2 / expected,
+        # where observed is the ciphertext count at (p + k) and expected is the text length times
+        # frequencies[p]. That works out to (counts^2 @ weights) / length - length, with these weights:
+        charset_len = len(encoders.CHARSET)
+        plain_offsets = (np.arange(charset_len)[:, None] - np.arange(charset_len)[None, :]) % charset_len
+        self.weights = 1.0 / self.frequencies[plain_offsets]
+
+    # Score every key for each ciphertext, returning (keys, confidences), one of each per ciphertext
+    def score_keys_batch(self, ciphertexts: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        counts = count_characters_batch(ciphertexts).astype(float)
+        lengths = np.maximum(counts.sum(axis=1, keepdims=True), 1)
+        chi_squared = (counts ** 2) @ self.weights / lengths - lengths
+
+        # Key 0 isn't a valid Caesar key
+        chi_squared[:, 0] = np.inf
+        keys = chi_squared.argmin(axis=1)
+
+        # Texts with no characters from the set tie on every key, so get no confidence at all
+        (best, runner_up) = np.sort(chi_squared, axis=1)[:, :2].T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            confidences = np.where(runner_up > 0, 1 - best / runner_up, 0.0)
+        return (keys, confidences)
+
+    def infer_keys_batch(self, ciphertexts: list[str], batch_size: int = DEFAULT_BATCH_SIZE) -> list[int]:
+        (keys, confidences) = self.score_keys_batch(ciphertexts)
+        results = keys.tolist()
+
+        if self.fallback is not None:
+            chunk_size = self.fallback._get_chunk_size(self.fallback.key_model)
+            unsure = [i for (i, c) in enumerate(ciphertexts) if confidences[i] < self.min_confidence and len(c) >= chunk_size]
+            fallback_keys = self.fallback.infer_keys_batch([ciphertexts[i] for i in unsure], batch_size)
+            for (i, key) in zip(unsure, fallback_keys):
+                results[i] = key
+
+        return results
+
+    def infer_texts_batch(self, ciphertexts: list[str], batch_size: int = DEFAULT_BATCH_SIZE) -> list[str]:
+        return decode_caesar_batch(ciphertexts, self.infer_keys_batch(ciphertexts, batch_size))
+
+    def infer_key(self, ciphertext: str) -> int:
+        return self.infer_keys_batch([ciphertext])[0]
+
+    def infer_text(self, ciphertext: str) -> str:
+        return self.infer_texts_batch([ciphertext])[0]
+
+
+# Recovers Caesar plaintexts by inferring each key, then decrypting with the cipher engine, which is exact and
+# far cheaper than predicting the text with a model. Keys come from key_cracker: a Frequency_Caesar_Cracker
+# (optionally a hybrid) or a model-based Caesar_Cracker.
+#
+# Each decryption is checked against the corpus character frequencies (see get_text_fit_batch()). Any that fit
+# worse than max_fit are handed to text_cracker, a Caesar_Cracker with a text model, if there is one; otherwise
+# the decryption is kept. The text model needs at least one chunk of text, so shorter ciphertexts always keep
+# their decryption. fallback_count counts the ciphertexts handed to the text model so far.
+class Decrypting_Caesar_Cracker(object):
+    def __init__(self, key_cracker, frequencies: np.ndarray, text_cracker: Caesar_Cracker = None, max_fit: float = DEFAULT_MAX_TEXT_FIT):
+        self.key_cracker = key_cracker
+        self.frequencies = np.asarray(frequencies, dtype=float)
+        self.text_cracker = text_cracker
+        self.max_fit = max_fit
+        self.fallback_count = 0
+
+        if len(self.frequencies) != len(encoders.CHARSET):
+            raise Exception(f"Expected {len(encoders.CHARSET)} character frequencies, not {len(self.frequencies)}")
+
+    def infer_texts_batch(self, ciphertexts: list[str], batch_size: int = DEFAULT_BATCH_SIZE) -> list[str]:
+        results = decode_caesar_batch(ciphertexts, self.key_cracker.infer_keys_batch(ciphertexts, batch_size))
+
+        if self.text_cracker is not None:
+            chunk_size = self.text_cracker._get_chunk_size(self.text_cracker.text_model)
+            fits = get_text_fit_batch(results, self.frequencies)
+            failed = [i for (i, c) in enumerate(ciphertexts) if fits[i] > self.max_fit and len(c) >= chunk_size]
+            fallback_texts = self.text_cracker.infer_texts_batch([ciphertexts[i] for i in failed], batch_size)
+            for (i, text) in zip(failed, fallback_texts):
+                results[i] = text
+            self.fallback_count += len(failed)
+
+        return results
+
+    def infer_text(self, ciphertext: str) -> str:
+        return self.infer_texts_batch([ciphertext])[0]
+
+
+_QUADGRAM_PLACES = ngram_index.ngram_places(4)
+
+# Turn quadgram counts into a dense (len(CHARSET),)*4 float32 table of log10 probabilities
+def build_quadgram_table(counts: np.ndarray) -> np.ndarray:
+    total = max(counts.sum(), 1)
+    table = np.log10(np.maximum(counts, QUADGRAM_FLOOR_COUNT) / total).astype(np.float32)
+    return table.reshape((len(encoders.CHARSET),) * 4)
+
+# Load the quadgram table, building it (and saving it) first if needed. By default it is built from the
+# n-gram index, and rebuilt whenever the index has changed since; otherwise the given files are read.
+# The saved table is memory-mapped, so loading takes next to no time.
+def get_quadgram_table(path: str = QUADGRAM_TABLE_PATH, paths: list[str] = None, rebuild: bool = False) -> np.ndarray:
+    manifest_path = os.path.join(NGRAM_INDEX_DIR, ngram_index.MANIFEST_FILENAME)
+    if paths is None and os.path.exists(path) and os.path.exists(manifest_path):
+        rebuild = rebuild or os.path.getmtime(manifest_path) > os.path.getmtime(path)
+
+    if rebuild or not os.path.exists(path):
+        counts = ngram_index.load_counts(4) if paths is None else ngram_index.count_text_files(paths, 4)
+        table = build_quadgram_table(counts)
+        temp_path = path + ".tmp.npy"
+        np.save(temp_path, table)
+        os.replace(temp_path, path)
+
+    return np.load(path, mmap_mode='r')
+
+# A ciphertext prepared for key search: each distinct quadgram once, with how often it occurs, and
+# where every cipher character appears in them. places[c, q] is the sum of the place values
+# (len(CHARSET)**3 for the first position, down to 1 for the last) where character c appears in quadgram q,
+# so changing what c decrypts to by some amount changes q's table index by that amount times places[c, q].
+# The nonzero entries of places are also kept as flat lists, for going through them all at once.
+class _Quadgram_Text(object):
+    def __init__(self, ciphertext: str):
+        charset_len = len(encoders.CHARSET)
+        (indexes, weights) = np.unique(ngram_index.ngram_indexes(encoders.string_to_offset_array(ciphertext), 4), return_counts=True)
+        self.weights = weights.astype(np.float32)
+        self.quadgrams = (indexes[:, None] // _QUADGRAM_PLACES) % charset_len
+
+        self.places = np.zeros((charset_len, len(indexes)), dtype=np.int64)
+        for column in range(4):
+            np.add.at(self.places, (self.quadgrams[:, column], np.arange(len(indexes))), _QUADGRAM_PLACES[column])
+        self.quadgrams_with = [np.flatnonzero(row) for row in self.places]
+        self.letters = [c for c in range(charset_len) if len(self.quadgrams_with[c]) > 0]
+        (self.entry_letters, self.entry_quadgrams) = np.nonzero(self.places)
+        self.entry_places = self.places[self.entry_letters, self.entry_quadgrams]
+
+    # Table index of every quadgram, decrypted with a mapping (cipher offset -> plain offset)
+    def table_indexes(self, mapping: np.ndarray) -> np.ndarray:
+        return mapping[self.quadgrams] @ _QUADGRAM_PLACES
+
+    # Score of the plaintext that a mapping gives
+    def score(self, flat_table: np.ndarray, mapping: np.ndarray) -> float:
+        return float(self.weights @ flat_table[self.table_indexes(mapping)])
+
+    # How much the score would change by swapping what cipher offset a decrypts to with each other
+    # cipher offset b, given the current table indexes and values of every quadgram.
+    # Only the quadgrams containing a or b can change, so only those get rescored: the ones containing
+    # a in one pass, for every b at once, and the ones containing b but not a in another.
+    def swap_deltas(self, flat_table: np.ndarray, mapping: np.ndarray, indexes: np.ndarray, values: np.ndarray, a: int) -> np.ndarray:
+        with_a = self.quadgrams_with[a]
+        shifts = (mapping - mapping[a])[:, None] * (self.places[a, with_a] - self.places[:, with_a])
+        deltas = (flat_table[indexes[with_a] + shifts] - values[with_a]) @ self.weights[with_a]
+
+        without_a = self.places[a, self.entry_quadgrams] == 0
+        letters = self.entry_letters[without_a]
+        quadgrams = self.entry_quadgrams[without_a]
+        shifts = (mapping[a] - mapping[letters]) * self.entry_places[without_a]
+        changes = (flat_table[indexes[quadgrams] + shifts] - values[quadgrams]) * self.weights[quadgrams]
+        return deltas + np.bincount(letters, weights=changes, minlength=len(mapping))
+
+# One restart of the key search: start from a random mapping, then repeatedly pick a character
+# in the ciphertext, score swapping it with every other character, and make the best swap if it
+# improves the score. With a temperature above 0 (simulated annealing), a random worse swap is
+# sometimes made instead, with the temperature multiplied by cooling after each step. The search
+# stops after max_stale keys in a row fail to beat the best so far.
+# Returns (best score, best mapping, number of keys evaluated).
+def _search_mapping(flat_table: np.ndarray, text: _Quadgram_Text, seed: int, max_stale: int,
+                    temperature: float, cooling: float) -> tuple[float, np.ndarray, int]:
+    rng = random.Random(seed)
+    charset_len = len(encoders.CHARSET)
+    mapping = np.array(rng.sample(range(charset_len), charset_len))
+    if len(text.letters) == 0:
+        return (0.0, mapping, 0)
+
+    indexes = text.table_indexes(mapping)
+    values = flat_table[indexes]
+    score = float(text.weights @ values)
+    (best_score, best_mapping) = (score, mapping.copy())
+    stale = 0
+    evaluated = 0
+    while stale < max_stale:
+        a = rng.choice(text.letters)
+        deltas = text.swap_deltas(flat_table, mapping, indexes, values, a)
+        deltas[a] = -np.inf
+        evaluated += charset_len - 1
+
+        b = int(deltas.argmax())
+        if deltas[b] <= 0 and temperature > 0:
+            b = rng.randrange(charset_len - 1)
+            b += b >= a
+            if rng.random() >= np.exp(deltas[b] / temperature):
+                b = None
+        elif deltas[b] <= 0:
+            b = None
+        temperature *= cooling
+
+        if b is not None:
+            mapping[a], mapping[b] = mapping[b], mapping[a]
+            score += float(deltas[b])
+            changed = np.union1d(text.quadgrams_with[a], text.quadgrams_with[b])
+            indexes[changed] = mapping[text.quadgrams[changed]] @ _QUADGRAM_PLACES
+            values[changed] = flat_table[indexes[changed]]
+
+        if score > best_score + 1e-3:
+            (best_score, best_mapping) = (score, mapping.copy())
+            stale = 0
+        else:
+            stale += charset_len - 1
+
+    return (best_score, best_mapping, evaluated)
+
+# Process pool workers each load the (memory-mapped) quadgram table once
+_worker_tables = {}
+
+def _search_mapping_in_worker(table_path: str, ciphertext: str, seed: int, max_stale: int,
+                              temperature: float, cooling: float) -> tuple[float, np.ndarray, int]:
+    if table_path not in _worker_tables:
+        _worker_tables[table_path] = np.load(table_path, mmap_mode='r').reshape(-1)
+    return _search_mapping(_worker_tables[table_path], _Quadgram_Text(ciphertext), seed, max_stale, temperature, cooling)
+
+# Cracks the substitution cipher by key search: hill climbing (or simulated annealing, with a starting
+# temperature above 0) over character swaps, scored by how English-like the quadgrams of the decrypted
+# text are. Each of several restarts starts from a random key, and the best result wins. With more than
+# one worker, the restarts run in a process pool, and each worker memory-maps the table from table_path.
+# A table passed in directly is saved to a temporary file for the workers, for the length of each search.
+#
+# After each search, keys_evaluated and search_seconds describe the work done.
+class Substitution_Cracker(object):
+    def __init__(self, table: np.ndarray = None, table_path: str = QUADGRAM_TABLE_PATH, restarts: int = SUBST_RESTARTS,
+                 workers: int = 1, max_stale: int = SUBST_MAX_STALE_SWAPS, temperature: float = 0.0, cooling: float = 0.999):
+        self.table_path = table_path if table is None else None
+        self.table = get_quadgram_table(table_path) if table is None else table
+        self.flat_table = self.table.reshape(-1)
+        self.restarts = restarts
+        self.workers = workers
+        self.max_stale = max_stale
+        self.temperature = temperature
+        self.cooling = cooling
+
+        self.keys_evaluated = 0
+        self.search_seconds = 0.0
+
+    def keys_per_second(self) -> float:
+        return self.keys_evaluated / max(self.search_seconds, 1e-9)
+
+    # Returns a key in the form used by encoders.decode_substitution()
+    def infer_key(self, ciphertext: str, seed: int = None) -> str:
+        seeds = [random.Random(seed).getrandbits(32) + i for i in range(self.restarts)]
+        start_time = time.perf_counter()
+
+        if self.workers <= 1:
+            text = _Quadgram_Text(ciphertext)
+            results = [_search_mapping(self.flat_table, text, s, self.max_stale, self.temperature, self.cooling) for s in seeds]
+        else:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                table_path = self.table_path
+                if table_path is None:
+                    table_path = os.path.join(temp_dir, "quadgrams.npy")
+                    np.save(table_path, self.table)
+
+                with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+                    results = list(executor.map(_search_mapping_in_worker, [table_path] * len(seeds), [ciphertext] * len(seeds),
+                                                seeds, [self.max_stale] * len(seeds), [self.temperature] * len(seeds),
+                                                [self.cooling] * len(seeds)))
+
+        self.search_seconds = time.perf_counter() - start_time
+        self.keys_evaluated = sum(evaluated for (_, _, evaluated) in results)
+        (_, mapping, _) = max(results, key=lambda result: result[0])
+
+        # The mapping takes cipher offsets to plain offsets, but the key lists the cipher character for each plain one
+        return "".join(encoders.CHARSET[c] for c in np.argsort(mapping))
+
+    def infer_text(self, ciphertext: str, seed: int = None) -> str:
+        return encoders.decode_substitution(ciphertext, self.infer_key(ciphertext, seed))
+
+
+def self_test():
+    text = "THE QUICK BROWN FOX JUMPS OVER THE LAZY DOG. " * 20
+    frequencies = (count_characters_batch([text])[0] + 1) / (len(text) + len(encoders.CHARSET))
+
+    cracker = Frequency_Caesar_Cracker(frequencies)
+    ciphertexts = [encoders.encode_caesar(text, key) for key in [1, 17, len(encoders.CHARSET) - 1]]
+    print(f"Frequency Caesar Keys: {cracker.infer_keys_batch(ciphertexts) == [1, 17, len(encoders.CHARSET) - 1]}")
+    print(f"Frequency Caesar Texts: {cracker.infer_texts_batch(ciphertexts) == [text] * 3}")
+    print(f"Frequency Caesar Empty: {cracker.infer_keys_batch([]) == []}")
+
+    # Decrypting with the inferred key recovers the text exactly, and it fits the frequencies far better than a wrong key
+    decrypting = Decrypting_Caesar_Cracker(cracker, frequencies)
+    print(f"Decrypting Caesar Texts: {decrypting.infer_texts_batch(ciphertexts) == [text] * 3}")
+    fits = get_text_fit_batch([text, encoders.encode_caesar(text, 1)], frequencies)
+    print(f"Decrypting Caesar Fit: {fits[0] < DEFAULT_MAX_TEXT_FIT < fits[1]}")
+
+    # Scoring every swap incrementally should match rescoring the whole text after each swap
+    flat_table = np.random.default_rng(0).random(len(encoders.CHARSET) ** 4, dtype=np.float32)
+    quadgram_text = _Quadgram_Text(encoders.encode_substitution(text, encoders.get_key_substitution()))
+    mapping = np.random.permutation(len(encoders.CHARSET))
+    indexes = quadgram_text.table_indexes(mapping)
+    score = quadgram_text.score(flat_table, mapping)
+    deltas_match = True
+    for a in quadgram_text.letters:
+        deltas = quadgram_text.swap_deltas(flat_table, mapping, indexes, flat_table[indexes], a)
+        for b in range(len(encoders.CHARSET)):
+            swapped = mapping.copy()
+            swapped[a], swapped[b] = swapped[b], swapped[a]
+            deltas_match &= bool(abs(score + deltas[b] - quadgram_text.score(flat_table, swapped)) < 1e-3)
+    print(f"Substitution Swap Deltas: {deltas_match}")
+
+    # With a table built from a book, the search should crack a passage from it
+    book = encoders.encode_simple(helpers.read_text_file(os.path.join(DATA_INTAKE_DIR, sorted(os.listdir(DATA_INTAKE_DIR))[0])))
+    table = build_quadgram_table(np.bincount(ngram_index.ngram_indexes(encoders.string_to_offset_array(book), 4), minlength=len(encoders.CHARSET) ** 4))
+    passage = book[len(book) // 2 : len(book) // 2 + 1000]
+    random.seed(0)
+    ciphertext = encoders.encode_substitution(passage, encoders.get_key_substitution())
+    decrypted = Substitution_Cracker(table).infer_text(ciphertext, seed=0)
+    print(f"Substitution Cracker: {np.mean([a == b for (a, b) in zip(decrypted, passage)]) > 0.9}")
+
+    # Workers should search with the table passed in, not the one saved at table_path
+    parallel = Substitution_Cracker(table, restarts=2, workers=2).infer_text(ciphertext, seed=0)
+    print(f"Substitution Cracker Workers: {parallel == Substitution_Cracker(table, restarts=2).infer_text(ciphertext, seed=0)}")
+
+    # Progressive key inference should pick the same key as inferring from every chunk of a long ciphertext
+    import models
+    key_model = models.load_model(models.CAESAR_KEY_MODEL_PATH)
+    chunk_size = Caesar_Cracker._get_chunk_size(key_model)
+    scaler = helpers.load_scaler_from_file(helpers.get_recommended_scaler_path(encoders.ENCODER_CAESAR, chunk_size, temp=False))
+    model_cracker = Caesar_Cracker(scaler, key_model, None)
+    long_ciphertexts = [encoders.encode_caesar(book[start : start + chunk_size * 200 + 100], 17) for start in range(0, chunk_size * 2000, chunk_size * 200)]
+    progressive = [model_cracker.infer_key_progressive(c) for c in long_ciphertexts]
+    print(f"Progressive Caesar Keys: {[key for (key, _) in progressive] == model_cracker.infer_keys_batch(long_ciphertexts)}")
+
+    # The serving functions, with and without XLA, should give the same keys and texts as model.predict()
+    text_model = models.load_model(models.CAESAR_TEXT_MODEL_PATH)
+    short_ciphertexts = [encoders.encode_caesar(book[start : start + chunk_size * 3 + 50], key) for (start, key) in [(0, 1), (5000, 17), (9000, 40)]]
+    plain_cracker = Caesar_Cracker(scaler, key_model, text_model)
+    chunks = helpers.chunkify(encoders.string_to_offset_array(short_ciphertexts[0]), chunk_size, dtype=np.uint8)
+    for jit_compile in [False, True]:
+        serving_cracker = Caesar_Cracker(scaler, key_model, text_model, serving=True, jit_compile=jit_compile)
+        same_predictions = all(np.allclose(plain_cracker._predict_chunk_array(model, None, chunks, DEFAULT_BATCH_SIZE),
+                                           serving_cracker._predict_chunk_array(model, function, chunks, DEFAULT_BATCH_SIZE), atol=1e-4)
+                               for (model, function) in [(key_model, serving_cracker.key_function), (text_model, serving_cracker.text_function)])
+        same_keys = serving_cracker.infer_keys_batch(short_ciphertexts) == plain_cracker.infer_keys_batch(short_ciphertexts)
+        same_texts = serving_cracker.infer_texts_batch(short_ciphertexts) == plain_cracker.infer_texts_batch(short_ciphertexts)
+        print(f"Serving Caesar Cracker{' (XLA)' if jit_compile else ''}: {same_predictions and same_keys and same_texts}")
+
+    # A model whose chunk predictions all agree needs only the first batch, and its keys wrap around like decode_caesar_batch()'s
+    import tensorflow as tf
+    def constant_key_model(value):
+        return tf.keras.Sequential([tf.keras.Input(key_model.input_shape[1:]), tf.keras.layers.Flatten(),
+                                    tf.keras.layers.Dense(1, kernel_initializer="zeros", bias_initializer=tf.keras.initializers.Constant(value)),
+                                    tf.keras.layers.Reshape((1, 1))])
+    keys_used = [Caesar_Cracker(scaler, constant_key_model(value), None).infer_key_progressive(long_ciphertexts[0]) for value in [17.2, 0.3, 70]]
+    print(f"Progressive Caesar Early Stop: {keys_used == [(17, DEFAULT_FIRST_BATCH_CHUNKS), (0, DEFAULT_FIRST_BATCH_CHUNKS), (70 - len(encoders.CHARSET), DEFAULT_FIRST_BATCH_CHUNKS)]}")
+
+if __name__ == '__main__':
+    self_test()
@@ -1,35 +1,195 @@
 import sqlalchemy
 import sqlalchemy.orm
-import sqlalchemy.ext.automap
+from sqlalchemy.orm import Mapped, mapped_column
 import pathlib
 import random
+import collections
 import numpy as np
+from typing import TYPE_CHECKING
 
-import credentials
 import encoders
 import helpers
 
+# Only needed for type hints, so this file can be imported (e.g. by benchmarks) without a credentials file
+if TYPE_CHECKING:
+    import credentials
+
+# Maximum number of keys held in each of the DB key caches. Caesar keys are few, but every
+# substitution key is different, so the key table can grow large.
+KEY_CACHE_SIZE = 100_000
+
+# A key row as held in the key caches: plain values rather than ORM objects, so entries
+# don't depend on the session they were loaded in.
+CachedKey = collections.namedtuple("CachedKey", ["id", "key_type_id", "value"])
+
+# Simple in-process lookup cache with hit/miss counters.
+# If max_size is given, the least recently used entries are dropped once the cache is full.
+class LookupCache(object):
+    def __init__(self, max_size: int = None):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Returns the cached value for the key, or default if it isn't cached
+    def get(self, key, default=None):
+        if key not in self.entries:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        if self.max_size is not None:
+            self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        if self.max_size is not None:
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def get_stats(self) -> dict:
+        return {"size": len(self.entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+# Default connection pool settings. Each DB keeps up to POOL_SIZE connections open (plus up to
+# POOL_MAX_OVERFLOW more under load), so repeated sessions reuse connections instead of opening new ones.
+# Pre-ping checks a pooled connection is still alive before handing it out, e.g. after the server restarts.
+POOL_SIZE = 5
+POOL_MAX_OVERFLOW = 10
+POOL_PRE_PING = True
+
+
+# ORM models for the tables in sql/schema.sql. These are declared here, rather than reflected
+# from the database, so constructing a DB doesn't have to query the schema first.
+# Keep them in step with sql/schema.sql (and sql/indexes.sql).
+class Base(sqlalchemy.orm.DeclarativeBase):
+    pass
+
+class EncoderName(Base):
+    __tablename__ = "encoder_names"
+    id: Mapped[int] = mapped_column(sqlalchemy.Identity(always=True), primary_key=True)
+    name: Mapped[str] = mapped_column(sqlalchemy.String(128))
+
+class KeyType(Base):
+    __tablename__ = "key_types"
+    id: Mapped[int] = mapped_column(sqlalchemy.Identity(always=True), primary_key=True)
+    name: Mapped[str] = mapped_column(sqlalchemy.String(128))
+
+class CipherKey(Base):
+    __tablename__ = "cipher_keys"
+    __table_args__ = (
+        sqlalchemy.Index("cipher_keys_type_value_idx", "key_type_id", "value"),
+    )
+    id: Mapped[int] = mapped_column(sqlalchemy.Identity(always=True), primary_key=True)
+    key_type_id: Mapped[int] = mapped_column(sqlalchemy.ForeignKey("key_types.id"))
+    value: Mapped[str] = mapped_column(sqlalchemy.String)
+
+class Source(Base):
+    __tablename__ = "sources"
+    id: Mapped[int] = mapped_column(sqlalchemy.Identity(always=True), primary_key=True)
+    title: Mapped[str] = mapped_column(sqlalchemy.String)
+    url: Mapped[str] = mapped_column(sqlalchemy.String(256))
+    test_only: Mapped[bool] = mapped_column(sqlalchemy.Boolean)
+
+class File(Base):
+    __tablename__ = "files"
+    __table_args__ = (
+        sqlalchemy.Index("files_encoder_test_only_idx", "encoder_id", "test_only"),
+        sqlalchemy.Index("files_source_encoder_idx", "source_id", "encoder_id"),
+    )
+    id: Mapped[int] = mapped_column(sqlalchemy.Identity(always=True), primary_key=True)
+    source_id: Mapped[int] = mapped_column(sqlalchemy.ForeignKey("sources.id"))
+    encoder_id: Mapped[int] = mapped_column(sqlalchemy.ForeignKey("encoder_names.id"))
+    key_id: Mapped[int | None] = mapped_column(sqlalchemy.ForeignKey("cipher_keys.id"))
+    path: Mapped[str] = mapped_column(sqlalchemy.String(128))
+    test_only: Mapped[bool] = mapped_column(sqlalchemy.Boolean)
+
+
 class DB(object):
-    def __init__(self, creds: credentials.DB_Credentials):
+    # Normally the connection URL is built from the credentials, but a different URL can be given
+    # instead, e.g. a local SQLite file for benchmarking.
+    # Nothing is sent to the database until the first session is used.
+    def __init__(self, creds: 'credentials.DB_Credentials', url: str = None,
+                 pool_size: int = POOL_SIZE, max_overflow: int = POOL_MAX_OVERFLOW, pool_pre_ping: bool = POOL_PRE_PING):
         # SQL Alchemy connection info
         self.creds = creds
-        self.engine = sqlalchemy.create_engine(
-            f"postgresql://{creds.user}:{creds.password}@{creds.server}:{creds.port}/{creds.db_name}")
-
-        base = sqlalchemy.ext.automap.automap_base()
-        base.prepare(autoload_with=self.engine)
-
-        # SQL Alchemy table references, auto-mapped
-        self.db_encoder_tbl = base.classes.encoder_names
-        self.db_key_types_tbl = base.classes.key_types
-        self.db_keys_tbl = base.classes.cipher_keys
-        self.db_sources_tbl = base.classes.sources
-        self.db_files_tbl = base.classes.files
+        if url is None:
+            url = f"postgresql://{creds.user}:{creds.password}@{creds.server}:{creds.port}/{creds.db_name}"
+        self.engine = sqlalchemy.create_engine(url, pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=pool_pre_ping)
+
+        # SQL Alchemy table references, declared above
+        self.db_encoder_tbl = EncoderName
+        self.db_key_types_tbl = KeyType
+        self.db_keys_tbl = CipherKey
+        self.db_sources_tbl = Source
+        self.db_files_tbl = File
+
+        # In-process lookup caches. Encoder names and key types are a handful of rows that don't change,
+        # so they are loaded all at once the first time one is needed. Keys are cached both by ID and
+        # by (key type ID, value), up to KEY_CACHE_SIZE entries each.
+        self.dimensions_loaded = False
+        self.encoder_cache = LookupCache()
+        self.key_type_cache = LookupCache()
+        self.key_cache = LookupCache(KEY_CACHE_SIZE)
+        self.key_id_cache = LookupCache(KEY_CACHE_SIZE)
 
     # Get a database session to allow operations.
     # Caller is responsible for closing the session.
     def get_session(self):
         return sqlalchemy.orm.Session(self.engine)
+
+    # Insert rows into a table in a single statement and a single transaction.
+    # Each row is a dict of column values. Returns the new row IDs, in the same order as the rows.
+    def _insert_returning_ids(self, session, table, rows: list[dict]) -> list[int]:
+        if len(rows) == 0:
+            return []
+
+        statement = sqlalchemy.insert(table).returning(table.id, sort_by_parameter_order=True)
+        ids = session.scalars(statement, rows).all()
+        session.commit()
+        return list(ids)
+
+    # Load all encoder names and key types into the caches, if that hasn't been done yet
+    def _load_dimension_tables(self, session):
+        if self.dimensions_loaded:
+            return
+
+        for row in session.query(self.db_encoder_tbl.id, self.db_encoder_tbl.name).all():
+            self.encoder_cache.put(row.name, row.id)
+        for row in session.query(self.db_key_types_tbl.id, self.db_key_types_tbl.name).all():
+            self.key_type_cache.put(row.name, row.id)
+        self.dimensions_loaded = True
+
+    # Add keys to both key caches
+    def _cache_keys(self, keys: list[CachedKey]):
+        for key in keys:
+            self.key_cache.put(key.id, key)
+            self.key_id_cache.put((key.key_type_id, key.value), key.id)
+
+    # Empty all the lookup caches, e.g. if the database has been changed by another process
+    def clear_caches(self):
+        self.dimensions_loaded = False
+        for cache in (self.encoder_cache, self.key_type_cache, self.key_cache, self.key_id_cache):
+            cache.clear()
+
+    # Returns a map from cache name to that cache's size and hit/miss counts, for logging
+    def get_cache_stats(self) -> dict:
+        return {
+            "encoders": self.encoder_cache.get_stats(),
+            "key_types": self.key_type_cache.get_stats(),
+            "keys_by_id": self.key_cache.get_stats(),
+            "key_ids_by_value": self.key_id_cache.get_stats(),
+        }
     
     # Convenience method to get encoder and key type ID maps
     # Returns a tuple: (encoder_ids, key_type_ids)
@@ -61,11 +221,17 @@ class DB(object):
         if len(encrypted_files) > max_encrypted_files and max_encrypted_files > 0:
             encrypted_files = random.sample(encrypted_files, max_encrypted_files)
 
+        # Get the plaintexts for all of those sources in one query, rather than one query per source
+        source_ids = list({c.source_id for c in encrypted_files})
+        plaintext_files_by_source = {}
+        for p in self.get_files_by_sources_and_encoder(session, source_ids, simplifier_encoder_id, test_only=test_only):
+            plaintext_files_by_source.setdefault(p.source_id, []).append(p)
+
         for c in encrypted_files:
             sid = c.source_id
         
             if sid not in source_id_to_plaintext:
-                plaintext_ids = self.get_files_by_source_and_encoder(session, sid, simplifier_encoder_id, test_only=test_only)
+                plaintext_ids = plaintext_files_by_source.get(sid, [])
                 if len(plaintext_ids) != 1:
                     raise Exception(f"Found {len(plaintext_ids)} plaintexts for source ID {sid}; should be exactly 1")
                 source_id_to_plaintext[sid] = plaintext_ids[0]
@@ -78,53 +244,60 @@ class DB(object):
     
     # Convenience method to get features and targets (X and y) formatted for use.
     # Returns a tuple: (X, y_keys, y_texts)
-    #   X is a list of lists, where the inner list is chunks of ciphertext, as offsets
-    #   y_keys is a list of keys, where key structure varies by encoder type (floats for Caesar)
-    #   y_texts is a list of lists, where the inner list is chunks of plaintext, as offsets
+    #   X is a list of arrays, where each array is a chunk of ciphertext, as offsets
+    #   y_keys is a list of keys, where key structure varies by encoder type (a single value for Caesar)
+    #   y_texts is a list of arrays, where each array is a chunk of plaintext, as offsets
+    # Every value is an offset into CHARSET, so dtype=np.uint8 gives the same data in 1/8 the memory of the default float.
     def get_features_and_targets(self, session, source_id_to_plaintext: dict, source_id_to_ciphertext: dict, encoder: str, chunk_size: int,
-                                 want_keys = True, want_texts = True) -> tuple:
+                                 want_keys = True, want_texts = True, dtype = float) -> tuple:
         X = []
         y_keys = []
         y_texts = []
 
+        # Look up the keys for all the ciphertexts in one query, rather than one query per file
+        if want_keys:
+            key_ids = [c.key_id for sid in source_id_to_plaintext for c in source_id_to_ciphertext[sid]]
+            key_values = self.get_key_values_by_ids(session, key_ids)
+
         for sid in source_id_to_plaintext:
             if want_texts:
                 plaintext = helpers.read_text_file(source_id_to_plaintext[sid].path)
-                plaintext_offsets = encoders.string_to_offsets(plaintext)
-                plaintext_offset_chunks = helpers.chunkify(plaintext_offsets, chunk_size)    
+                plaintext_offsets = encoders.string_to_offset_array(plaintext)
+                plaintext_offset_chunks = helpers.chunkify(plaintext_offsets, chunk_size, dtype=dtype)
 
             for c in source_id_to_ciphertext[sid]:
                 ciphertext = helpers.read_text_file(c.path)
-                ciphertext_offsets = encoders.string_to_offsets(ciphertext)
-                ciphertext_offset_chunks = helpers.chunkify(ciphertext_offsets, chunk_size)
+                ciphertext_offsets = encoders.string_to_offset_array(ciphertext)
+                ciphertext_offset_chunks = helpers.chunkify(ciphertext_offsets, chunk_size, dtype=dtype)
 
                 if want_keys:
                     if encoder == encoders.ENCODER_CAESAR:
-                        key_value = float(self.get_key_by_id(session, c.key_id).value)
+                        key_value = np.dtype(dtype).type(int(key_values[c.key_id]))
                         
                     elif encoder == encoders.ENCODER_SUBST:
-                        key_str = self.get_key_by_id(session, c.key_id).value
-                        key_value_ints = encoders.string_to_offsets(key_str)
-                        key_value = np.array(key_value_ints).astype(float)
+                        key_str = key_values[c.key_id]
+                        key_value = encoders.string_to_offset_array(key_str).astype(dtype)
 
                     else:
                         raise Exception(f"Unsupported encoder {encoder}")
 
-                for i in range (len(ciphertext_offset_chunks)):
-                    ciphertext_offset_chunk = ciphertext_offset_chunks[i]
-                    X.append(np.array(ciphertext_offset_chunk).astype(float))
-
-                    if want_texts: 
-                        plaintext_offset_chunk = plaintext_offset_chunks[i]
-                        y_texts.append(np.array(plaintext_offset_chunk).astype(float))
-                    if want_keys:
-                        y_keys.append(key_value)
+                X.extend(ciphertext_offset_chunks)
+                if want_texts:
+                    y_texts.extend(plaintext_offset_chunks)
+                if want_keys:
+                    y_keys.extend([key_value] * len(ciphertext_offset_chunks))
 
         return X, y_keys if want_keys else None, y_texts if want_texts else None
 
 
     # Returns the database ID for specified encoder name, or -1 if not found
     def get_encoder_id(self, session, name):
+        self._load_dimension_tables(session)
+        id = self.encoder_cache.get(name)
+        if id is not None:
+            return id
+
+        # Not cached, but it may have been added by another process since the cache was loaded
         results = session.query(
             self.db_encoder_tbl.id, self.db_encoder_tbl.name
         ).filter(self.db_encoder_tbl.name == name).all()
@@ -132,16 +305,24 @@ class DB(object):
         if len(results) == 0:
             return -1
         else:
+            self.encoder_cache.put(name, results[0].id)
             return results[0].id
         
-    # Add a new encoder name to the database
-    def add_encoder(self, session, name):
-        session.add(self.db_encoder_tbl(name = name))
-        session.commit()
+    # Add a new encoder name to the database, returning its ID
+    def add_encoder(self, session, name) -> int:
+        id = self._insert_returning_ids(session, self.db_encoder_tbl, [{"name": name}])[0]
+        self.encoder_cache.put(name, id)
+        return id
         
 
     # Returns the database ID for specified key type, or -1 if not found
     def get_key_type_id(self, session, name):
+        self._load_dimension_tables(session)
+        id = self.key_type_cache.get(name)
+        if id is not None:
+            return id
+
+        # Not cached, but it may have been added by another process since the cache was loaded
         results = session.query(
             self.db_key_types_tbl.id, self.db_key_types_tbl.name
         ).filter(self.db_key_types_tbl.name == name).all()
@@ -149,12 +330,14 @@ class DB(object):
         if len(results) == 0:
             return -1
         else:
+            self.key_type_cache.put(name, results[0].id)
             return results[0].id    
 
-    # Add a new key type to the database
-    def add_key_type(self, session, name):
-        session.add(self.db_key_types_tbl(name = name))
-        session.commit()
+    # Add a new key type to the database, returning its ID
+    def add_key_type(self, session, name) -> int:
+        id = self._insert_returning_ids(session, self.db_key_types_tbl, [{"name": name}])[0]
+        self.key_type_cache.put(name, id)
+        return id
 
 
     # Get a single source by its ID, or None if not found
@@ -186,10 +369,15 @@ class DB(object):
         else:
             return results[0].id
 
-    # Add a new key type to the database
-    def add_source(self, session, title, url, test_only):
-        session.add(self.db_sources_tbl(title=title, url=url, test_only=test_only))
-        session.commit()
+    # Add a new source to the database, returning its ID
+    def add_source(self, session, title, url, test_only) -> int:
+        return self.add_sources(session, [(title, url, test_only)])[0]
+
+    # Add several sources to the database in one transaction.
+    # Each row is a tuple (title, url, test_only). Returns the new IDs, in the same order.
+    def add_sources(self, session, rows: list[tuple]) -> list[int]:
+        return self._insert_returning_ids(session, self.db_sources_tbl, [
+            {"title": title, "url": url, "test_only": test_only} for (title, url, test_only) in rows])
 
 
     # Get all files by source ID and/or encoder ID. Returns a list of database rows.
@@ -211,23 +399,53 @@ class DB(object):
         results = q.all()
         return results
         
-    # Add a file to the database.
+    # Get all files for any of the specified source IDs, with the specified encoder ID, in one query.
+    # Specify test_only as True or False to limit results accordingly,
+    #    or leave it as None to ignore that property
+    def get_files_by_sources_and_encoder(self, session, source_ids: list[int], encoder_id, test_only=None):
+        if len(source_ids) == 0:
+            return []
+
+        q = session.query(
+            self.db_files_tbl
+        ).filter(
+            self.db_files_tbl.source_id.in_(source_ids),
+            self.db_files_tbl.encoder_id == encoder_id
+        )
+
+        if test_only is not None:
+            q = q.filter(self.db_files_tbl.test_only == test_only)
+
+        return q.all()
+
+    # Add a file to the database, returning its ID.
     # Note key_id can be None, for raw files, but all other parameters must be filled
-    def add_file(self, session, source_id, encoder_id, key_id, path, test_only):
-        new_row = self.db_files_tbl(
-            source_id = source_id,
-            encoder_id = encoder_id,
-            key_id = key_id,
-            path = pathlib.Path(path).as_posix(),
-            test_only = test_only)
-        session.add(new_row)
-        session.commit()
+    def add_file(self, session, source_id, encoder_id, key_id, path, test_only) -> int:
+        return self.add_files(session, [(source_id, encoder_id, key_id, path, test_only)])[0]
+
+    # Add several files to the database in one transaction.
+    # Each row is a tuple of add_file() parameters: (source_id, encoder_id, key_id, path, test_only)
+    # Returns the new IDs, in the same order.
+    def add_files(self, session, rows: list[tuple]) -> list[int]:
+        return self._insert_returning_ids(session, self.db_files_tbl, [
+            {
+                "source_id": source_id,
+                "encoder_id": encoder_id,
+                "key_id": key_id,
+                "path": pathlib.Path(path).as_posix(),
+                "test_only": test_only
+            } for (source_id, encoder_id, key_id, path, test_only) in rows])
 
        
-    # Get a single key by its ID, or None if not found
+    # Get a single key by its ID, or None if not found.
+    # The key is returned as a CachedKey, with id, key_type_id and value fields.
     def get_key_by_id(self, session, key_id):
+        key = self.key_cache.get(key_id)
+        if key is not None:
+            return key
+
         results = session.query(
-            self.db_keys_tbl
+            self.db_keys_tbl.id, self.db_keys_tbl.key_type_id, self.db_keys_tbl.value
         ).filter(
             self.db_keys_tbl.id == key_id
         ).all()
@@ -235,10 +453,40 @@ class DB(object):
         if len(results) == 0:
             return None
         else:
-            return results[0]
+            key = CachedKey(results[0].id, results[0].key_type_id, results[0].value)
+            self._cache_keys([key])
+            return key
+
+    # Returns a map from key ID to key value for all of the specified key IDs.
+    # Keys that aren't cached are looked up in one query.
+    def get_key_values_by_ids(self, session, key_ids: list[int]) -> dict:
+        key_values = {}
+        missing_ids = []
+        for key_id in set(key_ids):
+            key = self.key_cache.get(key_id)
+            if key is None:
+                missing_ids.append(key_id)
+            else:
+                key_values[key_id] = key.value
+
+        if len(missing_ids) > 0:
+            results = session.query(
+                self.db_keys_tbl.id, self.db_keys_tbl.key_type_id, self.db_keys_tbl.value
+            ).filter(
+                self.db_keys_tbl.id.in_(missing_ids)
+            ).all()
+
+            self._cache_keys([CachedKey(row.id, row.key_type_id, row.value) for row in results])
+            key_values.update({row.id: row.value for row in results})
+
+        return key_values
 
     # Returns the database ID for specified key, or -1 if not found
     def get_key_id_by_type_and_value(self, session, key_type_id, key_value: str):
+        id = self.key_id_cache.get((key_type_id, key_value))
+        if id is not None:
+            return id
+
         results = session.query(
             self.db_keys_tbl.id
         ).filter(
@@ -249,8 +497,42 @@ class DB(object):
         if len(results) == 0:
             return -1
         else:
+            self._cache_keys([CachedKey(results[0].id, key_type_id, key_value)])
             return results[0].id
         
-    def add_key(self, session, key_type_id, key_value:str):
-        session.add(self.db_keys_tbl(key_type_id = key_type_id, value = key_value))
-        session.commit()
+    # Returns a map from key value to database ID for all of the specified keys that are in the database.
+    # Keys that aren't cached are looked up in one query.
+    def get_key_ids_by_type_and_values(self, session, key_type_id, key_values: list[str]) -> dict:
+        key_ids = {}
+        missing_values = []
+        for key_value in set(key_values):
+            id = self.key_id_cache.get((key_type_id, key_value))
+            if id is None:
+                missing_values.append(key_value)
+            else:
+                key_ids[key_value] = id
+
+        if len(missing_values) > 0:
+            results = session.query(
+                self.db_keys_tbl.id, self.db_keys_tbl.value
+            ).filter(
+                self.db_keys_tbl.key_type_id == key_type_id,
+                self.db_keys_tbl.value.in_(missing_values)
+            ).all()
+
+            self._cache_keys([CachedKey(row.id, key_type_id, row.value) for row in results])
+            key_ids.update({row.value: row.id for row in results})
+
+        return key_ids
+
+    # Add a new key to the database, returning its ID
+    def add_key(self, session, key_type_id, key_value:str) -> int:
+        return self.add_keys(session, key_type_id, [key_value])[0]
+
+    # Add several keys of the same type to the database in one transaction.
+    # Returns the new IDs, in the same order as the values.
+    def add_keys(self, session, key_type_id, key_values: list[str]) -> list[int]:
+        ids = self._insert_returning_ids(session, self.db_keys_tbl, [
+            {"key_type_id": key_type_id, "value": key_value} for key_value in key_values])
+        self._cache_keys([CachedKey(id, key_type_id, key_value) for id, key_value in zip(ids, key_values)])
+        return ids
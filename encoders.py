@@ -1,5 +1,8 @@
 import re
 import random
+import functools
+
+import numpy as np
 
 ENCODER_NONE = "None"
 ENCODER_SIMPLIFIER = "Simplifier"
@@ -37,13 +40,135 @@ SIMPLIFICATION_MAP = str.maketrans({
 CHARSET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890-=`!#$%&*()+[];':\",./<>? \n"
 
 
+# Lookup tables for the cipher engine. Text is handled as a buffer of byte values, and every
+# cipher operation becomes a single table lookup per byte (bytes.translate or numpy take),
+# rather than a CHARSET.find() call per character.
+_CHARSET_BYTES = CHARSET.encode('ascii')
+_CHARSET_ARRAY = np.frombuffer(_CHARSET_BYTES, dtype=np.uint8)
+
+# Byte value -> offset in the character set. Bytes outside the character set map to -1,
+# which matches the behavior of CHARSET.find().
+_OFFSET_TABLE = np.full(256, -1, dtype=np.int16)
+_OFFSET_TABLE[_CHARSET_ARRAY] = np.arange(len(CHARSET), dtype=np.int16)
+
+# Convert text to an array of byte values, one per character. Characters that don't fit
+# in a byte can't be in the character set, so they all get the same out-of-set value.
+def _text_to_bytes(text: str) -> np.ndarray:
+    try:
+        return np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+    except UnicodeEncodeError:
+        code_points = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        return np.minimum(code_points, 255).astype(np.uint8)
+
+# Apply a 256-entry translation table to text, returning the translated text
+def _apply_table(text: str, table: bytes) -> str:
+    try:
+        return text.encode('ascii').translate(table).decode('ascii')
+    except UnicodeEncodeError:
+        table_arr = np.frombuffer(table, dtype=np.uint8)
+        return table_arr.take(_text_to_bytes(text)).tobytes().decode('ascii')
+
+# Convert a string to a numpy array of offsets in the character set.
+# Characters outside the character set get INVALID_OFFSET (only possible with unsimplified text).
+INVALID_OFFSET = 255
+def string_to_offset_array(in_str: str) -> np.ndarray:
+    return _OFFSET_TABLE.take(_text_to_bytes(in_str)).astype(np.uint8)
+
 # Convert a string to a list of offsets in the character set
 def string_to_offsets(in_str:str) -> list[int]:
-    return [CHARSET.find(c) for c in in_str ]
+    return _OFFSET_TABLE.take(_text_to_bytes(in_str)).tolist()
 
-# Convert a list of character set offsets to a string
+# Convert a list (or array) of character set offsets to a string
 def offsets_to_string(offsets: list[int]) -> str:
-    return "".join(CHARSET[i] for i in offsets)
+    indexes = np.asarray(offsets, dtype=np.intp)
+    return _CHARSET_ARRAY.take(indexes).tobytes().decode('ascii')
+
+
+# Translation table combining every per-character step of simplification: the character map,
+# shifting to uppercase, and removing unsupported characters. Entries are filled in the first time
+# each character is seen. Line endings are normalized before the table is used, so there are no carriage
+# returns left by then.
+class _SimplificationTable(dict):
+    def __missing__(self, ordinal: int):
+        original = chr(ordinal)
+        mapped = original.translate(SIMPLIFICATION_MAP).upper()
+        kept = "".join([c for c in mapped if c in CHARSET])
+
+        if kept == original:
+            value = ordinal
+        elif kept == "":
+            value = None
+        else:
+            value = kept
+
+        self[ordinal] = value
+        return value
+
+_SIMPLIFICATION_TABLE = _SimplificationTable()
+
+# The same table for ASCII characters, in the form bytes.translate() wants: a 256-byte table and
+# a set of bytes to delete. Every ASCII character maps to at most one character, so this covers
+# the bulk of the text at C speed.
+def _build_ascii_simplification_table() -> tuple[bytes, bytes]:
+    table = bytearray(range(256))
+    delete = bytearray()
+    for i in range(128):
+        value = _SIMPLIFICATION_TABLE[i]
+        if value is None:
+            delete.append(i)
+        elif isinstance(value, int):
+            table[i] = value
+        else:
+            table[i] = ord(value)
+    return bytes(table), bytes(delete)
+
+(_SIMPLIFICATION_ASCII_TABLE, _SIMPLIFICATION_ASCII_DELETE) = _build_ascii_simplification_table()
+
+_NON_ASCII_RE = re.compile(r'[^\x00-\x7f]+')
+
+def _simplify_non_ascii(match: re.Match) -> str:
+    return match.group().translate(_SIMPLIFICATION_TABLE)
+
+# Whitespace consolidation, handled in one regex pass: runs of 3+ newlines become a blank line,
+# and runs of spaces become a single space.
+_WHITESPACE_RE = re.compile(r'\n\n\n+|  +')
+
+def _whitespace_replacement(match: re.Match) -> str:
+    return "\n\n" if match.group()[0] == "\n" else " "
+
+# Apply the character-level simplification steps to a piece of text.
+# Windows and old Mac line endings are converted first, which only costs a copy if they are present. This has
+# to happen before unsupported characters are removed, or removing one from between "\r" and "\n" would
+# turn a single line ending into two.
+# The (usually rare) non-ASCII characters are handled next, leaving ASCII text that can go
+# through a single bytes.translate() pass.
+def _simplify_characters(text: str) -> str:
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    if not text.isascii():
+        text = _NON_ASCII_RE.sub(_simplify_non_ascii, text)
+    return text.encode('ascii').translate(_SIMPLIFICATION_ASCII_TABLE, _SIMPLIFICATION_ASCII_DELETE).decode('ascii')
+
+# Consolidate whitespace in text that has already been through _simplify_characters().
+def _simplify_whitespace(text: str) -> str:
+    return _WHITESPACE_RE.sub(_whitespace_replacement, text)
+
+
+# Find the part of a Project Gutenberg text worth keeping, i.e. without the boilerplate.
+# The good part starts on the first line after the "Start" marker and ends with the start of the "End" marker.
+# find_func must behave like str.find(sub, start), which lets this work on a whole string or a file on disk.
+# Returns a tuple (start, end), where end is -1 if the text should be kept to the very end.
+def find_content_bounds(find_func) -> tuple[int, int]:
+    good_part_start = find_func(PG_START_CONTENT, 0)
+    good_part_end = find_func(PG_END_CONTENT, 0)
+
+    if good_part_start == -1:
+        good_part_start = 0
+    else:
+        # Move on to the newline
+        good_part_start = find_func("\n", good_part_start)+1
+
+    return (good_part_start, good_part_end)
 
 
 # Simplify raw text:
@@ -53,43 +178,25 @@ def offsets_to_string(offsets: list[int]) -> str:
 #   Removing all remaining non-supported characters
 #   Removing excessive whitespace
 #
+# The character-level steps share one translation table and the whitespace steps share one
+# regex, so the text only gets copied a few times no matter how big it is.
+#
 # Result is returned as a string
 def encode_simple(raw_text: str) -> str:
     # Remove Project Gutenberg boilerplate, if it is present.
-    # The good part starts on the first line after the "Start" marker
-    # and ends with the start of the "End" marker.
-    good_part_start = raw_text.find(PG_START_CONTENT)
-    good_part_end = raw_text.find(PG_END_CONTENT)
-
-    if good_part_start == -1:
-        good_part_start = 0
-    else:
-        # Move on to the newline
-        good_part_start = raw_text.find("\n", good_part_start)+1
-
+    (good_part_start, good_part_end) = find_content_bounds(raw_text.find)
     if good_part_end == -1:
         good_part_end = len(raw_text)
 
     result = raw_text[good_part_start:good_part_end]
 
-    # Character map
-    result = result.translate(SIMPLIFICATION_MAP)
-    result = result.replace('\r\n', '\n')
-    result = result.replace('\r', '\n')
-
-    # Uppercase
-    result = result.upper()
-
-    # Remove all non-supported characters
-    # This is quite a slow implementation. Regex would be faster, but also harder to test given the paucity
-    # of certain characters in the input and the handling of special characters within the regex string itself.
-    result = "".join([c for c in result if c in CHARSET])
+    # Character map, uppercase, and removal of non-supported characters
+    result = _simplify_characters(result)
 
     # Remove excessive whitespace by consolidating consequetive spaces and newlines
     # We do this at the end because some of the previous adjustments might result in
     # whitespace characters getting joined up.
-    result = re.sub(r'\n\n+', '\n\n', result)
-    result = re.sub(r'  +', ' ', result)
+    result = _simplify_whitespace(result)
 
     # And remove any whitespace from the beginning or end
     result = result.strip()
@@ -97,6 +204,43 @@ def encode_simple(raw_text: str) -> str:
     return result
 
 
+# Simplify text a block at a time, for texts too big to hold in memory. This does everything
+# encode_simple() does except removing the boilerplate; use find_content_bounds() to decide which
+# part of the text to feed in. Concatenating everything returned by feed() gives the same result
+# as encode_simple() on the whole text.
+#
+# Whitespace runs can cross block boundaries, so trailing whitespace from each block is held back
+# until the next block shows where the run ends. Whatever is still held back at the end is trailing
+# whitespace, which encode_simple() would have stripped anyway.
+# A carriage return at the very end of a block is held back too, unsimplified, in case the next block starts
+# with the "\n" of a Windows line ending.
+class StreamingSimplifier(object):
+    def __init__(self):
+        self.pending_whitespace = ""
+        self.pending_cr = ""
+        self.started = False
+
+    # Simplify the next block of raw text, returning the simplified text that is ready to output
+    def feed(self, raw_block: str) -> str:
+        raw_block = self.pending_cr + raw_block
+        self.pending_cr = "\r" if raw_block.endswith("\r") else ""
+        if self.pending_cr:
+            raw_block = raw_block[:-1]
+
+        text = self.pending_whitespace + _simplify_characters(raw_block)
+        ready = text.rstrip(" \n")
+        self.pending_whitespace = text[len(ready):]
+
+        result = _simplify_whitespace(ready)
+
+        # Leading whitespace gets stripped, just like encode_simple()
+        if not self.started:
+            result = result.lstrip()
+            self.started = len(result) > 0
+
+        return result
+
+
 def get_key_caesar() -> int:
     return random.randint(1, len(CHARSET)-1)
 
@@ -116,8 +260,31 @@ def decode_caesar(plaintext: str, key: int) -> str:
 # really the same algorithm either way. Encode vs. decode functions above just enforce
 # the key sign logic.
 def _do_caesar(plaintext: str, key: int) -> str:
-    result = "".join([CHARSET[(CHARSET.find(c) + key) % len(CHARSET)] for c in plaintext])
-    return result
+    return _apply_table(plaintext, _caesar_table(key))
+
+# Translation table for a Caesar shift. Characters outside the character set have offset -1,
+# so they shift the same way they always have.
+@functools.lru_cache(maxsize=None)
+def _caesar_table(key: int) -> bytes:
+    return _CHARSET_ARRAY[(_OFFSET_TABLE + key) % len(CHARSET)].tobytes()
+
+
+# Encrypt one plaintext under several Caesar keys in a single pass.
+# Returns a K x N uint8 matrix of character codes, one row per key. Use codes_to_string() to get text.
+def encode_caesar_many(plaintext: str, keys: list[int]) -> np.ndarray:
+    for key in keys:
+        if key < 1 or key >= len(CHARSET):
+            raise Exception(f"Bad Caesar offset key: {key}")
+
+    return _apply_tables_many(_text_to_bytes(plaintext), [_caesar_table(key) for key in keys])
+
+# Decrypt a K x N matrix of Caesar ciphertexts, where row i was encrypted with keys[i]
+def decode_caesar_many(ciphertexts: np.ndarray, keys: list[int]) -> np.ndarray:
+    for key in keys:
+        if key < 1 or key >= len(CHARSET):
+            raise Exception(f"Bad Caesar offset key: {key}")
+
+    return _apply_tables_rowwise(ciphertexts, [_caesar_table(-key) for key in keys])
 
 
 # Get a key for the substitution cypher, in a form of a string where each character corresponds
@@ -133,10 +300,59 @@ def encode_substitution(plaintext: str, key: str) -> str:
 def decode_substitution(plaintext: str, key: str) -> str:
     return _do_substitution(plaintext, key, CHARSET)
 
+# Encrypt one plaintext under several substitution keys in a single pass.
+# Returns a K x N uint8 matrix of character codes, one row per key. Use codes_to_string() to get text.
+def encode_substitution_many(plaintext: str, keys: list[str]) -> np.ndarray:
+    return _apply_tables_many(_text_to_bytes(plaintext), [_substitution_table(CHARSET, key) for key in keys])
+
+# Decrypt a K x N matrix of substitution ciphertexts, where row i was encrypted with keys[i]
+def decode_substitution_many(ciphertexts: np.ndarray, keys: list[str]) -> np.ndarray:
+    return _apply_tables_rowwise(ciphertexts, [_substitution_table(key, CHARSET) for key in keys])
+
 def _do_substitution(plaintext: str, key_from: str, key_to: str) -> str:
-    result = "".join([key_to[key_from.find(c)] for c in plaintext])
+    return _apply_table(plaintext, _substitution_table(key_from, key_to))
+
+# Translation table mapping each character of key_from to the same position in key_to.
+# Characters not in key_from map to the last character of key_to, as key_to[-1] would.
+@functools.lru_cache(maxsize=1024)
+def _substitution_table(key_from: str, key_to: str) -> bytes:
+    from_offsets = np.full(256, -1, dtype=np.int16)
+    from_bytes = np.frombuffer(key_from.encode('ascii'), dtype=np.uint8)
+    # Assign in reverse so the first occurrence wins, as with str.find()
+    from_offsets[from_bytes[::-1]] = np.arange(len(key_from), dtype=np.int16)[::-1]
+
+    to_bytes = np.frombuffer(key_to.encode('ascii'), dtype=np.uint8)
+    return to_bytes[from_offsets].tobytes()
+
+
+
+# Apply K translation tables to the same text, giving a K x N matrix of character codes.
+# The text is converted to bytes once, then each row is filled by a C-speed bytes.translate pass,
+# which benchmarks faster than a broadcast numpy gather over the whole matrix.
+def _apply_tables_many(text_bytes: np.ndarray, tables: list[bytes]) -> np.ndarray:
+    source = text_bytes.tobytes()
+    result = np.empty((len(tables), len(source)), dtype=np.uint8)
+    for i, table in enumerate(tables):
+        result[i] = np.frombuffer(source.translate(table), dtype=np.uint8)
     return result
 
+# Apply translation table i to row i of a K x N matrix of character codes
+def _apply_tables_rowwise(matrix: np.ndarray, tables: list[bytes]) -> np.ndarray:
+    result = np.empty_like(matrix)
+    for i, table in enumerate(tables):
+        result[i] = np.frombuffer(matrix[i].tobytes().translate(table), dtype=np.uint8)
+    return result
+
+# Convert one row of character codes (as returned by the *_many functions) to a string
+def codes_to_string(codes: np.ndarray) -> str:
+    return codes.tobytes().decode('ascii')
+
+# Compare every row of a K x N matrix of character codes against the text in one pass.
+# Returns the indexes of rows that do not match, so an empty list means they all match.
+def mismatched_rows(text: str, matrix: np.ndarray) -> list[int]:
+    expected = _text_to_bytes(text)
+    return np.flatnonzero((matrix != expected).any(axis=1)).tolist()
+
 
 
 def self_test():
@@ -188,6 +404,26 @@ def self_test():
     s_decoded_str = decode_substitution(s_coded_str, SUBST_KEY)
     print(f"Decode Substitution(LONG_TEST_STR): {s_decoded_str == LONG_TEST_STR}")
 
+    caesar_keys = [CAESAR_KEY, 1, len(CHARSET)-1]
+    c_coded = encode_caesar_many(LONG_TEST_STR, caesar_keys)
+    print(f"Encode Caesar Many(LONG_TEST_STR): {all(codes_to_string(c_coded[i]) == encode_caesar(LONG_TEST_STR, k) for i, k in enumerate(caesar_keys))}")
+    print(f"Decode Caesar Many(LONG_TEST_STR): {mismatched_rows(LONG_TEST_STR, decode_caesar_many(c_coded, caesar_keys)) == []}")
+
+    subst_keys = [SUBST_KEY, get_key_substitution()]
+    s_coded = encode_substitution_many(LONG_TEST_STR, subst_keys)
+    print(f"Encode Substitution Many(LONG_TEST_STR): {all(codes_to_string(s_coded[i]) == encode_substitution(LONG_TEST_STR, k) for i, k in enumerate(subst_keys))}")
+    print(f"Decode Substitution Many(LONG_TEST_STR): {mismatched_rows(LONG_TEST_STR, decode_substitution_many(s_coded, subst_keys)) == []}")
+    print(f"Mismatched Rows: {mismatched_rows(LONG_TEST_STR, s_coded) == [0, 1]}")
+
+    # The lookup tables should treat characters outside the set just like CHARSET.find() did
+    offset_array = string_to_offset_array(LONG_TEST_STR)
+    print(f"string_to_offset_array(LONG_TEST_STR): {offset_array.tolist() == string_to_offsets(LONG_TEST_STR)}")
+
+    odd_str = "Aé\tZ"
+    print(f"string_to_offsets(odd_str): {string_to_offsets(odd_str) == [0, -1, -1, 25]}")
+    print(f"Encode Caesar(odd_str): {encode_caesar(odd_str, CAESAR_KEY) == CHARSET[3] + CHARSET[2]*2 + CHARSET[28]}")
+    print(f"Encode Substitution(odd_str): {encode_substitution(odd_str, SUBST_KEY) == SUBST_KEY[0] + SUBST_KEY[-1]*2 + SUBST_KEY[25]}")
+
     # This was getting very oddly mangled by simplification:
     scary_string = """
 String set by triple quotes
@@ -200,5 +436,16 @@ String set by triple quotes
     fixed_accent_string = "RESUME"
     print(f"Accent Correction: {encode_simple(accented_string) == fixed_accent_string}")
 
+    # Line endings are normalized before unsupported characters are removed, as they always were
+    line_end_strings = {"a\r\t\nb": "A\n\nB", "a\r\nb\r\tc": "A\nB\nC", "a\r\n\t\r\n\t\r\nb": "A\n\nB", "a\t\r\nb\r": "A\nB"}
+    print(f"Line Endings Around Unsupported Characters: {all(encode_simple(k) == v for (k, v) in line_end_strings.items())}")
+
+    streamed = []
+    for (raw, expected) in line_end_strings.items():
+        for split in range(len(raw) + 1):
+            simplifier = StreamingSimplifier()
+            streamed.append(simplifier.feed(raw[:split]) + simplifier.feed(raw[split:]) == expected)
+    print(f"Streaming Line Endings: {all(streamed)}")
+
 if __name__ == '__main__':
     self_test()
\ No newline at end of file
@@ -0,0 +1,236 @@
+# This file evaluates the Caesar models against the test-only files, and writes the accuracy table and graph
+# shown at the top of the report (accuracy_table.png and accuracy_graph.png). Run it from the top directory:
+#   python evaluate.py
+#   python evaluate.py --store
+#   python evaluate.py --self-test
+# The first reads the test-only files listed in the database; --store reads the same chunks from the
+# test-only feature store instead (see feature_store.py), which is much faster once it exists.
+#
+# The models put out a prediction for every iteration through a chunk (see report.ipynb), and the graph shows
+# how accuracy changes from one iteration to the next. Chunks are streamed through the models a batch at a time,
+# and each batch's predictions are counted and thrown away, so memory use doesn't depend on how much test data
+# there is. Predictions are rounded to uint8 offsets and compared with the uint8 targets.
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import encoders
+import helpers
+import feature_store
+import models
+
+from constants import *
+
+# How many chunks go through the models at once. Text model predictions for each chunk of a model taking the
+# chunk as a sequence are chunk size x chunk size floats, so this is what bounds memory use.
+DEFAULT_BATCH_SIZE = 32
+
+ACCURACY_TABLE_PATH = "accuracy_table.png"
+ACCURACY_GRAPH_PATH = "accuracy_graph.png"
+
+# Running totals of how many predicted values were right, for each iteration, plus the modulo distance for the
+# last iteration (as in tf_helpers.modulo_distance_accuracy()). Its size depends only on the number of iterations.
+class Accuracy_Counter(object):
+    def __init__(self, iterations: int):
+        self.correct = np.zeros(iterations, dtype=np.int64)
+        self.distance_sum = 0.0
+        self.value_count = 0
+        self.chunk_count = 0
+
+    # Count a batch of predictions, shaped (chunks, values, iterations), against the expected offsets,
+    # shaped (chunks, values)
+    def add(self, predictions: np.ndarray, expected: np.ndarray):
+        rounded = (np.rint(predictions) % CUSTOM_LOSS_MODULO).astype(np.uint8)
+        self.correct += (rounded == expected[:, :, None]).sum(axis=(0, 1))
+
+        difference = np.abs(predictions[:, :, -1] - expected) % CUSTOM_LOSS_MODULO
+        self.distance_sum += float(np.minimum(difference, CUSTOM_LOSS_MODULO - difference).sum())
+        self.value_count += expected.size
+        self.chunk_count += len(expected)
+
+    # Accuracy after each iteration, as an array of proportions
+    def get_accuracies(self) -> np.ndarray:
+        return self.correct / max(self.value_count, 1)
+
+    def get_distance_accuracy(self) -> float:
+        return 1 - self.distance_sum / max(self.value_count, 1) / (CUSTOM_LOSS_MODULO / 2)
+
+# Models are either key or text models. How many iterations there are, and where to find them in the output:
+#   key models put out (chunks, iterations, 1)
+#   text models taking the chunk as a sequence put out (chunks, chunk size, iterations), with the text along the 2nd
+#   dimension; text models taking the chunk as a single step put out (chunks, 1, chunk size), a single iteration
+def _is_sequence_text_model(model) -> bool:
+    return model.output_shape[1] == int(np.prod(model.input_shape[1:]))
+
+def get_iteration_count(model, kind: str) -> int:
+    if kind == "text" and _is_sequence_text_model(model):
+        return model.output_shape[2]
+    return model.output_shape[1]
+
+# Reorder a batch of a model's predictions to (chunks, values, iterations)
+def _by_iteration(model, kind: str, predictions: np.ndarray) -> np.ndarray:
+    if kind == "text" and _is_sequence_text_model(model):
+        return predictions
+    return predictions.transpose((0, 2, 1))
+
+# Stream chunks through the key and text models (either can be None), batch_size at a time, counting how accurate
+# each iteration of predictions is. parts is an iterable of dicts of uint8 arrays, with X, y_keys and y_texts, as
+# from feature_store.load_shards() or feature_store.iter_file_parts().
+# Returns a map from "key" and "text" to an Accuracy_Counter, for the models given.
+def evaluate_parts(parts, scaler, key_model=None, text_model=None, batch_size: int = DEFAULT_BATCH_SIZE) -> dict:
+    model_map = {kind: model for (kind, model) in [("key", key_model), ("text", text_model)] if model is not None}
+    counters = {kind: Accuracy_Counter(get_iteration_count(model, kind)) for (kind, model) in model_map.items()}
+
+    for part in parts:
+        for start in range(0, len(part["X"]), batch_size):
+            X = np.asarray(part["X"][start : start + batch_size])
+            scaled = helpers.scale_features(scaler, X)
+            expected = {"key": np.asarray(part["y_keys"][start : start + batch_size]).reshape((len(X), -1)),
+                        "text": np.asarray(part["y_texts"][start : start + batch_size])}
+
+            for (kind, model) in model_map.items():
+                predictions = model.predict_on_batch(scaled.reshape((-1,) + tuple(model.input_shape[1:])))
+                counters[kind].add(_by_iteration(model, kind, np.asarray(predictions)), expected[kind])
+
+    return counters
+
+# Summarize the counters as a table, one column per model
+def get_results_table(counters: dict) -> pd.DataFrame:
+    columns = {}
+    for (kind, counter) in counters.items():
+        accuracies = counter.get_accuracies()
+        columns[f"{kind.capitalize()} Model"] = {
+            "Chunks": counter.chunk_count,
+            "Direct Accuracy": accuracies[-1],
+            "Modulo Distance Accuracy": counter.get_distance_accuracy(),
+            "Best Iteration": int(accuracies.argmax()),
+            "Best Iteration Accuracy": accuracies.max(),
+        }
+    return pd.DataFrame(columns)
+
+# Write the results table as an image. Matplotlib is only needed for the images, so it's imported here.
+def write_accuracy_table(table: pd.DataFrame, path: str = ACCURACY_TABLE_PATH):
+    from matplotlib.figure import Figure
+
+    def format_value(row_name, value):
+        return f"{int(value)}" if row_name in ("Chunks", "Best Iteration") else f"{value:.2%}"
+
+    cell_text = [[format_value(row_name, value) for value in row] for (row_name, row) in table.iterrows()]
+    figure = Figure(figsize=(2 + 2 * len(table.columns), 0.4 * (len(table) + 1)))
+    axes = figure.subplots()
+    axes.axis("off")
+    axes.table(cellText=cell_text, rowLabels=list(table.index), colLabels=list(table.columns), loc="center")
+    figure.savefig(path, bbox_inches="tight", dpi=150)
+
+# Write the graph of accuracy by iteration for each model
+def write_accuracy_graph(counters: dict, path: str = ACCURACY_GRAPH_PATH):
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(8, 5))
+    axes = figure.subplots()
+    for (kind, counter) in counters.items():
+        accuracies = counter.get_accuracies()
+        axes.plot(np.arange(len(accuracies)), accuracies, marker="o" if len(accuracies) == 1 else None,
+                  label=f"{kind.capitalize()} Model Accuracy")
+    axes.set_title("Caesar Cipher Model Accuracy")
+    axes.set_xlabel("Iteration")
+    axes.set_ylabel("Accuracy")
+    axes.legend()
+    figure.savefig(path, dpi=150)
+
+# Parts of the test-only data for the encoder and chunk size, from the feature store or from the text files
+# listed in the database. Either way, only one part (a shard, or one encrypted file) is read at a time.
+def iter_test_parts(encoder: str, chunk_size: int, use_store: bool):
+    if use_store:
+        return feature_store.load_shards(feature_store.get_store_dir(encoder, chunk_size, test_only=True))
+
+    import db_connect
+    from credentials import CONNECTION_INFO
+
+    db = db_connect.DB(CONNECTION_INFO)
+    with db.get_session() as session:
+        file_sets = feature_store.get_file_sets(db, session, encoder, test_only=True)
+    return (part for (_, part) in feature_store.iter_file_parts(encoder, chunk_size, file_sets) if part is not None)
+
+
+def self_test():
+    # Three chunks of four values, over three iterations that get better as they go
+    expected = np.array([[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 10, 11]], dtype=np.uint8)
+    predictions = np.stack([expected + 5.0, expected + 0.4, expected + CUSTOM_LOSS_MODULO - 0.2], axis=2)
+    predictions[0, 0, 1] = 20
+    counter = Accuracy_Counter(3)
+    counter.add(predictions[:2], expected[:2])
+    counter.add(predictions[2:], expected[2:])
+    print(f"Accuracy By Iteration: {np.allclose(counter.get_accuracies(), [0, 11 / 12, 1]) and counter.chunk_count == 3}")
+    print(f"Modulo Distance Accuracy: {np.isclose(counter.get_distance_accuracy(), 1 - 0.2 / (CUSTOM_LOSS_MODULO / 2))}")
+
+    # Streaming in small batches should count the same as predicting everything at once, as the report used to
+    key_model = models.load_model(models.CAESAR_KEY_MODEL_PATH)
+    text_model = models.load_model(models.CAESAR_TEXT_MODEL_PATH)
+    chunk_size = int(np.prod(key_model.input_shape[1:]))
+    scaler = helpers.load_scaler_from_file(helpers.get_recommended_scaler_path(encoders.ENCODER_CAESAR, chunk_size, temp=False))
+
+    # A passage of prose, from the middle of a book, as the crackers self-test uses
+    book = encoders.encode_simple(helpers.read_text_file(os.path.join(DATA_INTAKE_DIR, sorted(os.listdir(DATA_INTAKE_DIR))[0])))
+    plaintext = book[len(book) // 2 : len(book) // 2 + chunk_size * 20]
+    keys = [3, 17, 42]
+    X = np.concatenate([helpers.chunkify(encoders.string_to_offset_array(encoders.encode_caesar(plaintext, k)), chunk_size, dtype=np.uint8) for k in keys])
+    y_keys = np.repeat(np.array(keys, dtype=np.uint8), len(X) // len(keys))
+    y_texts = np.tile(helpers.chunkify(encoders.string_to_offset_array(plaintext), chunk_size, dtype=np.uint8), (len(keys), 1))
+    parts = [{"X": X[:25], "y_keys": y_keys[:25], "y_texts": y_texts[:25]}, {"X": X[25:], "y_keys": y_keys[25:], "y_texts": y_texts[25:]}]
+    counters = evaluate_parts(parts, scaler, key_model, text_model, batch_size=7)
+
+    scaled = helpers.scale_features(scaler, X).reshape((-1,) + tuple(key_model.input_shape[1:]))
+    best_keys = key_model.predict(scaled, verbose=0)[:, -1, 0].round().astype(int) % CUSTOM_LOSS_MODULO
+    best_texts = text_model.predict(scaled, verbose=0)[:, -1, :].round().astype(int) % CUSTOM_LOSS_MODULO
+    print(f"Streamed Key Accuracy: {np.isclose(counters['key'].get_accuracies()[-1], (best_keys == y_keys).mean())}")
+    print(f"Streamed Text Accuracy: {np.isclose(counters['text'].get_accuracies()[-1], (best_texts == y_texts).mean())}")
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        paths = [os.path.join(temp_dir, "table.png"), os.path.join(temp_dir, "graph.png")]
+        write_accuracy_table(get_results_table(counters), paths[0])
+        write_accuracy_graph(counters, paths[1])
+        print(f"Write Table And Graph: {all(os.path.getsize(p) > 0 for p in paths)}")
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the Caesar models against the test-only files, and write the accuracy table and graph.")
+    parser.add_argument("--store", action="store_true", help="Read chunks from the test-only feature store instead of the text files")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="How many chunks go through the models at once")
+    parser.add_argument("--key-model", default=models.CAESAR_KEY_MODEL_PATH)
+    parser.add_argument("--text-model", default=models.CAESAR_TEXT_MODEL_PATH)
+    parser.add_argument("--table", default=ACCURACY_TABLE_PATH, help="Where to write the accuracy table image")
+    parser.add_argument("--graph", default=ACCURACY_GRAPH_PATH, help="Where to write the accuracy graph image")
+    args = parser.parse_args()
+
+    key_model = models.load_model(args.key_model)
+    text_model = models.load_model(args.text_model)
+    chunk_size = int(np.prod(key_model.input_shape[1:]))
+    scaler = helpers.load_scaler_from_file(helpers.get_recommended_scaler_path(encoders.ENCODER_CAESAR, chunk_size, temp=False))
+
+    start_time = time.perf_counter()
+    parts = iter_test_parts(encoders.ENCODER_CAESAR, chunk_size, args.store)
+    counters = evaluate_parts(parts, scaler, key_model, text_model, args.batch_size)
+    print(f"Evaluated {counters['key'].chunk_count} chunks in {time.perf_counter() - start_time:.1f} seconds")
+
+    table = get_results_table(counters)
+    print(table)
+    write_accuracy_table(table, args.table)
+    write_accuracy_graph(counters, args.graph)
+    print(f"Wrote {args.table} and {args.graph}")
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ["--self-test"]:
+        self_test()
+    else:
+        main()
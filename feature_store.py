@@ -0,0 +1,396 @@
+# This file contains the feature store: precomputed chunks of ciphertext (features) and the matching
+# plaintext chunks and keys (targets), saved to disk so they don't have to be rebuilt from the text
+# files for every training or report run.
+#
+# There is one store per encoder, chunk size and test_only setting. Each store is a directory of
+# "shards", each shard being a few uint8 .npy files that can be memory-mapped, plus a manifest listing
+# which encrypted files are already in the store. Stores are built or updated from the top directory:
+#   python feature_store.py "Caesar Cipher" 256
+#   python feature_store.py "Caesar Cipher" 256 --test-only
+# Once a store exists, the librarian adds new encrypted files to it whenever it runs. Each update adds
+# a shard; small shards from recent updates get merged now and then (see compact_small_shards()).
+
+import os
+import sys
+import json
+import shutil
+import types
+import argparse
+import tempfile
+
+import numpy as np
+
+import encoders
+import helpers
+
+from constants import *
+
+MANIFEST_FILENAME = "manifest.json"
+
+# The arrays in each shard. All have one row per chunk:
+#   X:       ciphertext chunk, as offsets (chunk_size columns)
+#   y_keys:  the key, as offsets: one value for Caesar, len(CHARSET) columns for substitution
+#   y_texts: plaintext chunk, as offsets (chunk_size columns)
+#   ids:     source ID, encrypted file ID and key ID the chunk came from
+SHARD_ARRAYS = ["X", "y_keys", "y_texts", "ids"]
+ID_COLUMNS = ["source_id", "file_id", "key_id"]
+
+# A new shard is written whenever this many chunks have been collected, which limits memory use while building
+SHARD_MAX_ROWS = 500_000
+
+# Each update adds a shard. Once the small shards at the end of a store (together under SHARD_MAX_ROWS rows) number
+# more than this, they are merged into one, so the shard count stays down without rewriting the whole store.
+MAX_SMALL_SHARDS = 8
+
+# Get the directory for a feature store, with key info in the name
+def get_store_dir(encoder: str, chunk_size: int, test_only: bool, root: str = FEATURE_STORE_DIR) -> str:
+    split = "test" if test_only else "train"
+    return os.path.join(root, f'{encoder.replace(" ", "_")}_{chunk_size:06}_{split}')
+
+# Read a store's manifest, or return None if there is no store in the directory
+def read_manifest(store_dir: str) -> dict:
+    path = os.path.join(store_dir, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return None
+    return json.loads(helpers.read_text_file(path))
+
+# Write the manifest to a temporary file first, so a store is never left with a half-written manifest
+def _write_manifest(store_dir: str, manifest: dict):
+    path = os.path.join(store_dir, MANIFEST_FILENAME)
+    helpers.write_text_file(json.dumps(manifest, indent=1), path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def _new_manifest(encoder: str, chunk_size: int, test_only: bool) -> dict:
+    return {"encoder": encoder, "chunk_size": chunk_size, "test_only": test_only, "next_shard": 0, "shards": [],
+            "skipped_file_ids": []}
+
+def _shard_path(store_dir: str, shard_name: str, array_name: str) -> str:
+    return os.path.join(store_dir, f"{shard_name}_{array_name}.npy")
+
+# The key target for a chunk, as offsets: the shift itself for Caesar, the substitution alphabet otherwise
+def _key_target(encoder: str, key_value: str) -> np.ndarray:
+    if encoder == encoders.ENCODER_CAESAR:
+        return np.array(int(key_value), dtype=np.uint8)
+    elif encoder == encoders.ENCODER_SUBST:
+        return encoders.string_to_offset_array(key_value)
+    else:
+        raise Exception(f"Unsupported encoder {encoder}")
+
+# Write the collected chunks as a new shard and record it in the manifest.
+# Each array is written straight into a memory-mapped .npy file a part at a time, so the parts (which may
+# themselves be memory-mapped shards, when compacting) are never concatenated in memory.
+def _write_shard(store_dir: str, manifest: dict, parts: list[dict], file_ids: list[int]):
+    shard_name = f"shard_{manifest['next_shard']:05}"
+    row_count = sum(len(part["X"]) for part in parts)
+    for array_name in SHARD_ARRAYS:
+        first = parts[0][array_name]
+        array = np.lib.format.open_memmap(_shard_path(store_dir, shard_name, array_name), mode='w+',
+                                          dtype=first.dtype, shape=(row_count,) + first.shape[1:])
+        start = 0
+        for part in parts:
+            array[start : start + len(part[array_name])] = part[array_name]
+            start += len(part[array_name])
+        array.flush()
+        del array
+
+    manifest["next_shard"] += 1
+    manifest["shards"].append({"name": shard_name, "rows": row_count, "file_ids": file_ids})
+    _write_manifest(store_dir, manifest)
+
+# Read encrypted files and their plaintexts, yielding one tuple (file_id, part) per encrypted file, where
+# part maps each name in SHARD_ARRAYS to that file's chunks (one row per chunk).
+# Each entry in file_sets is a tuple (plaintext_path, ciphertexts), where ciphertexts is a list of
+# tuples (source_id, file_id, key_id, key_value, ciphertext_path) for that plaintext.
+# Files shorter than one chunk can't be used; for those, part is None.
+def iter_file_parts(encoder: str, chunk_size: int, file_sets: list[tuple]):
+    for plaintext_path, ciphertexts in file_sets:
+        plaintext_chunks = None
+        for source_id, file_id, key_id, key_value, ciphertext_path in ciphertexts:
+            ciphertext_offsets = encoders.string_to_offset_array(helpers.read_text_file(ciphertext_path))
+            if len(ciphertext_offsets) < chunk_size:
+                yield (file_id, None)
+                continue
+
+            if plaintext_chunks is None:
+                plaintext_offsets = encoders.string_to_offset_array(helpers.read_text_file(plaintext_path))
+                plaintext_chunks = helpers.chunkify(plaintext_offsets, chunk_size, dtype=np.uint8)
+
+            X = helpers.chunkify(ciphertext_offsets, chunk_size, dtype=np.uint8)
+            rows = len(X)
+            key_target = _key_target(encoder, key_value)
+            yield (file_id, {
+                "X": X,
+                "y_keys": np.broadcast_to(key_target, (rows,) + key_target.shape),
+                "y_texts": plaintext_chunks,
+                "ids": np.broadcast_to(np.array([source_id, file_id, key_id], dtype=np.int64), (rows, len(ID_COLUMNS))),
+            })
+
+# Add encrypted files to a store, creating the store if needed and writing new shards as needed.
+# file_sets is as described for iter_file_parts().
+# Files shorter than one chunk are skipped, and recorded as such. Returns the number of chunks added.
+def add_files_to_store(store_dir: str, encoder: str, chunk_size: int, test_only: bool, file_sets: list[tuple]) -> int:
+    manifest = read_manifest(store_dir)
+    if manifest is None:
+        manifest = _new_manifest(encoder, chunk_size, test_only)
+    os.makedirs(store_dir, exist_ok=True)
+
+    parts = []
+    file_ids = []
+    pending_rows = 0
+    total_rows = 0
+    skipped_count = 0
+    for file_id, part in iter_file_parts(encoder, chunk_size, file_sets):
+        if part is None:
+            manifest["skipped_file_ids"].append(file_id)
+            skipped_count += 1
+            continue
+
+        parts.append(part)
+        file_ids.append(file_id)
+        pending_rows += len(part["X"])
+
+        if pending_rows >= SHARD_MAX_ROWS:
+            _write_shard(store_dir, manifest, parts, file_ids)
+            total_rows += pending_rows
+            parts, file_ids, pending_rows = [], [], 0
+
+    if pending_rows > 0:
+        _write_shard(store_dir, manifest, parts, file_ids)
+        total_rows += pending_rows
+    else:
+        _write_manifest(store_dir, manifest)
+
+    if skipped_count > 0:
+        print(f"Skipped {skipped_count} files shorter than the chunk size ({chunk_size})")
+    return total_rows
+
+# Look up encrypted files in the database, grouped with their plaintexts as file sets for iter_file_parts().
+# Files with IDs in exclude_file_ids are left out.
+def get_file_sets(db, session, encoder: str, test_only: bool, exclude_file_ids: set = frozenset()) -> list[tuple]:
+    (encoder_ids, _) = db.get_id_maps(session)
+    (sid_to_p, sid_to_c) = db.get_source_maps(session, -1, encoder_ids[encoder], test_only=test_only)
+
+    new_files = {sid: [c for c in sid_to_c[sid] if c.id not in exclude_file_ids] for sid in sid_to_c}
+    key_values = db.get_key_values_by_ids(session, [c.key_id for sid in new_files for c in new_files[sid]])
+
+    file_sets = []
+    for sid in sorted(new_files):
+        if len(new_files[sid]) > 0:
+            file_sets.append((sid_to_p[sid].path,
+                [(sid, c.id, c.key_id, key_values[c.key_id], c.path) for c in new_files[sid]]))
+    return file_sets
+
+# Bring a store up to date with the database, adding any encrypted files it doesn't have yet.
+# The store is created if it doesn't exist. Returns the number of chunks added.
+def update_store(db, session, encoder: str, chunk_size: int, test_only: bool, root: str = FEATURE_STORE_DIR) -> int:
+    store_dir = get_store_dir(encoder, chunk_size, test_only, root)
+    manifest = read_manifest(store_dir)
+    stored_file_ids = set()
+    if manifest is not None:
+        stored_file_ids = {file_id for shard in manifest["shards"] for file_id in shard["file_ids"]}
+        stored_file_ids.update(manifest["skipped_file_ids"])
+
+    file_sets = get_file_sets(db, session, encoder, test_only, exclude_file_ids=stored_file_ids)
+    row_count = add_files_to_store(store_dir, encoder, chunk_size, test_only, file_sets)
+    compact_small_shards(store_dir)
+    return row_count
+
+# Update every store that already exists under the root directory. Returns the number of chunks added.
+def update_existing_stores(db, session, root: str = FEATURE_STORE_DIR) -> int:
+    if not os.path.isdir(root):
+        return 0
+
+    total_rows = 0
+    for name in sorted(os.listdir(root)):
+        manifest = read_manifest(os.path.join(root, name))
+        if manifest is not None:
+            total_rows += update_store(db, session, manifest["encoder"], manifest["chunk_size"], manifest["test_only"], root)
+    return total_rows
+
+# Get the store's shards as a list of maps from array name to array.
+# The arrays are memory-mapped read-only, so nothing is read until it is used.
+def load_shards(store_dir: str) -> list[dict]:
+    manifest = read_manifest(store_dir)
+    if manifest is None:
+        raise Exception(f"No feature store found in {store_dir}")
+
+    return [{array_name: np.load(_shard_path(store_dir, shard["name"], array_name), mmap_mode='r')
+             for array_name in SHARD_ARRAYS} for shard in manifest["shards"]]
+
+# Load features and targets from a store, much like DB.get_features_and_targets() but as uint8 arrays.
+# Returns a tuple: (X, y_keys, y_texts, ids), with y_keys and y_texts None if not wanted.
+# For a store with a single shard the arrays are memory-mapped, with no copying; if there are several,
+# they get concatenated in memory. To keep every shard memory-mapped, pass per_shard=True, which returns
+# a list of arrays (one per shard, from load_shards()) in place of each array. compact_store() merges the
+# shards into one.
+def load_features_and_targets(encoder: str, chunk_size: int, test_only: bool, want_keys = True, want_texts = True,
+                              root: str = FEATURE_STORE_DIR, per_shard: bool = False) -> tuple:
+    shards = load_shards(get_store_dir(encoder, chunk_size, test_only, root))
+    if len(shards) == 0:
+        raise Exception(f"Feature store for {encoder}, chunk size {chunk_size} is empty")
+
+    def get_array(array_name):
+        if per_shard:
+            return [shard[array_name] for shard in shards]
+        if len(shards) == 1:
+            return shards[0][array_name]
+        return np.concatenate([shard[array_name] for shard in shards])
+
+    return (get_array("X"),
+            get_array("y_keys") if want_keys else None,
+            get_array("y_texts") if want_texts else None,
+            get_array("ids"))
+
+# Merge the last count shards of a store into one new shard, at the end of the store.
+# The shards are copied through memory maps, so this doesn't need memory for all of them.
+def _merge_last_shards(store_dir: str, manifest: dict, count: int):
+    old_shards = manifest["shards"][-count:]
+    parts = load_shards(store_dir)[-count:]
+    file_ids = [file_id for shard in old_shards for file_id in shard["file_ids"]]
+
+    manifest["shards"] = manifest["shards"][:-count]
+    _write_shard(store_dir, manifest, parts, file_ids)
+    del parts
+
+    for shard in old_shards:
+        for array_name in SHARD_ARRAYS:
+            os.remove(_shard_path(store_dir, shard["name"], array_name))
+
+# Merge all of a store's shards into one, so it can be loaded with no copying.
+# This rewrites the whole store, so it is only done when asked for (see main()).
+def compact_store(store_dir: str):
+    manifest = read_manifest(store_dir)
+    if manifest is None or len(manifest["shards"]) <= 1:
+        return
+    _merge_last_shards(store_dir, manifest, len(manifest["shards"]))
+
+# Merge the small shards left at the end of a store by incremental updates, once there are more than
+# max_small_shards of them. Only shards that together have fewer than SHARD_MAX_ROWS rows are merged, so
+# the cost doesn't grow with the size of the store. Returns True if any shards were merged.
+def compact_small_shards(store_dir: str, max_small_shards: int = MAX_SMALL_SHARDS) -> bool:
+    manifest = read_manifest(store_dir)
+    if manifest is None:
+        return False
+
+    (count, rows) = (0, 0)
+    for shard in reversed(manifest["shards"]):
+        if rows + shard["rows"] >= SHARD_MAX_ROWS:
+            break
+        (count, rows) = (count + 1, rows + shard["rows"])
+
+    if count <= max(max_small_shards, 1):
+        return False
+    _merge_last_shards(store_dir, manifest, count)
+    return True
+
+def self_test():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        chunk_size = 7
+        plaintexts = [encoders.encode_simple("The quick brown fox jumps over the lazy dog. " * (i + 1)) for i in range(3)]
+        keys = [3, 17, 42]
+
+        # Write plaintexts and encrypted copies, as the librarian would
+        file_sets = []
+        file_id = 0
+        for source_id, plaintext in enumerate(plaintexts):
+            plaintext_path = os.path.join(temp_dir, f"plain_{source_id}.txt")
+            helpers.write_text_file(plaintext, plaintext_path)
+            ciphertexts = []
+            for key_id, key in enumerate(keys):
+                ciphertext_path = os.path.join(temp_dir, f"cipher_{source_id}_{key_id}.txt")
+                helpers.write_text_file(encoders.encode_caesar(plaintext, key), ciphertext_path)
+                ciphertexts.append((source_id, file_id, key_id, str(key), ciphertext_path))
+                file_id += 1
+            file_sets.append((plaintext_path, ciphertexts))
+
+        # Build in two steps, to check incremental updates
+        store_dir = get_store_dir(encoders.ENCODER_CAESAR, chunk_size, False, root=temp_dir)
+        add_files_to_store(store_dir, encoders.ENCODER_CAESAR, chunk_size, False, file_sets[:1])
+        add_files_to_store(store_dir, encoders.ENCODER_CAESAR, chunk_size, False, file_sets[1:])
+        print(f"Incremental Build: {len(read_manifest(store_dir)['shards']) == 2}")
+
+        # Compare with building the same data the way DB.get_features_and_targets() does
+        expected_X, expected_keys, expected_texts = [], [], []
+        for plaintext_path, ciphertexts in file_sets:
+            plaintext_chunks = helpers.chunkify(encoders.string_to_offsets(helpers.read_text_file(plaintext_path)), chunk_size)
+            for _, _, _, key_value, ciphertext_path in ciphertexts:
+                ciphertext_chunks = helpers.chunkify(encoders.string_to_offsets(helpers.read_text_file(ciphertext_path)), chunk_size)
+                expected_X += ciphertext_chunks
+                expected_texts += plaintext_chunks
+                expected_keys += [int(key_value)] * len(ciphertext_chunks)
+
+        def matches_expected(X, y_keys, y_texts):
+            return (X.dtype == np.uint8 and X.tolist() == expected_X and y_keys.tolist() == expected_keys
+                    and y_texts.tolist() == expected_texts)
+
+        (X, y_keys, y_texts, ids) = load_features_and_targets(encoders.ENCODER_CAESAR, chunk_size, False, root=temp_dir)
+        print(f"Load Sharded Store: {matches_expected(X, y_keys, y_texts) and len(ids) == len(expected_X)}")
+
+        compact_store(store_dir)
+        (X, y_keys, y_texts, ids) = load_features_and_targets(encoders.ENCODER_CAESAR, chunk_size, False, root=temp_dir)
+        print(f"Load Compacted Store: {matches_expected(X, y_keys, y_texts) and isinstance(X, np.memmap)}")
+        del X, y_keys, y_texts, ids
+
+        # Updating from the database, as the librarian does, adds a shard per update, without rewriting the store.
+        # This stands in for the few DB methods get_file_sets() uses, serving one more source each update.
+        class Test_DB(object):
+            source_count = 1
+            def get_id_maps(self, session):
+                return ({encoders.ENCODER_CAESAR: 0}, {})
+            def get_source_maps(self, session, limit, encoder_id, test_only):
+                sid_to_p = {sid: types.SimpleNamespace(path=file_sets[sid][0]) for sid in range(self.source_count)}
+                sid_to_c = {sid: [types.SimpleNamespace(id=c[1], key_id=c[2], path=c[4]) for c in file_sets[sid][1]]
+                            for sid in range(self.source_count)}
+                return (sid_to_p, sid_to_c)
+            def get_key_values_by_ids(self, session, key_ids):
+                return {key_id: str(keys[key_id]) for key_id in key_ids}
+
+        test_db = Test_DB()
+        update_root = os.path.join(temp_dir, "updated")
+        update_dir = get_store_dir(encoders.ENCODER_CAESAR, chunk_size, False, root=update_root)
+        first_shard_path = None
+        for source_count in range(1, len(file_sets) + 1):
+            test_db.source_count = source_count
+            update_store(test_db, None, encoders.ENCODER_CAESAR, chunk_size, False, root=update_root)
+            first_shard_path = first_shard_path or _shard_path(update_dir, read_manifest(update_dir)["shards"][0]["name"], "X")
+        (X, y_keys, y_texts, ids) = load_features_and_targets(encoders.ENCODER_CAESAR, chunk_size, False, root=update_root, per_shard=True)
+        print(f"Incremental Update: {len(X) == len(file_sets) and os.path.exists(first_shard_path) and all(isinstance(x, np.memmap) for x in X)}")
+        print(f"Load Store Per Shard: {matches_expected(np.concatenate(X), np.concatenate(y_keys), np.concatenate(y_texts))}")
+        del X, y_keys, y_texts, ids
+
+        # Small shards get merged once there are too many, leaving bigger shards alone
+        compact_small_shards(update_dir, max_small_shards=len(file_sets))
+        unmerged = len(read_manifest(update_dir)["shards"])
+        compact_small_shards(update_dir, max_small_shards=1)
+        (X, y_keys, y_texts, ids) = load_features_and_targets(encoders.ENCODER_CAESAR, chunk_size, False, root=update_root)
+        print(f"Compact Small Shards: {unmerged == len(file_sets) and len(read_manifest(update_dir)['shards']) == 1 and matches_expected(X, y_keys, y_texts)}")
+        del X, y_keys, y_texts, ids
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or update a feature store from the files in the database.")
+    parser.add_argument("encoder", choices=[encoders.ENCODER_CAESAR, encoders.ENCODER_SUBST])
+    parser.add_argument("chunk_size", type=int)
+    parser.add_argument("--test-only", action="store_true", help="Build from test-only files instead of training files")
+    parser.add_argument("--compact", action="store_true", help="Merge the store's shards into one after updating")
+    args = parser.parse_args()
+
+    import db_connect
+    from credentials import CONNECTION_INFO
+
+    db = db_connect.DB(CONNECTION_INFO)
+    with db.get_session() as session:
+        row_count = update_store(db, session, args.encoder, args.chunk_size, args.test_only)
+    print(f"Added {row_count} chunks")
+
+    if args.compact:
+        compact_store(get_store_dir(args.encoder, args.chunk_size, args.test_only))
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ["--self-test"]:
+        self_test()
+    else:
+        main()
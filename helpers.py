@@ -3,10 +3,21 @@
 import numpy as np
 import json
 import os
+import sys
+import copy
+import hashlib
+import shutil
+import tempfile
 
-from sklearn.preprocessing import StandardScaler
+import encoders
+
+from typing import TYPE_CHECKING
 from constants import *
 
+# scikit-learn takes a while to import, so it's only imported when a scaler is actually made
+if TYPE_CHECKING:
+    from sklearn.preprocessing import StandardScaler
+
 # Read a text file in the format needed for this project
 def read_text_file(path: str) -> str:
     with open(path, 'r', encoding='utf-8', newline='\n') as readable:
@@ -18,109 +29,304 @@ def write_text_file(text: str, path: str):
     with open(path, "w", encoding='utf-8', newline='\n') as text_file:
         text_file.write(text)
 
+# Read a text file a block at a time, yielding strings of up to block_size characters, so the whole
+# file never has to be in memory. Optionally limit to the characters in [start, end), where an end
+# of -1 means the end of the file.
+def read_text_blocks(path: str, block_size: int = STREAMING_BLOCK_SIZE, start: int = 0, end: int = -1):
+    with open(path, 'r', encoding='utf-8', newline='\n') as readable:
+        position = 0
+        while end == -1 or position < end:
+            block = readable.read(block_size)
+            if len(block) == 0:
+                break
+
+            block_start = position
+            position += len(block)
+            if position <= start:
+                continue
+
+            block_end = len(block) if end == -1 else end - block_start
+            yield block[max(0, start - block_start) : block_end]
+
+# Read just the first characters of a text file
+def read_text_head(path: str, length: int = STREAMING_BLOCK_SIZE) -> str:
+    return next(read_text_blocks(path, length), "")
+
+# Find a string in a text file without reading the whole file into memory.
+# Works like str.find(), returning the character offset of the first match at or after start, or -1.
+def find_in_text_file(path: str, needle: str, start: int = 0, block_size: int = STREAMING_BLOCK_SIZE) -> int:
+    # Keep the end of each block around, in case the match straddles two blocks
+    carry = ""
+    carry_start = start
+    for block in read_text_blocks(path, block_size, start):
+        window = carry + block
+        found = window.find(needle)
+        if found != -1:
+            return carry_start + found
+
+        keep = min(len(window), len(needle) - 1)
+        carry_start += len(window) - keep
+        carry = window[len(window) - keep:]
+
+    return -1
+
+# Simplify a raw text file into a new file, a block at a time, so memory use depends on the block
+# size rather than the file size. The result matches encoders.encode_simple() on the whole file.
+def simplify_text_file_streaming(raw_path: str, simplified_path: str, block_size: int = STREAMING_BLOCK_SIZE):
+    (start, end) = encoders.find_content_bounds(
+        lambda needle, from_offset: find_in_text_file(raw_path, needle, from_offset, block_size))
+
+    simplifier = encoders.StreamingSimplifier()
+    with open(simplified_path, "w", encoding='utf-8', newline='\n') as text_file:
+        for block in read_text_blocks(raw_path, block_size, start, end):
+            text_file.write(simplifier.feed(block))
+
+# Encrypt a plaintext file under several keys a block at a time, writing one output file per key.
+# Every block is decrypted again and checked against the plaintext.
+# func_encode_many and func_decode_many are the encoders.*_many functions for the cipher.
+def encrypt_text_file_streaming(plain_path: str, keys: list, encrypted_paths: list[str], func_encode_many, func_decode_many,
+                                block_size: int = STREAMING_BLOCK_SIZE):
+    text_files = [open(path, "w", encoding='utf-8', newline='\n') for path in encrypted_paths]
+    try:
+        for block in read_text_blocks(plain_path, block_size):
+            cipher_texts = func_encode_many(block, keys)
+            bad_rows = encoders.mismatched_rows(block, func_decode_many(cipher_texts, keys))
+            if len(bad_rows) > 0:
+                raise Exception(f'Decrypted text did not match plaintext in {plain_path}, key "{keys[bad_rows[0]]}"')
+
+            for text_file, cipher_codes in zip(text_files, cipher_texts):
+                text_file.write(encoders.codes_to_string(cipher_codes))
+    finally:
+        for text_file in text_files:
+            text_file.close()
+
+# Simplify a raw text file into a new file, either reading it whole or streaming it a block at a time.
+# Returns the size of the raw file in bytes. This only touches files, so it can run in a worker process.
+def simplify_text_file(raw_path: str, simplified_path: str, streaming: bool = False) -> int:
+    if streaming:
+        simplify_text_file_streaming(raw_path, simplified_path)
+    else:
+        write_text_file(encoders.encode_simple(read_text_file(raw_path)), simplified_path)
+    return os.path.getsize(raw_path)
+
+# Encrypt a plaintext file under several keys, writing one output file per key, either reading it whole
+# or streaming it a block at a time. Decryption is checked for every key.
+# Returns the size of the plaintext file in bytes. This only touches files, so it can run in a worker process.
+def encrypt_text_file(plain_path: str, keys: list, encrypted_paths: list[str], func_encode_many, func_decode_many,
+                      streaming: bool = False) -> int:
+    if streaming:
+        encrypt_text_file_streaming(plain_path, keys, encrypted_paths, func_encode_many, func_decode_many)
+    else:
+        plaintext = read_text_file(plain_path)
+        cipher_texts = func_encode_many(plaintext, keys)
+        bad_rows = encoders.mismatched_rows(plaintext, func_decode_many(cipher_texts, keys))
+        if len(bad_rows) > 0:
+            raise Exception(f'Decrypted text did not match plaintext in {plain_path}, key "{keys[bad_rows[0]]}"')
+
+        for encrypted_path, cipher_codes in zip(encrypted_paths, cipher_texts):
+            write_text_file(encoders.codes_to_string(cipher_codes), encrypted_path)
+    return os.path.getsize(plain_path)
+
+# Get the start position of every chunk, for chunkify()
+def _chunk_starts(length: int, chunk_size: int, stride: int, cover_end: bool) -> range:
+    starts = range(0, length - chunk_size + 1, stride)
+    if cover_end and (length - chunk_size) % stride != 0:
+        starts = list(starts) + [length - chunk_size]
+    return starts
+
 # Break a list of values into chunks.
-# If the length is not evenly divisible by chunk_size, the final chunk
-# will overlap the previous one so the whole thing gets converted.
-def chunkify(inputs: list, chunk_size: int) -> list[list]:
-    if len(inputs) < chunk_size:
-        raise Exception(f"Chunk size ({chunk_size}) must be no greater than input length ({len(inputs)})")
-
-    chunks = []
-
-    offset = 0
-    while offset < len(inputs):
-        if (offset + chunk_size >= len(inputs)):
-            offset = len(inputs) - chunk_size
-        
-        chunk = inputs[offset : offset + chunk_size]
-        chunks.append(chunk)
-
-        offset += chunk_size     
-        
-    return chunks
-
-# Convert a string to a list of lists of numbers, broken up into chunks.
+# Chunks start every stride values, which defaults to chunk_size (no overlap). A smaller stride gives
+# overlapping windows. If the chunks don't end exactly at the end of the input, the final chunk
+# will overlap the previous one so the whole thing gets converted, unless cover_end is False,
+# in which case the leftover values are dropped.
+#
+# If dtype is given, the chunks are returned as the rows of a 2D numpy array of that type,
+# e.g. np.uint8 for offsets, which is far more compact than lists or float arrays. If the input is
+# already an array of that type, the result is a read-only view of it, with no copying, except when
+# the final chunk has to be moved back to cover the end; that can't be expressed as a view, so
+# the chunks get copied. Use chunkify_view() to get the chunks without any copying.
+def chunkify(inputs: list, chunk_size: int, dtype = None, stride: int = None, cover_end: bool = True) -> list | np.ndarray:
+    if dtype is not None:
+        (chunks, tail) = chunkify_view(inputs, chunk_size, dtype, stride, cover_end)
+        if len(tail) > 0:
+            chunks = np.concatenate((chunks, tail))
+        return chunks
+
+    stride = _check_chunk_args(len(inputs), chunk_size, stride)
+    return [inputs[start : start + chunk_size] for start in _chunk_starts(len(inputs), chunk_size, stride, cover_end)]
+
+# Chunk values as chunkify() does with a dtype, but without copying anything if the input is already an array
+# of that type. Returns a tuple (chunks, tail) of read-only views of the input: chunks has every chunk starting
+# at a multiple of stride, and tail has the final chunk moved back to cover the end, if cover_end is True and
+# one is needed, or no rows otherwise. Together, they are the rows chunkify() would return.
+def chunkify_view(inputs, chunk_size: int, dtype, stride: int = None, cover_end: bool = True) -> tuple[np.ndarray, np.ndarray]:
+    stride = _check_chunk_args(len(inputs), chunk_size, stride)
+    values = np.asarray(inputs, dtype=dtype)
+    chunks = np.lib.stride_tricks.sliding_window_view(values, chunk_size)[::stride]
+    tail_start = len(values) - chunk_size
+    if cover_end and tail_start % stride != 0:
+        tail = np.lib.stride_tricks.sliding_window_view(values[tail_start:], chunk_size)
+    else:
+        tail = chunks[:0]
+    return (chunks, tail)
+
+# Check the arguments to chunkify(), returning the stride to use
+def _check_chunk_args(length: int, chunk_size: int, stride: int) -> int:
+    if length < chunk_size:
+        raise Exception(f"Chunk size ({chunk_size}) must be no greater than input length ({length})")
+    if stride is None:
+        stride = chunk_size
+    if stride < 1:
+        raise Exception(f"Stride ({stride}) must be at least 1")
+    return stride
+
+# Convert a string to a list of lists of numbers (the UTF-8 codes), broken up into chunks.
 # If the length is not evenly divisible by chunk_size, the final chunk
 # will overlap the previous one so the whole string gets converted.
-# !!! If I still need this function at all, leverage the chunkify(function)
 def string_to_bytes(text, chunk_size, array_out=True) -> list[list]:
-    if len(text) < chunk_size:
-        raise Exception(f"Chunk size ({chunk_size}) must be no greater than text length ({len(text)})")
-
-    chunks = []
-
-    offset = 0
-    while offset < len(text):
-        if (offset + chunk_size >= len(text)):
-            offset = len(text) - chunk_size
-        
-        # I'm sure there is a more optimal way to do this...
-        encoded = text[offset : offset + chunk_size].encode('UTF-8')
-        if array_out:
-            #!!! Describe / clean up how this make better data types for TF
-            numbered = np.array([float(b) for b in encoded])
-        else:
-            numbered = [b for b in encoded]
-
-        if len(encoded) != chunk_size or len(numbered) != chunk_size:
-            raise Exception(f"Conversion chunk size error: {len(text)}, {len(encoded)}, {len(numbered)}, {chunk_size}")
-        chunks.append(numbered)
-
-        offset += chunk_size     
-        
-    return chunks
-
-# Get a filename to use for saving scaler values, with key info in the name
+    encoded = np.frombuffer(text.encode('UTF-8'), dtype=np.uint8)
+    if len(encoded) != len(text):
+        raise Exception(f"Conversion chunk size error: {len(text)} characters, but {len(encoded)} bytes")
+
+    if array_out:
+        return list(chunkify(encoded, chunk_size, dtype=float))
+    else:
+        return chunkify(encoded.tolist(), chunk_size)
+
+# Get a filename to use for saving scaler values, with key info in the name.
+# Scalers are saved in the binary (.npz) format now; load_scaler_from_file() falls back on an
+# older .json file of the same name if there is no .npz file.
 def get_recommended_scaler_path(encoder:str, chunk_size: int, temp = True):
     where = TEMP_MODEL_DIR if temp else MODEL_DIR
 
-    filename = f'scaler_{encoder.replace(" ", "_")}_{chunk_size:06}.json'
+    filename = f'scaler_{encoder.replace(" ", "_")}_{chunk_size:06}.npz'
     
     return os.path.join(where, filename)
 
-# Write feature (input) scaler values to file, for later use with a StandardScaler
-def save_scaler_to_file(scaler: StandardScaler, filepath):
-    # Get the values as strings. This loses a tiny bit of information.
-    mean_str = np.array2string(scaler.mean_)
-    scale_str = np.array2string(scaler.scale_)
+# Fit a StandardScaler to features a batch of rows at a time, so compact (e.g. uint8) features
+# never have to be converted to float all at once.
+# Pass in a scaler to carry on fitting it with more features, e.g. when they're read a file at a time.
+SCALER_FIT_BATCH_ROWS = 65536
+
+def fit_scaler(X: np.ndarray, batch_rows: int = SCALER_FIT_BATCH_ROWS, scaler: 'StandardScaler' = None) -> 'StandardScaler':
+    if scaler is None:
+        from sklearn.preprocessing import StandardScaler
+        scaler = StandardScaler()
+    for start in range(0, len(X), batch_rows):
+        scaler.partial_fit(X[start : start + batch_rows])
+    return scaler
+
+# Scale features with a fitted scaler, like scaler.transform(), but straight from compact (e.g. uint8)
+# features into an array of dtype, without a float64 copy in between.
+# float32 is what the models use, so that is the default.
+def scale_features(scaler: 'StandardScaler', X: np.ndarray, dtype = np.float32) -> np.ndarray:
+    scaled = np.empty(np.shape(X), dtype=dtype)
+    np.subtract(X, scaler.mean_.astype(dtype), out=scaled)
+    np.divide(scaled, scaler.scale_.astype(dtype), out=scaled)
+    return scaled
+
+# Write feature (input) scaler values to file, for later use with a StandardScaler.
+# A .npz path gets the binary format, which keeps the values exactly. Any other path gets the older
+# JSON format, with every value written out in full.
+def save_scaler_to_file(scaler: 'StandardScaler', filepath):
+    if filepath.endswith(".npz"):
+        # Write to a temporary file first, so a cached copy of the old values can't be mistaken for the new
+        temp_path = filepath + ".tmp.npz"
+        np.savez(temp_path, mean_=scaler.mean_, scale_=scaler.scale_)
+        os.replace(temp_path, filepath)
+        return
+
+    # Get the values as strings, with enough digits to read back exactly, and no "..." for long arrays
+    mean_str = np.array2string(scaler.mean_, threshold=sys.maxsize, floatmode='unique')
+    scale_str = np.array2string(scaler.scale_, threshold=sys.maxsize, floatmode='unique')
 
     d = {"mean_": mean_str, "scale_": scale_str}
 
     # Write the values
     write_text_file(json.dumps(d), filepath)    
 
-# Create a StandardScaler instance from the values in a file
-def load_scaler_from_file(filepath) -> StandardScaler:
-    # Get the values out of the file
-    file_content = read_text_file(filepath)
-    d = json.loads(file_content)
+# Create a StandardScaler instance from the values in a file, in either format.
+# Scalers are cached (see load_file_cached()), but each call returns its own copy, so it can be refitted safely.
+def load_scaler_from_file(filepath) -> 'StandardScaler':
+    json_path = os.path.splitext(filepath)[0] + ".json"
+    if filepath.endswith(".npz") and not os.path.exists(filepath) and os.path.exists(json_path):
+        filepath = json_path
+
+    return copy.deepcopy(load_file_cached(filepath, _read_scaler_file))
 
-    mean_str = d["mean_"]
-    scale_str = d["scale_"]
+def _read_scaler_file(filepath) -> 'StandardScaler':
+    if filepath.endswith(".npz"):
+        with np.load(filepath) as arrays:
+            (mean_arr, scale_arr) = (arrays["mean_"], arrays["scale_"])
+    else:
+        # Get the values out of the file
+        file_content = read_text_file(filepath)
+        d = json.loads(file_content)
 
-    # Strip the brackets from the strings so, ironically, they can be read as arrays
-    mean_arr = np.fromstring(mean_str[1:-1], sep=' ', dtype=float)
-    scale_arr = np.fromstring(scale_str[1:-1], sep=' ', dtype=float)
+        mean_str = d["mean_"]
+        scale_str = d["scale_"]
+
+        # Strip the brackets from the strings so, ironically, they can be read as arrays
+        mean_arr = np.fromstring(mean_str[1:-1], sep=' ', dtype=float)
+        scale_arr = np.fromstring(scale_str[1:-1], sep=' ', dtype=float)
 
     # Set up a new scaler 
+    from sklearn.preprocessing import StandardScaler
     scaler = StandardScaler()
     scaler.mean_ = mean_arr
     scaler.scale_ = scale_arr
 
     return scaler
 
+# Things loaded from files (scalers, models) are kept here for the life of the process, keyed by
+# (path, modification time, load function), so loading the same file again is free unless it has changed.
+_file_cache = {}
+
+# Load a file with load_func(path), or return what it returned last time if the file hasn't changed since.
+# The cached object itself is returned, not a copy.
+def load_file_cached(path: str, load_func):
+    key = (os.path.abspath(path), os.stat(path).st_mtime_ns, load_func.__module__, load_func.__qualname__)
+    if key not in _file_cache:
+        # Anything loaded from an older version of the file is out of date now
+        for old_key in [k for k in _file_cache if k[0] == key[0] and k[2:] == key[2:]]:
+            del _file_cache[old_key]
+        _file_cache[key] = load_func(path)
+    return _file_cache[key]
+
+def clear_file_cache():
+    _file_cache.clear()
+
+# Check simplification of every intake file against the hashes in the golden file.
+# Returns a list of filenames whose simplified text does not match.
+SIMPLIFIED_GOLDEN_PATH = os.path.join(DATA_DIR, "simplified_golden.json")
+# If temp_path is given, the files are simplified in streaming mode via that file, with a small block size.
+def check_simplified_golden(golden_path: str = SIMPLIFIED_GOLDEN_PATH, intake_dir: str = DATA_INTAKE_DIR, temp_path: str = None) -> list[str]:
+    golden = json.loads(read_text_file(golden_path))
+
+    mismatches = []
+    for filename in sorted(golden):
+        intake_path = os.path.join(intake_dir, filename)
+        if temp_path is None:
+            simplified = encoders.encode_simple(read_text_file(intake_path))
+        else:
+            simplify_text_file_streaming(intake_path, temp_path, block_size=4093)
+            simplified = read_text_file(temp_path)
+        if hashlib.sha256(simplified.encode('utf-8')).hexdigest() != golden[filename]:
+            mismatches.append(filename)
+    return mismatches
+
 # Compare two strings and return basic accuracy info.
 # Returns a tuple (good_count, bad_count, total_count, good_percent)
 def good_bad_string_match(str_a: str, str_b: str) -> tuple[int, int, int, float]:
     if len(str_a) != len(str_b):
         raise Exception(f"String must be equal length. {len(str_a)} != {len(str_b)}")
 
-    # Let numpy do the work
-    arr_a = np.array(list(str_a))
-    arr_b = np.array(list(str_b))
-    matches = (arr_a == arr_b)
-    
-    good = matches.astype(int).sum()
+    # Let numpy do the work, comparing fixed-width character codes rather than building arrays of
+    # one-character strings
+    arr_a = np.frombuffer(str_a.encode('utf-32-le'), dtype=np.uint32)
+    arr_b = np.frombuffer(str_b.encode('utf-32-le'), dtype=np.uint32)
+
+    good = int(np.count_nonzero(arr_a == arr_b))
     bad = len(str_a) - good
     total = good+bad
     
@@ -143,8 +349,81 @@ def self_test():
     chunks = chunkify(TEST_VALS, TEST_CHUNK_SIZE)
     print(f"Chunkify Values: {chunks == GOOD_VAL_CHUNKS}")
 
+    chunks = chunkify(TEST_VALS[:7], TEST_CHUNK_SIZE, dtype=np.uint8)
+    print(f"Chunkify Array: {chunks.dtype == np.uint8 and chunks.tolist() == chunkify(TEST_VALS[:7], TEST_CHUNK_SIZE)}")
+
+    values = np.array(TEST_VALS, dtype=np.uint8)
+    chunks = chunkify(values, 4, dtype=np.uint8, stride=2)
+    print(f"Chunkify Overlapping View: {chunks.tolist() == [[0,1,2,3], [2,3,4,5], [4,5,6,7]] and np.shares_memory(chunks, values)}")
+    print(f"Chunkify Overlapping List: {chunkify(TEST_VALS[:7], 4, stride=2) == [[0,1,2,3], [2,3,4,5], [3,4,5,6]]}")
+    (view, tail) = chunkify_view(values[:7], 2, dtype=np.uint8)
+    print(f"Chunkify View: {np.concatenate((view, tail)).tolist() == chunkify(TEST_VALS[:7], 2) and np.shares_memory(view, values) and np.shares_memory(tail, values)}")
+    (view, tail) = chunkify_view(values, 2, dtype=np.uint8)
+    print(f"Chunkify View Aligned: {view.tolist() == GOOD_VAL_CHUNKS and tail.shape == (0, 2)}")
+    print(f"Chunkify Without Cover End: {chunkify(TEST_VALS[:7], 2, dtype=np.uint8, cover_end=False).tolist() == GOOD_VAL_CHUNKS[:3]}")
+
+    print(f"Good Bad String Match: {good_bad_string_match('ABCé', 'ABDé') == (3, 1, 4, 0.75)}")
+
+    print(f"String To Bytes: {[list(c) for c in string_to_bytes('ABCDE', 2)] == [[65.0, 66.0], [67.0, 68.0], [68.0, 69.0]]}")
+
+    features = np.random.randint(0, OUTPUT_MAX + 1, size=(1000, 16), dtype=np.uint8)
+    scaler = fit_scaler(features, batch_rows=300)
+    from sklearn.preprocessing import StandardScaler
+    expected = StandardScaler().fit(features).transform(features)
+    scaled = scale_features(scaler, features)
+    print(f"Compact Scaling: {scaled.dtype == np.float32 and np.allclose(scaled, expected, atol=1e-5)}")
+
     scaler_str = get_recommended_scaler_path("foo bar", 123)
     print(f'Scaler Path: {("foo_bar" in scaler_str) and ("123" in scaler_str)}')
 
+    # Long scalers used to get truncated with "..." in JSON, and lose precision
+    scaler = fit_scaler(np.random.randint(0, OUTPUT_MAX + 1, size=(100, 1500), dtype=np.uint8))
+    scaler_dir = tempfile.mkdtemp()
+    scalers_match = True
+    for filename in ["scaler.npz", "scaler.json"]:
+        save_scaler_to_file(scaler, os.path.join(scaler_dir, filename))
+        loaded = load_scaler_from_file(os.path.join(scaler_dir, filename))
+        scalers_match &= np.array_equal(loaded.mean_, scaler.mean_) and np.array_equal(loaded.scale_, scaler.scale_)
+    print(f"Save And Load Scaler: {scalers_match}")
+
+    old_format_path = os.path.join(scaler_dir, "old.json")
+    save_scaler_to_file(scaler, old_format_path)
+    loaded = load_scaler_from_file(os.path.join(scaler_dir, "old.npz"))
+    print(f"Load Older Scaler Format: {np.array_equal(loaded.mean_, scaler.mean_)}")
+
+    loaded.mean_ = loaded.mean_ + 1
+    reloaded = load_scaler_from_file(old_format_path)
+    print(f"Scaler Cache: {np.array_equal(reloaded.mean_, scaler.mean_) and len(_file_cache) == 3}")
+
+    scaler.mean_ = scaler.mean_ + 2
+    save_scaler_to_file(scaler, os.path.join(scaler_dir, "scaler.npz"))
+    os.utime(os.path.join(scaler_dir, "scaler.npz"), ns=(0, 0))
+    print(f"Scaler Cache Reload: {np.array_equal(load_scaler_from_file(os.path.join(scaler_dir, 'scaler.npz')).mean_, scaler.mean_)}")
+    shutil.rmtree(scaler_dir)
+
+    blocks = list(read_text_blocks(SIMPLIFIED_GOLDEN_PATH, 7, start=3, end=40))
+    whole = read_text_file(SIMPLIFIED_GOLDEN_PATH)
+    print(f"Read Text Blocks: {''.join(blocks) == whole[3:40] and max(len(b) for b in blocks) <= 7}")
+
+    marker = whole[100:120]
+    print(f"Find In Text File: {find_in_text_file(SIMPLIFIED_GOLDEN_PATH, marker, block_size=16) == whole.find(marker)}")
+    print(f"Find In Text File (missing): {find_in_text_file(SIMPLIFIED_GOLDEN_PATH, 'not in there', block_size=16) == -1}")
+
+    mismatches = check_simplified_golden()
+    print(f"Simplification Golden File: {len(mismatches) == 0} {mismatches if mismatches else ''}")
+
+    temp_path = os.path.join(tempfile.mkdtemp(), "simplified.txt")
+    mismatches = check_simplified_golden(temp_path=temp_path)
+    print(f"Streaming Simplification Golden File: {len(mismatches) == 0} {mismatches if mismatches else ''}")
+
+    plain_path = os.path.join(os.path.dirname(temp_path), "plain.txt")
+    encrypted_paths = [os.path.join(os.path.dirname(temp_path), f"encrypted_{i}.txt") for i in range(2)]
+    write_text_file(read_text_file(temp_path)[:100000], plain_path)
+    keys = [3, 17]
+    encrypt_text_file_streaming(plain_path, keys, encrypted_paths, encoders.encode_caesar_many, encoders.decode_caesar_many, block_size=999)
+    plaintext = read_text_file(plain_path)
+    print(f"Streaming Encryption: {all(read_text_file(p) == encoders.encode_caesar(plaintext, k) for p, k in zip(encrypted_paths, keys))}")
+    shutil.rmtree(os.path.dirname(temp_path))
+
 if __name__ == '__main__':
     self_test()
\ No newline at end of file
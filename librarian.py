@@ -2,12 +2,16 @@ import os
 import shutil
 import re # for regex
 import random
+import argparse
+import time
+import concurrent.futures
 
 import encoders
 import db_connect
 import helpers
+import feature_store
+import ngram_index
 
-from credentials import CONNECTION_INFO
 from constants import *
 
 # During development, it's very helpful to be able to run the full librarian even
@@ -22,8 +26,18 @@ ENCRYPTIONS_PER_SOURCE = min(5, int(len(encoders.CHARSET) * 2 // 3))
 # That flag is propogated to encoded files based on each source.
 SOURCE_TEST_ONLY_CHANCE = 0.10
 
-# Database access wrapper
-db = db_connect.DB(CONNECTION_INFO)
+# Files at least this big (in bytes) are processed in streaming mode, a block at a time, so memory use
+# depends on STREAMING_BLOCK_SIZE rather than the file size. Streaming can be forced for every file
+# with the --stream command line option.
+STREAMING_MIN_FILE_SIZE = 64 * 1024 * 1024
+STREAM_ALL_FILES = False
+
+# When simplifying and encrypting, finished files are added to the database in batches of this size
+DB_WRITE_BATCH_SIZE = 100
+
+# Database access wrapper. It's created in prep_db(), not when this file is imported, so importing
+# the librarian for its settings doesn't need the database or credentials.
+db = None
 
 # Database IDs, name: ID
 encoder_ids= {}
@@ -45,18 +59,25 @@ def prep_dirs():
     make_dir_if_not_exist(DATA_ENCODED_DIR)
 
 
+# Whether to process a file in streaming mode
+def use_streaming(path) -> bool:
+    return STREAM_ALL_FILES or os.path.getsize(path) >= STREAMING_MIN_FILE_SIZE
+
 # Initialize database content, adding encoder and key types if needed,
 # and getting their ID numbers. Also initializes the SQL Alchemy engine object
 # and tables references by auto-mapping.
 def prep_db():
+    global db
+    from credentials import CONNECTION_INFO
+    db = db_connect.DB(CONNECTION_INFO)
+
     # Get database IDs for encoders and key types, adding them to the db if needed
     with db.get_session() as session:
         for encoder in encoders.ALL_ENCODER_NAMES:
             id = db.get_encoder_id(session, encoder)
             if (id == -1):
                 print(f'Adding encoder "{encoder}" to database')
-                db.add_encoder(session, encoder)
-                id = db.get_encoder_id(session, encoder)
+                id = db.add_encoder(session, encoder)
 
             encoder_ids[encoder] = id
 
@@ -66,8 +87,7 @@ def prep_db():
             id = db.get_key_type_id(session, key_type)
             if (id == -1):
                 print(f'Adding key type "{key_type}" to database')
-                db.add_key_type(session, key_type)
-                id = db.get_key_type_id(session, key_type)
+                id = db.add_key_type(session, key_type)
 
             key_type_ids[key_type] = id
 
@@ -96,18 +116,25 @@ def process_intake(dir_path = DATA_INTAKE_DIR):
         print(f"{file}:")
         intake_path = os.path.join(dir_path, file)
 
-        # Read the whole file as a string
-        content = helpers.read_text_file(intake_path)
+        if use_streaming(intake_path):
+            # The title and ID are near the top, so only read the first block.
+            # The markers could be anywhere, so search for them a block at a time.
+            content = helpers.read_text_head(intake_path)
+            contains = lambda marker: helpers.find_in_text_file(intake_path, marker) != -1
+        else:
+            # Read the whole file as a string
+            content = helpers.read_text_file(intake_path)
+            contains = lambda marker: marker in content
 
         # Check that the contents look right. If not, print a message and move on to the next file.
         if not encoders.PG_FIRST_LINE_START in content:
             # It would be nice to use content.startswith(), but there can be extra unprintable bytes
             print("WARNING: Does not contain the expected first line")
             continue
-        if not encoders.PG_START_CONTENT in content:
+        if not contains(encoders.PG_START_CONTENT):
             print("WARNING: Does not contain the introductory boilerplate marker")
             continue
-        if not encoders.PG_END_CONTENT in content:
+        if not contains(encoders.PG_END_CONTENT):
             print("WARNING: Does not contain the closing boilerplate marker")
             continue
 
@@ -147,8 +174,7 @@ def process_intake(dir_path = DATA_INTAKE_DIR):
                 print(f"test_only: {test_only}")
 
                 print(f'Adding source "{title}" to database')
-                db.add_source(session, title, url, test_only)
-                source_id = db.get_source_id_by_title(session, title)
+                source_id = db.add_source(session, title, url, test_only)
             else:
                 print("Title is already in the database")
                 if ABORT_ON_DB_POPULATED:
@@ -175,12 +201,51 @@ def process_intake(dir_path = DATA_INTAKE_DIR):
                     continue
 
 
-# Simplify any raw files that need it
-def simplify_raw_files():
+# Run func(*args) for each entry in job_args, yielding (job index, result) as each one finishes.
+# With more than one worker the jobs are spread across a process pool, otherwise they just run
+# here, in order. Either way, the caller stays the only one talking to the database.
+def run_jobs(func, job_args: list[tuple], workers: int):
+    if workers <= 1:
+        for i, args in enumerate(job_args):
+            yield (i, func(*args))
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(func, *args): i for i, args in enumerate(job_args)}
+        for future in concurrent.futures.as_completed(futures):
+            yield (futures[future], future.result())
+
+# Add file rows to the database, then empty the list.
+# Each row is a tuple of add_file() parameters: (source_id, encoder_id, key_id, path, test_only)
+def flush_file_rows(session, rows: list[tuple]):
+    if len(rows) > 0:
+        print(f"Adding {len(rows)} files to database")
+        db.add_files(session, rows)
+    rows.clear()
+
+# Print how long a stage took, and its throughput if known, in bytes or characters
+def report_stage(name: str, elapsed_seconds: float, file_count: int = None, byte_count: int = None, char_count: int = None):
+    message = f"Stage {name}: {elapsed_seconds:.2f} seconds"
+    if file_count is not None:
+        message += f", {file_count} files"
+    if byte_count is not None:
+        mb = byte_count / 1e6
+        message += f", {mb:.2f} MB ({mb / max(elapsed_seconds, 1e-9):.2f} MB/s)"
+    if char_count is not None:
+        millions = char_count / 1e6
+        message += f", {millions:.2f}M characters ({millions / max(elapsed_seconds, 1e-9):.2f}M characters/s)"
+    print(message)
+
+
+# Simplify any raw files that need it.
+# Returns a tuple (file_count, byte_count) describing the raw files that got simplified.
+def simplify_raw_files(workers = 1) -> tuple[int, int]:
     with db.get_session() as session:
         # Get all raw files
         files = db.get_files_by_source_and_encoder(session, -1, encoder_ids[encoders.ENCODER_NONE])
 
+        # Figure out which files need simplifying. Each job is (source_id, raw_path, simplified_path, test_only).
+        jobs = []
         for rawfile in files:
             print(f"Raw file ID {rawfile.id}")
 
@@ -191,61 +256,81 @@ def simplify_raw_files():
                 if ABORT_ON_DB_POPULATED:
                     continue
 
-            # Read the whole file as a string
-            raw = helpers.read_text_file(rawfile.path)
-
-            # Simplify it
-            print("Simplifying")
-            simplified = encoders.encode_simple(raw)
-
             # Retain the original filename for easier reference
             filename = os.path.basename(rawfile.path)
-
-            # Add the simplified file to the database
-            print("Adding simplified file to database")
             simplified_path = os.path.join(DATA_SIMPLIFIED_DIR, filename)
-            db.add_file(session, rawfile.source_id, encoder_ids[encoders.ENCODER_SIMPLIFIER], None, simplified_path, rawfile.test_only)
+            jobs.append((rawfile.source_id, rawfile.path, simplified_path, rawfile.test_only))
+
+        # Simplify them, saving to the simplified data directory. The database gets updated in batches
+        # as files are finished.
+        print(f"Simplifying {len(jobs)} files with {workers} worker(s)")
+        job_args = [(raw_path, simplified_path, use_streaming(raw_path)) for (_, raw_path, simplified_path, _) in jobs]
+        pending_rows = []
+        byte_count = 0
+        for i, raw_size in run_jobs(helpers.simplify_text_file, job_args, workers):
+            (source_id, raw_path, simplified_path, test_only) = jobs[i]
+            print(f"Simplified {raw_path} -> {simplified_path}")
+            byte_count += raw_size
+
+            pending_rows.append((source_id, encoder_ids[encoders.ENCODER_SIMPLIFIER], None, simplified_path, test_only))
+            if len(pending_rows) >= DB_WRITE_BATCH_SIZE:
+                flush_file_rows(session, pending_rows)
+        flush_file_rows(session, pending_rows)
+
+        return (len(jobs), byte_count)
+
+# Add any simplified files that haven't been counted yet to the n-gram index.
+# Returns a tuple (file_count, char_count) describing the files that got counted.
+def index_simple_files(workers = 1) -> tuple[int, int]:
+    with db.get_session() as session:
+        files = db.get_files_by_source_and_encoder(session, -1, encoder_ids[encoders.ENCODER_SIMPLIFIER])
 
-            # Save to the simplified data directory
-            print(f"Saving to {simplified_path}")
-            helpers.write_text_file(simplified, simplified_path)
+    print(f"Counting n-grams in new simplified files with {workers} worker(s)")
+    return ngram_index.update_index([f.path for f in files], workers=workers)
 
-def encrypt_simple_files():      
+# Encrypt any simplified files that need it, with each available cipher.
+# Returns a tuple (file_count, byte_count) describing the plaintext files that got encrypted,
+# counting each file once per cipher.
+def encrypt_simple_files(workers = 1) -> tuple[int, int]:
     with db.get_session() as session:
         # Get all simplified (plaintext) files
         files = db.get_files_by_source_and_encoder(session, -1, encoder_ids[encoders.ENCODER_SIMPLIFIER])
+        plainfiles = [(f.id, f.source_id, f.path, f.test_only) for f in files]
 
-        for plainfile in files:
-            print(f"Plaintext file ID {plainfile.id}")
+        # Figure out what needs encrypting, and with which keys.
+        # Each job is (source_id, encoder_id, key_ids, encrypted_paths, test_only), lining up with job_args.
+        jobs = []
+        job_args = []
+        for (plainfile_id, source_id, plain_path, test_only) in plainfiles:
+            print(f"Plaintext file ID {plainfile_id}")
 
             for cipher_name in encoders.AVAILABLE_CIPHERS:
                 if cipher_name == encoders.ENCODER_CAESAR:
                     key_type_id = key_type_ids[encoders.KEY_NAME_CAESAR]
                     func_get_key = encoders.get_key_caesar
-                    func_encode = encoders.encode_caesar
-                    func_decode = encoders.decode_caesar
+                    func_encode_many = encoders.encode_caesar_many
+                    func_decode_many = encoders.decode_caesar_many
                 elif cipher_name == encoders.ENCODER_SUBST:
                     key_type_id = key_type_ids[encoders.KEY_NAME_SUBST]
                     func_get_key = encoders.get_key_substitution
-                    func_encode = encoders.encode_substitution
-                    func_decode = encoders.decode_substitution
+                    func_encode_many = encoders.encode_substitution_many
+                    func_decode_many = encoders.decode_substitution_many
                 else:
                     raise Exception(f"Unknown cipher {cipher_name}")
 
                 # Check whether we've already encrypted this file with this cipher
                 encoder_id = encoder_ids[cipher_name]
-                encrypted_files = db.get_files_by_source_and_encoder(session, plainfile.source_id, encoder_id)
+                encrypted_files = db.get_files_by_source_and_encoder(session, source_id, encoder_id)
                 if len(encrypted_files) >= ENCRYPTIONS_PER_SOURCE:
                     print(f'File already encrypted with "{cipher_name}" {len(encrypted_files)} times (max {ENCRYPTIONS_PER_SOURCE})')
                     if ABORT_ON_DB_POPULATED:
                         continue
                 times_to_encrypt = ENCRYPTIONS_PER_SOURCE - len(encrypted_files)
-
-                # Read the whole file as a string
-                plaintext = helpers.read_text_file(plainfile.path)
+                if times_to_encrypt < 1:
+                    continue
 
                 # We're going to encrypt multiple times, and each time we should use a different key,
-                # so we need to track which ones we've used.
+                # so pick all the keys up front.
                 keys_used = []
                 for i in range(times_to_encrypt):
                     # Find a key we haven't used yet for this file
@@ -257,41 +342,82 @@ def encrypt_simple_files():
                             print(f"Key {key} already used -- try again")
                     keys_used.append(key)
 
-                    # Encrypt it, and make sure decryption works
-                    print(f"Encrypting with {cipher_name}")
-                    cipher_text = func_encode(plaintext, key)
-                    deciphered_text = func_decode(cipher_text, key)
-
-                    if deciphered_text != plaintext:
-                        raise Exception(f'Decrypted text did not match plaintext for cipher "{cipher_name}", key "{key}"')                
-
-                    # Add the key to the database, or just get its ID if it's already there
-                    # (there's only so many possible keys, espescially for simpler ciphers)
-                    key_id = db.get_key_id_by_type_and_value(session, key_type_id, str(key))
-                    if key_id == -1:
-                        print("Adding key to database")
-                        db.add_key(session, key_type_id, str(key))
-                        key_id = db.get_key_id_by_type_and_value(session, key_type_id, str(key))
-                    print(f"Key ID {key_id}")
-
-                    # Pick a filename based on database IDs for source, encoder, and key
-                    filename = f"{plainfile.source_id:08}_{encoder_id:08}_{key_id:08}.txt"
-                    encrypted_path = os.path.join(DATA_ENCODED_DIR, filename)
+                # Add the keys to the database, or just get their IDs if they're already there
+                # (there's only so many possible keys, espescially for simpler ciphers)
+                key_values = [str(key) for key in keys_used]
+                key_value_to_id = db.get_key_ids_by_type_and_values(session, key_type_id, key_values)
+                new_key_values = [value for value in key_values if value not in key_value_to_id]
+                if len(new_key_values) > 0:
+                    print(f"Adding {len(new_key_values)} keys to database")
+                    key_value_to_id.update(zip(new_key_values, db.add_keys(session, key_type_id, new_key_values)))
+                key_ids = [key_value_to_id[value] for value in key_values]
+                print(f"Key IDs {key_ids}")
+
+                # Pick filenames based on database IDs for source, encoder, and key
+                encrypted_paths = []
+                for key_id in key_ids:
+                    filename = f"{source_id:08}_{encoder_id:08}_{key_id:08}.txt"
+                    encrypted_paths.append(os.path.join(DATA_ENCODED_DIR, filename))
+
+                jobs.append((source_id, encoder_id, key_ids, encrypted_paths, test_only))
+                job_args.append((plain_path, keys_used, encrypted_paths, func_encode_many, func_decode_many, use_streaming(plain_path)))
+
+        # Encrypt with all the keys for each file at once, making sure decryption works for every one of them,
+        # and save to the encrypted data directory. The database gets updated in batches as files are finished.
+        print(f"Encrypting {len(jobs)} file/cipher combinations with {workers} worker(s)")
+        pending_rows = []
+        byte_count = 0
+        for i, plain_size in run_jobs(helpers.encrypt_text_file, job_args, workers):
+            (source_id, encoder_id, key_ids, encrypted_paths, test_only) = jobs[i]
+            print(f"Encrypted {job_args[i][0]} -> {', '.join(encrypted_paths)}")
+            byte_count += plain_size
+
+            for key_id, encrypted_path in zip(key_ids, encrypted_paths):
+                pending_rows.append((source_id, encoder_id, key_id, encrypted_path, test_only))
+            if len(pending_rows) >= DB_WRITE_BATCH_SIZE:
+                flush_file_rows(session, pending_rows)
+        flush_file_rows(session, pending_rows)
+
+        return (len(jobs), byte_count)
 
-                    # Add the simplified file to the database
-                    print("Adding encrypted file to database")
-                    db.add_file(session, plainfile.source_id, encoder_id, key_id, encrypted_path, plainfile.test_only)
+def main():
+    global STREAM_ALL_FILES
 
-                    # Save to the encrypted data directory 
-                    print(f"Saving to {encrypted_path}")
-                    helpers.write_text_file(cipher_text, encrypted_path)
+    parser = argparse.ArgumentParser(description="Take in, simplify, and encrypt text files, populating the database")
+    parser.add_argument("--stream", action="store_true",
+                        help=f"process every file a block at a time (files of {STREAMING_MIN_FILE_SIZE} bytes or more always are)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes to use for simplification, n-gram counting and encryption (default 1)")
+    args = parser.parse_args()
+    STREAM_ALL_FILES = args.stream
 
-def main():
     prep_dirs()
     prep_db()
+
+    start_time = time.perf_counter()
     process_intake()
-    simplify_raw_files()
-    encrypt_simple_files()
+    report_stage("intake", time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    (file_count, byte_count) = simplify_raw_files(args.workers)
+    report_stage("simplify", time.perf_counter() - start_time, file_count, byte_count)
+
+    start_time = time.perf_counter()
+    (file_count, char_count) = index_simple_files(args.workers)
+    report_stage("ngrams", time.perf_counter() - start_time, file_count, char_count=char_count)
+
+    start_time = time.perf_counter()
+    (file_count, byte_count) = encrypt_simple_files(args.workers)
+    report_stage("encrypt", time.perf_counter() - start_time, file_count, byte_count)
+
+    # Add the new files to any feature stores that have been built
+    start_time = time.perf_counter()
+    with db.get_session() as session:
+        chunk_count = feature_store.update_existing_stores(db, session)
+    report_stage(f"features ({chunk_count} chunks)", time.perf_counter() - start_time)
+
+    for name, stats in db.get_cache_stats().items():
+        print(f"Cache {name}: {stats['hits']} hits, {stats['misses']} misses, {stats['size']} entries")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,10 +1,38 @@
-# This file contains a class to encapsulate creation of models during tuning
+# This file contains a class to encapsulate creation of models during tuning, and a runner that
+# spreads a Hyperband search over several local processes.
+#
+# To resume an interrupted parallel search from the command line (the notebook calls run_parallel_search()):
+#   python model_tuner.py tuner_projects/KT --workers 4
 
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
 import tensorflow as tf
+import keras_tuner as kt
 
 import constants
+import helpers
 import tf_helpers
 
+# Files kept in a parallel search's project directory, next to keras-tuner's own oracle and trial files
+TUNING_CONFIG_FILENAME = "tuning_config.json"
+TUNING_DATA_DIRNAME = "tuning_data"
+TUNING_LOG_DIRNAME = "logs"
+
+# The chief process serves the oracle to the worker processes on this port
+DEFAULT_ORACLE_PORT = 8000
+
+# Trials are stopped early if the validation modulo distance accuracy hasn't beaten PRUNE_BASELINE after
+# PRUNE_PATIENCE epochs. Guessing keys at random scores 0.5. Without the custom metrics, trials are stopped
+# once the validation loss hasn't improved for PRUNE_PATIENCE epochs.
+PRUNE_PATIENCE = 2
+PRUNE_BASELINE = 0.55
+
 class ModelTuner(object):
     # Initialize choice lists as empty. These should be populated by the top-level code.
     def __init__(self, input_shape, output_size, chunk_size, batch_size):
@@ -19,6 +47,18 @@ class ModelTuner(object):
         self.CHOICES_USE_OUTPUT_LIMITER = []
         self.CHOICES_OPTIMIZER = []
 
+    # Returns the settings and choice lists as a dict that can be saved as JSON, for from_config()
+    def get_config(self) -> dict:
+        return dict(vars(self))
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'ModelTuner':
+        model_tuner = cls(tuple(config["INPUT_SHAPE"]), config["OUTPUT_SIZE"], config["CHUNK_SIZE"], config["BATCH_SIZE"])
+        for name, value in config.items():
+            setattr(model_tuner, name, value)
+        model_tuner.INPUT_SHAPE = tuple(model_tuner.INPUT_SHAPE)
+        return model_tuner
+
     # Choose activation and recurrent activation for an RNN layer (actually just GRU and LSTM use them),
     # respecting that choosing might be turned off, in which case it defaults to (tanh, sigmoid)
     def _GetRNNActivations(self, label: str, hp) -> tuple[str, str]:
@@ -93,4 +133,180 @@ class ModelTuner(object):
             metrics = "mae"
         model.compile(loss=loss, optimizer=optimizer, metrics=metrics)
         
-        return model        
\ No newline at end of file
+        return model        
+
+
+# Save the training and test data for a parallel search, once, so every process loads the same data.
+# The data is kept as uint8 offsets, reshaped for the model, and scaled inside each process's dataset.
+def save_tuning_data(project_dir: str, scaler, X_train: np.ndarray, y_train: np.ndarray, X_test: np.ndarray, y_test: np.ndarray):
+    data_dir = os.path.join(project_dir, TUNING_DATA_DIRNAME)
+    os.makedirs(data_dir, exist_ok=True)
+    for name, array in [("X_train", X_train), ("y_train", y_train), ("X_test", X_test), ("y_test", y_test)]:
+        np.save(os.path.join(data_dir, f"{name}.npy"), np.asarray(array, dtype=np.uint8))
+    helpers.save_scaler_to_file(scaler, os.path.join(data_dir, "scaler.npz"))
+
+# Build a dataset of (features, targets) batches from the data saved by save_tuning_data().
+# split is "train" or "test". The arrays stay memory-mapped: the dataset only holds row indexes, which are
+# shuffled and batched, and each batch of rows is then read from the arrays as uint8 and scaled to float32
+# inside the graph. So memory use doesn't depend on how much data there is, and every trial in a process
+# reuses the same dataset instead of converting NumPy arrays again each time it calls fit().
+def make_tuning_dataset(project_dir: str, split: str, batch_size: int, shuffle_buffer: int = 0) -> tf.data.Dataset:
+    data_dir = os.path.join(project_dir, TUNING_DATA_DIRNAME)
+    X = np.load(os.path.join(data_dir, f"X_{split}.npy"), mmap_mode="r")
+    y = np.load(os.path.join(data_dir, f"y_{split}.npy"), mmap_mode="r")
+    scaler = helpers.load_scaler_from_file(os.path.join(data_dir, "scaler.npz"))
+
+    mean = tf.constant(np.reshape(scaler.mean_, X.shape[1:]), dtype=tf.float32)
+    scale = tf.constant(np.reshape(scaler.scale_, X.shape[1:]), dtype=tf.float32)
+
+    def read_rows(indexes):
+        return (X[indexes], y[indexes])
+
+    def read_and_scale_batch(indexes):
+        (X_batch, y_batch) = tf.numpy_function(read_rows, [indexes], (tf.uint8, tf.uint8))
+        X_batch.set_shape((None,) + X.shape[1:])
+        y_batch.set_shape((None,) + y.shape[1:])
+        return ((tf.cast(X_batch, tf.float32) - mean) / scale, tf.cast(y_batch, tf.float32))
+
+    dataset = tf.data.Dataset.range(len(X))
+    if shuffle_buffer > 0:
+        dataset = dataset.shuffle(shuffle_buffer)
+    dataset = dataset.batch(batch_size).map(read_and_scale_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+def read_tuning_config(project_dir: str) -> dict:
+    return json.loads(helpers.read_text_file(os.path.join(project_dir, TUNING_CONFIG_FILENAME)))
+
+# Create the Hyperband tuner described by a parallel search's config. Nothing is overwritten, so an
+# existing search in the project directory is reloaded, and any trials that were running get retried.
+def make_tuner(project_dir: str, config: dict) -> kt.Hyperband:
+    model_tuner = ModelTuner.from_config(config["model_tuner"])
+    project_dir = os.path.abspath(project_dir)
+
+    return kt.Hyperband(
+        model_tuner.CreateModel,
+        objective=kt.Objective(config["objective"], direction=config["objective_direction"]),
+        max_epochs=config["max_epochs"],
+        hyperband_iterations=config["hyperband_iterations"],
+        executions_per_trial=config["executions_per_trial"],
+        overwrite=False,
+        directory=os.path.dirname(project_dir),
+        project_name=os.path.basename(project_dir))
+
+# Callbacks to stop unpromising trials early, so Hyperband spends its epochs on better ones
+def get_pruning_callbacks(patience: int = PRUNE_PATIENCE, baseline: float = PRUNE_BASELINE) -> list:
+    if constants.USE_CUSTOM_METRICS:
+        prune = tf.keras.callbacks.EarlyStopping(monitor="val_modulo_distance_accuracy", mode="max", patience=patience, baseline=baseline)
+    else:
+        prune = tf.keras.callbacks.EarlyStopping(monitor="val_loss", mode="min", patience=patience)
+    return [prune, tf.keras.callbacks.TerminateOnNaN()]
+
+# Run one process of a parallel search: the chief, which serves the oracle until all the workers finish,
+# or a worker, which runs trials. The KERASTUNER_* environment variables set by run_search_processes() say which.
+def _run_search_process(project_dir: str, threads: int):
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+    config = read_tuning_config(project_dir)
+    tuner = make_tuner(project_dir, config)
+
+    # The chief never trains, so it doesn't need the data
+    if os.environ["KERASTUNER_TUNER_ID"] == "chief":
+        tuner.search()
+        return
+
+    train_ds = make_tuning_dataset(project_dir, "train", config["batch_size"], config["shuffle_buffer"])
+    test_ds = make_tuning_dataset(project_dir, "test", config["batch_size"])
+    tuner.search(train_ds, validation_data=test_ds, epochs=config["search_epochs"],
+                 callbacks=get_pruning_callbacks(config["prune_patience"], config["prune_baseline"]))
+
+# Launch a chief and several worker processes for the search saved in project_dir, and wait for them all to finish.
+# Each process writes its output to a log file in the project directory. TensorFlow's threads are split between
+# the workers, so they don't compete for the same cores.
+def run_search_processes(project_dir: str, workers: int = None, port: int = DEFAULT_ORACLE_PORT):
+    project_dir = os.path.abspath(project_dir)
+    workers = workers or os.cpu_count()
+    threads = max(1, os.cpu_count() // workers)
+    log_dir = os.path.join(project_dir, TUNING_LOG_DIRNAME)
+    os.makedirs(log_dir, exist_ok=True)
+
+    def launch(tuner_id: str) -> subprocess.Popen:
+        env = dict(os.environ, KERASTUNER_TUNER_ID=tuner_id, KERASTUNER_ORACLE_IP="127.0.0.1", KERASTUNER_ORACLE_PORT=str(port))
+        with open(os.path.join(log_dir, f"{tuner_id}.log"), "a") as log:
+            return subprocess.Popen([sys.executable, os.path.abspath(__file__), project_dir, "--process", "--threads", str(threads)],
+                                    env=env, stdout=log, stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    print(f"Running search in {project_dir} with {workers} workers, {threads} threads each. Logs are in {log_dir}")
+    chief = launch("chief")
+    worker_processes = [launch(f"tuner{i}") for i in range(workers)]
+    try:
+        failed = [i for i, process in enumerate(worker_processes) if process.wait() != 0]
+        if len(failed) > 0:
+            chief.terminate()
+            raise Exception(f"Tuner workers {failed} failed; see the logs in {log_dir}. Run the search again to resume it.")
+        chief.wait()
+    except BaseException:
+        # Don't leave processes running if the search is interrupted; it can be resumed later
+        for process in [chief] + worker_processes:
+            if process.poll() is None:
+                process.terminate()
+        raise
+
+# Run a Hyperband search for the best ModelTuner model, spread over a chief and several worker processes,
+# and return the tuner, reloaded with the results. The project directory keeps the oracle's state, so if a
+# search is interrupted, running it again with overwrite=False resumes where it left off, with the data and
+# settings saved the first time (the arguments here are only used for a new search).
+# X and y are the uint8 arrays, reshaped for the model but not scaled; the scaler is applied by each process.
+def run_parallel_search(model_tuner: ModelTuner, directory: str, project_name: str, scaler,
+                        X_train: np.ndarray, y_train: np.ndarray, X_test: np.ndarray, y_test: np.ndarray,
+                        objective: str, objective_direction: str = "max", max_epochs: int = 20, hyperband_iterations: int = 1,
+                        executions_per_trial: int = 1, search_epochs: int = 20, shuffle_buffer: int = 10000,
+                        prune_patience: int = PRUNE_PATIENCE, prune_baseline: float = PRUNE_BASELINE,
+                        workers: int = None, port: int = DEFAULT_ORACLE_PORT, overwrite: bool = False) -> kt.Hyperband:
+    project_dir = os.path.abspath(os.path.join(directory, project_name))
+    if overwrite and os.path.exists(project_dir):
+        shutil.rmtree(project_dir)
+
+    if os.path.exists(os.path.join(project_dir, TUNING_CONFIG_FILENAME)):
+        print(f"Resuming search in {project_dir}, with its saved data and settings")
+    else:
+        os.makedirs(project_dir, exist_ok=True)
+        save_tuning_data(project_dir, scaler, X_train, y_train, X_test, y_test)
+        config = {
+            "model_tuner": model_tuner.get_config(),
+            "objective": objective,
+            "objective_direction": objective_direction,
+            "max_epochs": max_epochs,
+            "hyperband_iterations": hyperband_iterations,
+            "executions_per_trial": executions_per_trial,
+            "search_epochs": search_epochs,
+            "batch_size": model_tuner.BATCH_SIZE,
+            "shuffle_buffer": shuffle_buffer,
+            "prune_patience": prune_patience,
+            "prune_baseline": prune_baseline,
+        }
+        # Written last, and to a temporary file first, so an interrupted save isn't mistaken for a search to resume
+        path = os.path.join(project_dir, TUNING_CONFIG_FILENAME)
+        helpers.write_text_file(json.dumps(config, indent=1), path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    run_search_processes(project_dir, workers, port)
+    return make_tuner(project_dir, read_tuning_config(project_dir))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run or resume a parallel Hyperband search saved by run_parallel_search()")
+    parser.add_argument("project_dir", help="The search's project directory, e.g. tuner_projects/KT")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: one per CPU core)")
+    parser.add_argument("--port", type=int, default=DEFAULT_ORACLE_PORT, help="Port for the chief to serve the oracle on")
+    parser.add_argument("--process", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--threads", type=int, default=1, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.process:
+        _run_search_process(args.project_dir, args.threads)
+    else:
+        run_search_processes(args.project_dir, args.workers, args.port)
+
+if __name__ == "__main__":
+    main()
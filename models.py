@@ -2,12 +2,21 @@
 # Note scaler value files are tracked a little differently since the same
 # scaler can be used for multiple models. Scaler files have the necessary
 # information embedded in their names.
+#
+# TensorFlow (and tf_helpers, which needs it) is only imported when a model is actually loaded,
+# so importing this file for the paths is quick.
 
-import tensorflow as tf
 import os
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+import helpers
 
 from constants import *
-from tf_helpers import *
+
+if TYPE_CHECKING:
+    import tensorflow as tf
 
 # Model for inferring the key from Caesar-encrypted text:
 CAESAR_KEY_MODEL_PATH = os.path.join(MODEL_DIR, "caesar_key_0256_0003.keras")
@@ -15,12 +24,109 @@ CAESAR_KEY_MODEL_PATH = os.path.join(MODEL_DIR, "caesar_key_0256_0003.keras")
 # Model for inferring plaintext from Caesar-encrypted text:
 CAESAR_TEXT_MODEL_PATH = os.path.join(MODEL_DIR, "caesar_text_0256_0001.keras")
 
-# Load model from file, including custom objects used throughout this project
-def load_model(path: str) -> tf.keras.Model:
+# Lean models, for inference only, are saved next to the originals with this suffix (see export_lean_model())
+LEAN_MODEL_SUFFIX = "_lean"
+
+# What each kind of model's output is used for, by the crackers:
+#   "key": the last timestep's prediction, output[:, -1, :]
+#   "text": for models that take the chunk as a sequence of single values, the last output unit at every
+#           timestep, output[:, :, -1]; for models that take the chunk as a single step, the last (only) timestep
+LEAN_TARGETS = ["key", "text"]
+
+# Load model from file, including custom objects used throughout this project.
+# Models are cached by path and modification time (see helpers.load_file_cached()), so loading the same
+# file again returns the same model, unless the file has changed. Pass use_cache=False for a fresh copy.
+def load_model(path: str, use_cache: bool = True) -> 'tf.keras.Model':
+    if use_cache:
+        return helpers.load_file_cached(path, _read_model_file)
+    return _read_model_file(path)
+
+def _read_model_file(path: str) -> 'tf.keras.Model':
+    import tensorflow as tf
+    from tf_helpers import modulo_distance_loss, modulo_distance_accuracy, modulo_rounded_accuracy, modulo_output
+
     return tf.keras.models.load_model(path,
                 custom_objects={
                     'modulo_distance_loss': modulo_distance_loss,
                     'modulo_distance_accuracy': modulo_distance_accuracy,
                     'modulo_rounded_accuracy': modulo_rounded_accuracy,
                     'modulo_output': modulo_output
-            })
\ No newline at end of file
+            })
+
+# Returns the path a lean version of the model at the given path is saved to
+def get_lean_model_path(path: str) -> str:
+    (base, extension) = os.path.splitext(path)
+    return base + LEAN_MODEL_SUFFIX + extension
+
+# Take just the part of a full model's output that the crackers use, as described for LEAN_TARGETS.
+# Works on outputs of either model, so lean outputs pass through unchanged.
+def slice_used_output(output, target: str, chunk_size: int):
+    if target == "text" and output.shape[1] == chunk_size:
+        return output[:, :, -1:]
+    return output[:, -1:, :]
+
+# Build an inference-only copy of a trained Sequential model of recurrent and Dense layers, which only
+# computes the part of the output the crackers use (see LEAN_TARGETS), with the same weights:
+#   "key": the last recurrent layer returns only its final state, instead of every timestep, so the
+#          layers after it run once per chunk rather than once per timestep
+#   "text", for models taking a sequence: the output layer keeps only its last unit
+# Either way, predictions take a chunk size times less memory. The outputs keep three dimensions, so the
+# crackers index them the same way. The lean model's output is checked against the original's.
+def make_lean_model(model: 'tf.keras.Model', target: str) -> 'tf.keras.Model':
+    import tensorflow as tf
+
+    if target not in LEAN_TARGETS:
+        raise Exception(f"Unsupported lean model target {target}; choose from {LEAN_TARGETS}")
+
+    chunk_size = int(np.prod(model.input_shape[1:]))
+    layers = list(model.layers)
+    sequence_layers = [i for (i, layer) in enumerate(layers) if layer.get_config().get("return_sequences")]
+    if len(sequence_layers) == 0 or not all(isinstance(layer, tf.keras.layers.Dense) for layer in layers[sequence_layers[-1] + 1:]):
+        raise Exception(f"Can only make lean models ending in a recurrent layer followed by Dense layers: {[l.name for l in layers]}")
+
+    keep_last_unit = target == "text" and model.output_shape[1] == chunk_size
+    lean = tf.keras.models.Sequential(name=model.name + LEAN_MODEL_SUFFIX)
+    lean.add(tf.keras.Input(shape=model.input_shape[1:], name="Input_Layer"))
+    for (i, layer) in enumerate(layers):
+        config = layer.get_config()
+        weights = layer.get_weights()
+        if i == sequence_layers[-1] and not keep_last_unit:
+            config["return_sequences"] = False
+        if i == len(layers) - 1 and keep_last_unit:
+            config["units"] = 1
+            weights = [weights[0][:, -1:], weights[1][-1:]] if len(weights) == 2 else [weights[0][:, -1:]]
+        new_layer = layer.__class__.from_config(config)
+        lean.add(new_layer)
+        new_layer.set_weights(weights)
+    if not keep_last_unit:
+        lean.add(tf.keras.layers.Reshape((1, model.output_shape[-1]), name="Last_Timestep"))
+
+    # Check the lean model predicts the same values as the original, on some inputs like scaled features
+    inputs = np.random.default_rng(0).standard_normal((8,) + tuple(model.input_shape[1:])).astype(np.float32)
+    expected = slice_used_output(model(inputs, training=False).numpy(), target, chunk_size)
+    actual = lean(inputs, training=False).numpy()
+    if actual.shape != expected.shape or not np.allclose(actual, expected, rtol=1e-4, atol=1e-4):
+        raise Exception(f"Lean model output doesn't match the original's; largest difference {np.max(np.abs(actual - expected))}")
+
+    return lean
+
+# Make a lean copy (see make_lean_model()) of the model at the given path, and save it next to the original
+# (see get_lean_model_path()), or to lean_path. Returns the path it was saved to.
+def export_lean_model(path: str, target: str, lean_path: str = None) -> str:
+    lean_path = lean_path or get_lean_model_path(path)
+    lean = make_lean_model(load_model(path, use_cache=False), target)
+
+    # Save to a temporary file first, so a cached copy of an older lean model can't be mistaken for this one
+    (base, extension) = os.path.splitext(lean_path)
+    temp_path = base + ".tmp" + extension
+    lean.save(temp_path)
+    os.replace(temp_path, lean_path)
+    return lean_path
+
+# Load the lean version of the model at the given path, exporting it first if it doesn't exist
+# or is older than the model.
+def load_lean_model(path: str, target: str, use_cache: bool = True) -> 'tf.keras.Model':
+    lean_path = get_lean_model_path(path)
+    if not os.path.exists(lean_path) or os.path.getmtime(lean_path) < os.path.getmtime(path):
+        export_lean_model(path, target, lean_path)
+    return load_model(lean_path, use_cache)
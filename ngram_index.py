@@ -0,0 +1,267 @@
+# This file contains the n-gram index: counts of every 1, 2, 3 and 4 character sequence (n-gram) across
+# the simplified texts, saved to disk so statistics and classical cracker scoring don't have to rescan
+# the whole corpus.
+#
+# N-grams are identified by their characters' offsets into CHARSET, read as a base len(CHARSET) number,
+# so each n-gram has a flat index from 0 to len(CHARSET)**n - 1. N-grams with a character outside
+# CHARSET aren't counted. Counts up to DENSE_MAX_N are stored densely, one value per possible n-gram;
+# longer n-grams are mostly never seen, so only the nonzero counts are stored, as sorted indexes and values.
+#
+# The index directory holds those .npy files, plus a manifest listing the files already counted, so
+# the librarian can add each new simplified file without recounting the rest. To build or update
+# the index from the simplified files, from the top directory:
+#   python ngram_index.py
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import concurrent.futures
+
+import numpy as np
+
+import encoders
+import helpers
+
+from constants import *
+
+MANIFEST_FILENAME = "manifest.json"
+NGRAM_SIZES = [1, 2, 3, 4]
+DENSE_MAX_N = 3
+
+# When updating the index, it gets saved after counting this many files
+UPDATE_BATCH_FILES = 100
+
+# Place value of each position in an n-gram, for turning its offsets into a flat index
+def ngram_places(n: int) -> np.ndarray:
+    return len(encoders.CHARSET) ** np.arange(n - 1, -1, -1, dtype=np.int64)
+
+# Flat indexes of all the n-grams in an array of offsets, skipping any with characters outside CHARSET
+def ngram_indexes(offsets: np.ndarray, n: int) -> np.ndarray:
+    if len(offsets) < n:
+        return np.zeros(0, dtype=np.int64)
+    count = len(offsets) - n + 1
+
+    # Build the indexes a position at a time, like reading digits, which is much faster than
+    # multiplying a sliding window view by the place values
+    values = offsets.astype(np.int64)
+    indexes = values[:count].copy()
+    for position in range(1, n):
+        indexes *= len(encoders.CHARSET)
+        indexes += values[position : position + count]
+
+    # An n-gram is invalid if its window has any invalid characters, which a running count can tell
+    invalid_counts = np.concatenate(([0], np.cumsum(offsets == encoders.INVALID_OFFSET)))
+    return indexes[invalid_counts[n:] == invalid_counts[:count]]
+
+# Turn flat n-gram indexes back into strings
+def ngram_strings(indexes: np.ndarray, n: int) -> list[str]:
+    offsets = (np.asarray(indexes, dtype=np.int64)[:, None] // ngram_places(n)) % len(encoders.CHARSET)
+    return [encoders.offsets_to_string(row) for row in offsets]
+
+# Count the n-grams of a text file, reading it a block at a time.
+# Returns (character count, {n: (indexes, counts)}), with only the nonzero counts, for each n-gram size.
+def count_file_ngrams(path: str, block_size: int = STREAMING_BLOCK_SIZE) -> tuple[int, dict]:
+    dense_counts = {n: np.zeros(len(encoders.CHARSET) ** n, dtype=np.int64) for n in NGRAM_SIZES if n <= DENSE_MAX_N}
+    sparse_parts = {n: [] for n in NGRAM_SIZES if n > DENSE_MAX_N}
+    char_count = 0
+
+    # Keep the end of each block, so n-grams across block boundaries get counted
+    tail = ""
+    for block in helpers.read_text_blocks(path, block_size):
+        offsets = encoders.string_to_offset_array(tail + block)
+        for n in NGRAM_SIZES:
+            # Skip n-grams that were already counted with the previous block
+            indexes = ngram_indexes(offsets[max(len(tail) - (n - 1), 0):], n)
+            if n <= DENSE_MAX_N:
+                dense_counts[n] += np.bincount(indexes, minlength=len(dense_counts[n]))
+            else:
+                sparse_parts[n].append(np.unique(indexes, return_counts=True))
+        char_count += len(block)
+        tail = (tail + block)[-(max(NGRAM_SIZES) - 1):]
+
+    sparse_counts = {}
+    for n in NGRAM_SIZES:
+        if n <= DENSE_MAX_N:
+            indexes = np.flatnonzero(dense_counts[n])
+            sparse_counts[n] = (indexes, dense_counts[n][indexes])
+        else:
+            sparse_counts[n] = _merge_sparse([indexes for (indexes, _) in sparse_parts[n]], [values for (_, values) in sparse_parts[n]])
+    return (char_count, sparse_counts)
+
+# Add up sparse counts: lists of index arrays and matching count arrays, in which an index can appear
+# more than once. Returns (indexes, counts), with sorted, distinct indexes.
+def _merge_sparse(index_arrays: list[np.ndarray], count_arrays: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    if len(index_arrays) == 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    (indexes, inverse) = np.unique(np.concatenate(index_arrays), return_inverse=True)
+    # bincount adds up weights as float64, which is exact for any count below 2**53
+    counts = np.bincount(inverse, weights=np.concatenate(count_arrays), minlength=len(indexes)).astype(np.int64)
+    return (indexes, counts)
+
+# Count the n-grams of size n across text files, without using (or changing) the index.
+# Returns a dense array of len(CHARSET)**n counts.
+def count_text_files(paths: list[str], n: int) -> np.ndarray:
+    counts = np.zeros(len(encoders.CHARSET) ** n, dtype=np.int64)
+    for path in paths:
+        (_, file_counts) = count_file_ngrams(path)
+        (indexes, values) = file_counts[n]
+        counts[indexes] += values
+    return counts
+
+# Read the index's manifest, or return None if there is no index in the directory
+def read_manifest(index_dir: str = NGRAM_INDEX_DIR) -> dict:
+    path = os.path.join(index_dir, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return None
+    return json.loads(helpers.read_text_file(path))
+
+# Write the manifest to a temporary file first, so the index is never left with a half-written manifest
+def _write_manifest(index_dir: str, manifest: dict):
+    path = os.path.join(index_dir, MANIFEST_FILENAME)
+    helpers.write_text_file(json.dumps(manifest, indent=1), path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def _new_manifest() -> dict:
+    return {"files": {}, "char_count": 0}
+
+def _counts_path(index_dir: str, n: int, part: str = None) -> str:
+    suffix = "" if part is None else f"_{part}"
+    return os.path.join(index_dir, f"counts_{n}{suffix}.npy")
+
+# Save an array to a temporary file, then move it into place
+def _save_array(path: str, array: np.ndarray):
+    np.save(path + ".tmp.npy", array)
+    os.replace(path + ".tmp.npy", path)
+
+# Load the counts for n-grams of size n, as a dense array of len(CHARSET)**n counts.
+# With dense=False, returns (indexes, counts) of just the nonzero counts instead.
+# Dense counts are memory-mapped, so loading takes next to no time. An index with no files has all zero counts.
+def load_counts(n: int, index_dir: str = NGRAM_INDEX_DIR, dense: bool = True):
+    if n not in NGRAM_SIZES:
+        raise Exception(f"The n-gram index has sizes {NGRAM_SIZES}, not {n}")
+
+    size = len(encoders.CHARSET) ** n
+    if n <= DENSE_MAX_N:
+        path = _counts_path(index_dir, n)
+        counts = np.load(path, mmap_mode='r') if os.path.exists(path) else np.zeros(size, dtype=np.int64)
+        if dense:
+            return counts
+        indexes = np.flatnonzero(counts)
+        return (indexes, counts[indexes])
+
+    path = _counts_path(index_dir, n, "indexes")
+    if os.path.exists(path):
+        (indexes, values) = (np.load(path), np.load(_counts_path(index_dir, n, "values")))
+    else:
+        (indexes, values) = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    if not dense:
+        return (indexes, values)
+    counts = np.zeros(size, dtype=np.int64)
+    counts[indexes] = values
+    return counts
+
+# Add the n-gram counts of some files to the index. file_counts is a list of (path, count_file_ngrams() result).
+def add_file_counts(index_dir: str, file_counts: list[tuple[str, tuple[int, dict]]]):
+    manifest = read_manifest(index_dir) or _new_manifest()
+    os.makedirs(index_dir, exist_ok=True)
+
+    for n in NGRAM_SIZES:
+        (old_indexes, old_values) = load_counts(n, index_dir, dense=False)
+        indexes = np.concatenate([old_indexes] + [counts[n][0] for (_, (_, counts)) in file_counts])
+        values = np.concatenate([old_values] + [counts[n][1] for (_, (_, counts)) in file_counts])
+
+        if n <= DENSE_MAX_N:
+            dense_counts = np.bincount(indexes, weights=values, minlength=len(encoders.CHARSET) ** n).astype(np.int64)
+            _save_array(_counts_path(index_dir, n), dense_counts)
+        else:
+            (merged_indexes, merged_values) = _merge_sparse([indexes], [values])
+            _save_array(_counts_path(index_dir, n, "indexes"), merged_indexes)
+            _save_array(_counts_path(index_dir, n, "values"), merged_values)
+
+    for (path, (char_count, _)) in file_counts:
+        manifest["files"][os.path.normpath(path)] = char_count
+        manifest["char_count"] += char_count
+    _write_manifest(index_dir, manifest)
+
+# Count any of the given text files that aren't in the index yet, and add them to it. The index is
+# saved after every UPDATE_BATCH_FILES files, so memory use doesn't grow with the number of new files.
+# With more than one worker, the files are counted in a process pool.
+# Returns a tuple (file_count, char_count) describing the files that got added.
+def update_index(paths: list[str], index_dir: str = NGRAM_INDEX_DIR, workers: int = 1) -> tuple[int, int]:
+    manifest = read_manifest(index_dir) or _new_manifest()
+    new_paths = sorted({os.path.normpath(p) for p in paths} - set(manifest["files"].keys()))
+    if len(new_paths) == 0:
+        return (0, 0)
+
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        char_count = 0
+        for start in range(0, len(new_paths), UPDATE_BATCH_FILES):
+            batch_paths = new_paths[start : start + UPDATE_BATCH_FILES]
+            results = list((executor.map if executor is not None else map)(count_file_ngrams, batch_paths))
+            add_file_counts(index_dir, list(zip(batch_paths, results)))
+            char_count += sum(file_char_count for (file_char_count, _) in results)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return (len(new_paths), char_count)
+
+# The most common n-grams of size n, as a list of (n-gram, count) tuples
+def most_common(n: int, count: int, index_dir: str = NGRAM_INDEX_DIR) -> list[tuple[str, int]]:
+    (indexes, values) = load_counts(n, index_dir, dense=False)
+    top = np.argsort(values, kind="stable")[::-1][:count]
+    return list(zip(ngram_strings(indexes[top], n), values[top].tolist()))
+
+
+def self_test():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        texts = [encoders.encode_simple("The quick brown fox jumps over the lazy dog. " * (i + 1)) + "é" for i in range(3)]
+        paths = []
+        for i, text in enumerate(texts):
+            paths.append(os.path.join(temp_dir, f"plain_{i}.txt"))
+            helpers.write_text_file(text, paths[-1])
+
+        # Build in two steps, to check incremental updates, then try adding the same files again
+        index_dir = os.path.join(temp_dir, "ngrams")
+        update_index(paths[:1], index_dir)
+        update_index(paths, index_dir)
+        print(f"Skip Counted Files: {update_index(paths, index_dir) == (0, 0)}")
+
+        # Compare with counting the simplest way
+        all_match = True
+        for n in NGRAM_SIZES:
+            expected = {}
+            for text in texts:
+                for i in range(len(text) - n + 1):
+                    ngram = text[i : i + n]
+                    if all(c in encoders.CHARSET for c in ngram):
+                        expected[ngram] = expected.get(ngram, 0) + 1
+            (indexes, values) = load_counts(n, index_dir, dense=False)
+            all_match &= dict(zip(ngram_strings(indexes, n), values.tolist())) == expected
+            all_match &= int(load_counts(n, index_dir).sum()) == sum(expected.values())
+        print(f"N-gram Counts: {all_match}")
+
+        # Counts across block boundaries should come out the same as reading whole files
+        (_, whole) = count_file_ngrams(paths[2])
+        (_, blocked) = count_file_ngrams(paths[2], block_size=7)
+        print(f"Block Boundaries: {all(np.array_equal(whole[n][1], blocked[n][1]) for n in NGRAM_SIZES)}")
+
+        print(f"Most Common: {most_common(1, 1, index_dir)[0][0] == ' '}")
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def main():
+    paths = [os.path.join(DATA_SIMPLIFIED_DIR, f) for f in sorted(os.listdir(DATA_SIMPLIFIED_DIR))]
+    (file_count, char_count) = update_index(paths)
+    print(f"Added {file_count} files ({char_count} characters) to the n-gram index")
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ["--self-test"]:
+        self_test()
+    else:
+        main()
@@ -0,0 +1,5 @@
+-- This file adds the indexes from schema.sql to a database created before they were part of it.
+-- It is safe to run more than once.
+CREATE INDEX IF NOT EXISTS files_encoder_test_only_idx ON files (encoder_ID, test_only);
+CREATE INDEX IF NOT EXISTS files_source_encoder_idx ON files (source_ID, encoder_ID);
+CREATE INDEX IF NOT EXISTS cipher_keys_type_value_idx ON cipher_keys (key_type_id, value);
@@ -41,4 +41,10 @@ CREATE TABLE files (
     FOREIGN KEY (key_ID) REFERENCES cipher_keys(id),
     path VARCHAR(128) NOT NULL,
     test_only BOOLEAN NOT NULL
-);
\ No newline at end of file
+);
+
+-- Indexes for the common lookups: files by encoder (and test_only), files by source and encoder,
+-- and keys by type and value. See indexes.sql to add these to an existing database.
+CREATE INDEX files_encoder_test_only_idx ON files (encoder_ID, test_only);
+CREATE INDEX files_source_encoder_idx ON files (source_ID, encoder_ID);
+CREATE INDEX cipher_keys_type_value_idx ON cipher_keys (key_type_id, value);
@@ -2,8 +2,15 @@
 
 import tensorflow as tf
 import numpy as np
+import random
+import os
+import shutil
+import tempfile
 
 import constants
+import encoders
+import helpers
+import feature_store
 
 # Custom output activation, forcing output to be within range -- but not rounding it off
 # Possibly not needed, sigmoid + rescaler might work just as well
@@ -22,6 +29,8 @@ def modulo_distance_loss(y_true, y_pred):
     Returns: 
         The computed loss. 
     """ 
+    # Targets may be stored compactly (e.g. uint8), so cast them to match the predictions
+    y_true = tf.cast(y_true, y_pred.dtype)
     # Compute the raw difference
     diff = tf.abs(y_true - y_pred)
     # Apply modulo operation to handle wrap-around cases
@@ -34,6 +43,7 @@ def modulo_distance_loss(y_true, y_pred):
 # Returns accuracy as 1 - (average percent distance from correct value)
 @tf.keras.utils.register_keras_serializable(package="RPM_breakerbot", name="modulo_distance_accuracy")
 def modulo_distance_accuracy(y_true, y_pred):
+    y_true = tf.cast(y_true, y_pred.dtype)
     diff = tf.abs(y_true - y_pred)
     mod_diff = tf.math.mod(diff, constants.CUSTOM_LOSS_MODULO)
     loss = tf.minimum(mod_diff, constants.CUSTOM_LOSS_MODULO - mod_diff)
@@ -47,6 +57,7 @@ def modulo_distance_accuracy(y_true, y_pred):
 @tf.keras.utils.register_keras_serializable(package="RPM_breakerbot", name="modulo_rounded_accuracy")
 def modulo_rounded_accuracy(y_true, y_pred):
     # y_true SHOULD all be round, in-bounds numbers but just in case...
+    y_true = tf.cast(y_true, y_pred.dtype)
     true_rounded = tf.math.round(y_true)
     true_mod = tf.math.mod(true_rounded, constants.CUSTOM_LOSS_MODULO)
 
@@ -88,6 +99,108 @@ def reshape_output_for_RNN(output: np.array, output_size: int) -> np.array:
     return output.reshape((-1, output_size, 1))
 
 
+# Decide whether a source belongs in the test split, from its ID and the seed. All chunks from a source
+# land on the same side, and the split is the same every run for the same seed.
+def is_test_source(source_id: int, test_fraction: float, split_seed: int = 0) -> bool:
+    return random.Random(f"{split_seed}:{source_id}").random() < test_fraction
+
+# How many rows are read at a time when streaming a dataset
+DATASET_READ_ROWS = 4096
+
+def _check_dataset_args(store_dir: str, file_sets: list[tuple], infer: str, split: str):
+    if (store_dir is None) == (file_sets is None):
+        raise Exception("Specify either store_dir or file_sets")
+    if infer not in ("key", "text"):
+        raise Exception(f"Unsupported inference target {infer}")
+    if split not in (None, "train", "test"):
+        raise Exception(f"Unsupported split {split}")
+
+# Stream chunks from a feature store (store_dir) or from text files (file_sets, as described for
+# feature_store.iter_file_parts(), plus the encoder), yielding tuples (X_block, y_block) of up to
+# DATASET_READ_ROWS uint8 rows. Memory use doesn't depend on how much data there is.
+#   infer: "key" or "text", choosing the targets
+#   split: "train" or "test" to keep only the sources on that side of a split by source ID (see is_test_source()),
+#          or None to keep everything
+#   shuffle_rng: if given, the order in which shards or files are read, and the rows within them, get shuffled
+def iter_dataset_blocks(chunk_size: int, infer: str = "key", store_dir: str = None, file_sets: list[tuple] = None,
+                        encoder: str = None, split: str = None, test_fraction: float = 0.25, split_seed: int = 0,
+                        shuffle_rng: np.random.Generator = None):
+    _check_dataset_args(store_dir, file_sets, infer, split)
+    target_name = "y_keys" if infer == "key" else "y_texts"
+
+    def keep_source(source_id) -> bool:
+        return split is None or is_test_source(int(source_id), test_fraction, split_seed) == (split == "test")
+
+    def shuffled(count: int):
+        return range(count) if shuffle_rng is None else shuffle_rng.permutation(count)
+
+    # Parts map from array name to rows, as in the feature store
+    if store_dir is not None:
+        shards = feature_store.load_shards(store_dir)
+        parts = (shards[i] for i in shuffled(len(shards)))
+    else:
+        file_sets = [file_set for file_set in file_sets if len(file_set[1]) > 0 and keep_source(file_set[1][0][0])]
+        file_parts = feature_store.iter_file_parts(encoder, chunk_size, [file_sets[i] for i in shuffled(len(file_sets))])
+        parts = (part for _, part in file_parts if part is not None)
+
+    for part in parts:
+        source_ids = part["ids"][:, 0]
+        kept_sources = [sid for sid in np.unique(source_ids) if keep_source(sid)]
+        rows = np.flatnonzero(np.isin(source_ids, kept_sources))
+        if shuffle_rng is not None:
+            shuffle_rng.shuffle(rows)
+        for start in range(0, len(rows), DATASET_READ_ROWS):
+            block = rows[start : start + DATASET_READ_ROWS]
+            yield (part["X"][block], part[target_name][block])
+
+# Build a tf.data pipeline of (features, targets) batches, for Model.fit(), evaluate() or predict(),
+# streaming chunks as described for iter_dataset_blocks(). Data stays uint8 until the final map step,
+# which scales it with the scaler's values, casts it to float32 and reshapes it for the RNN, inside the graph.
+#   shuffle_buffer: how many chunks to shuffle among, or 0 for no shuffling. When shuffling, the order in which
+#          shards or files are read, and the rows within them, get shuffled too, differently each epoch.
+def make_dataset(scaler, chunk_size: int, infer: str = "key", store_dir: str = None, file_sets: list[tuple] = None,
+                 encoder: str = None, split: str = None, test_fraction: float = 0.25, split_seed: int = 0,
+                 batch_size: int = 32, shuffle_buffer: int = 0, seed: int = None) -> tf.data.Dataset:
+    _check_dataset_args(store_dir, file_sets, infer, split)
+    if store_dir is not None:
+        manifest = feature_store.read_manifest(store_dir)
+        if manifest is None:
+            raise Exception(f"No feature store found in {store_dir}")
+        encoder = manifest["encoder"]
+
+    shuffle = shuffle_buffer > 0
+    shuffle_rng = np.random.default_rng(seed) if shuffle else None
+
+    def generate():
+        return iter_dataset_blocks(chunk_size, infer, store_dir, file_sets, encoder, split, test_fraction, split_seed, shuffle_rng)
+
+    if infer == "text":
+        target_shape = (chunk_size,)
+    elif encoder == encoders.ENCODER_CAESAR:
+        target_shape = ()
+    else:
+        target_shape = (len(encoders.CHARSET),)
+    output_size = int(np.prod(target_shape))
+
+    dataset = tf.data.Dataset.from_generator(generate, output_signature=(
+        tf.TensorSpec(shape=(None, chunk_size), dtype=tf.uint8),
+        tf.TensorSpec(shape=(None,) + target_shape, dtype=tf.uint8)))
+    dataset = dataset.unbatch()
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed)
+    dataset = dataset.batch(batch_size)
+
+    mean = tf.constant(scaler.mean_, dtype=tf.float32)
+    scale = tf.constant(scaler.scale_, dtype=tf.float32)
+
+    def scale_and_reshape(X, y):
+        X = (tf.cast(X, tf.float32) - mean) / scale
+        return (tf.reshape(X, (-1, chunk_size, 1)), tf.reshape(tf.cast(y, tf.float32), (-1, output_size, 1)))
+
+    dataset = dataset.map(scale_and_reshape, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
 def self_test():
     # Testing my loss and accuracy functions
     t_true = [[1.0, 2.0, 3.0, constants.CUSTOM_LOSS_MODULO*5]]*2
@@ -106,5 +219,44 @@ def self_test():
     print("accD:", accD)
     print("accR:", accR)
 
+    # Targets stored compactly should give the same loss as float targets
+    t_true_compact = tf.constant(np.array([[1, 2, 3, 0]]*2).astype(np.uint8))
+    t_pred_compact = tf.constant(np.array([[0.4, 1.5, 3.5, 0.4]]*2).astype(np.float32))
+    loss_compact = modulo_distance_loss(t_true_compact, t_pred_compact)
+    print("compact loss:", np.isclose(loss_compact.numpy(), loss.numpy()))
+
+    # Build a dataset from a few small encrypted files, and compare with scaling the same chunks directly
+    temp_dir = tempfile.mkdtemp()
+    try:
+        chunk_size = 8
+        file_sets = []
+        for source_id in range(6):
+            plaintext = encoders.encode_simple(f"Source number {source_id} says hello to the dataset. " * 3)
+            plaintext_path = os.path.join(temp_dir, f"plain_{source_id}.txt")
+            helpers.write_text_file(plaintext, plaintext_path)
+            ciphertext_path = os.path.join(temp_dir, f"cipher_{source_id}.txt")
+            helpers.write_text_file(encoders.encode_caesar(plaintext, source_id + 1), ciphertext_path)
+            file_sets.append((plaintext_path, [(source_id, source_id, source_id, str(source_id + 1), ciphertext_path)]))
+
+        parts = [part for _, part in feature_store.iter_file_parts(encoders.ENCODER_CAESAR, chunk_size, file_sets)]
+        all_X = np.concatenate([part["X"] for part in parts])
+        scaler = helpers.fit_scaler(all_X)
+
+        dataset = make_dataset(scaler, chunk_size, "key", file_sets=file_sets, encoder=encoders.ENCODER_CAESAR, batch_size=5)
+        X_batches, y_batches = zip(*[(X.numpy(), y.numpy()) for X, y in dataset])
+        X_from_dataset = np.concatenate(X_batches)
+        expected_X = reshape_input_for_RNN(helpers.scale_features(scaler, all_X), chunk_size)
+        expected_y = np.concatenate([part["y_keys"] for part in parts]).reshape((-1, 1, 1))
+        print("dataset matches:", np.allclose(X_from_dataset, expected_X, atol=1e-5) and np.array_equal(np.concatenate(y_batches), expected_y))
+
+        def split_keys(split):
+            dataset = make_dataset(scaler, chunk_size, "key", file_sets=file_sets, encoder=encoders.ENCODER_CAESAR,
+                                   split=split, test_fraction=0.5, split_seed=1, shuffle_buffer=50, seed=2)
+            return {int(k) for _, y in dataset for k in y.numpy().flatten()}
+        train_keys, test_keys = split_keys("train"), split_keys("test")
+        print("dataset split:", len(train_keys & test_keys) == 0 and len(train_keys | test_keys) == len(file_sets))
+    finally:
+        shutil.rmtree(temp_dir)
+
 if __name__ == '__main__':
     self_test()    
\ No newline at end of file